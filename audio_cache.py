@@ -0,0 +1,136 @@
+"""Cache for synthesized speech.
+
+Clips are keyed by the text and the voice settings (voice id, rate, volume),
+so the same sentence in another voice is a separate entry. A small in-memory
+LRU, bounded by bytes, sits in front of a directory of WAV files with a total
+size cap. On disk the least recently used files are evicted first; the
+modification time of a file doubles as its last use. WAV files can be handed
+to st.audio as they are.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from speech_engine import AudioClip
+
+
+def audio_key(text, voice=None, rate=None, volume=None):
+    """Stable key for a text spoken with the given settings"""
+    text = " ".join(text.split())
+    return hashlib.sha256(json.dumps([text, voice, rate, volume]).encode()).hexdigest()
+
+
+class AudioCache:
+    """In-memory LRU of AudioClips over a size-capped directory of WAV files"""
+
+    def __init__(self, directory=None, max_disk_bytes=256 * 2**20, max_memory_bytes=32 * 2**20):
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        # key -> file size, in least recently used order
+        self._files = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            entries = [e for e in os.scandir(directory) if e.name.endswith(".wav")]
+            for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+                self._files[entry.name[:-4]] = entry.stat().st_size
+                self._disk_bytes += entry.stat().st_size
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.wav")
+
+    def get(self, text, voice=None, rate=None, volume=None):
+        """Cached AudioClip or None"""
+        key = audio_key(text, voice, rate, volume)
+        with self._lock:
+            clip = self._memory.get(key)
+            if clip is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return clip
+            on_disk = key in self._files
+            if on_disk:
+                self._files.move_to_end(key)
+
+        if on_disk:
+            try:
+                clip = AudioClip.from_wav(self._path(key))
+                os.utime(self._path(key))
+            except (OSError, EOFError):
+                # Evicted by another process or truncated, treat as a miss
+                clip = None
+                with self._lock:
+                    self._disk_bytes -= self._files.pop(key, 0)
+            if clip is not None:
+                self._remember(key, clip)
+                with self._lock:
+                    self._stats["disk_hits"] += 1
+                return clip
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def put(self, clip, text, voice=None, rate=None, volume=None):
+        key = audio_key(text, voice, rate, volume)
+        self._remember(key, clip)
+        if not self.directory:
+            return
+        wav = clip.to_wav()
+        # Write under a temporary name so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(wav)
+        os.replace(tmp, self._path(key))
+        with self._lock:
+            self._disk_bytes += len(wav) - self._files.pop(key, 0)
+            self._files[key] = len(wav)
+            evicted = []
+            while self._disk_bytes > self.max_disk_bytes and len(self._files) > 1:
+                old_key, size = self._files.popitem(last=False)
+                self._disk_bytes -= size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def get_or_synthesize(self, synthesize, text, voice=None, rate=None, volume=None):
+        """Cached clip, or synthesize(text, voice=, rate=, volume=) and cache the result"""
+        clip = self.get(text, voice, rate, volume)
+        if clip is None:
+            clip = synthesize(text, voice=voice, rate=rate, volume=volume)
+            self.put(clip, text, voice, rate, volume)
+        return clip
+
+    def _remember(self, key, clip):
+        size = len(clip.pcm)
+        if size > self.max_memory_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous.pcm)
+            self._memory[key] = clip
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_memory_bytes:
+                _, old = self._memory.popitem(last=False)
+                self._memory_bytes -= len(old.pcm)
+
+    def stats(self):
+        """Hit counters, hit rate and the bytes held in memory and on disk"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(memory_bytes=self._memory_bytes, disk_bytes=self._disk_bytes, disk_entries=len(self._files))
+        total = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / total, 3) if total else None
+        return stats
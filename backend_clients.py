@@ -0,0 +1,607 @@
+"""Asynchronous backend calls with pooling, timeouts, retries and cancellation.
+
+Every outbound call (Stability, Gemini, Wikipedia) runs on one background
+event loop that owns a pooled aiohttp session, so connections are kept alive
+between calls instead of paying TCP and TLS setup each time. Each backend has
+its own timeout, concurrency limit and retry policy.
+
+Calls are made on behalf of a tenant (the engine passes the session id).
+Each tenant has a token bucket per backend, so one session can't fire an
+unbounded number of expensive calls, and when a backend is at its
+concurrency limit a freed slot goes to the waiting tenant with the fewest
+calls in flight rather than to whoever queued first, so a session firing
+many calls at once delays its own calls instead of everyone's.
+
+Calls can carry a key naming what they ask for (the engine uses the response
+cache key). While a call with that key is in flight, identical calls from any
+session wait for it instead of going upstream, and all get its result
+(single flight). A shared call is only stopped once every caller gave up.
+It runs as its first caller made it, so the key must cover everything else
+the answer depends on (the engine puts the Gemini key and chat history in
+Gemini's), and joining callers are charged against their own rate limit.
+
+Synchronous callers (the Streamlit script, the engine's worker threads)
+submit a coroutine and wait for it. The wait can be cancelled at any moment
+through a threading.Event, and an on_wait callback is called while waiting so
+the caller can update its UI (or be interrupted).
+"""
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import math
+import queue
+import random
+import sys
+import threading
+import time
+
+# Transient HTTP statuses worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# How often a waiting caller checks for cancellation and calls on_wait
+WAIT_TICK = 0.1
+
+# Past this many token buckets, the full ones (idle tenants) are dropped
+MAX_BUCKETS = 10000
+# How long fair sharing remembers when a tenant was last served
+SERVED_MEMORY = 60
+
+
+class BackendPolicy:
+    """Timeout (seconds per attempt), concurrency limit, retry policy and per-tenant rate limit of a backend.
+
+    A tenant may make burst calls at once and rate calls per second after
+    that; a call that would have to wait more than max_wait seconds for its
+    turn is refused with RateLimited. rate=None turns rate limiting off.
+    """
+
+    def __init__(self, timeout, concurrency, retries=0, backoff=0.5, max_backoff=8.0,
+                 rate=None, burst=1, max_wait=2.0):
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+
+
+# An image prompt is up to 4 samples plus their refinement, so stability allows 8 calls at once
+DEFAULT_POLICIES = {
+    "stability": BackendPolicy(timeout=90, concurrency=4, retries=2, backoff=1.0, rate=0.2, burst=8),
+    "gemini": BackendPolicy(timeout=60, concurrency=8, retries=1, rate=1.0, burst=10),
+    "wikipedia": BackendPolicy(timeout=10, concurrency=8, retries=2, rate=2.0, burst=10),
+}
+
+
+class BackendError(Exception):
+    """A backend call failed"""
+
+
+class BackendTimeout(BackendError):
+    """A backend did not answer within its timeout"""
+
+
+class BackendCancelled(BackendError):
+    """The caller cancelled the request"""
+
+
+class RetryableError(BackendError):
+    """Raised by request coroutines for failures worth another attempt"""
+
+
+class RateLimited(BackendError):
+    """The tenant made too many calls to a backend, retry_after is in seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_retryable(error):
+    if isinstance(error, (asyncio.TimeoutError, RetryableError)):
+        return True
+    # aiohttp is imported by the first HTTP call, any connection error comes after that
+    aiohttp = sys.modules.get("aiohttp")
+    if aiohttp is not None and isinstance(error, aiohttp.ClientConnectionError):
+        return True
+    # aiohttp response errors carry .status, google.api_core errors carry .code
+    status = getattr(error, "status", None) or getattr(error, "code", None)
+    return status in RETRY_STATUSES
+
+
+class TokenBucket:
+    """rate tokens per second, at most burst of them saved up"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, max_wait=0.0):
+        """Take a token, returns how long to wait before using it or None if that would exceed max_wait"""
+        self._refill(time.monotonic())
+        wait = max(0.0, (1 - self.tokens) / self.rate)
+        if wait > max_wait:
+            return None
+        # Waiting callers borrow from the future, so the tokens can go below zero
+        self.tokens -= 1
+        return wait
+
+    def retry_after(self):
+        """Seconds until a token is available"""
+        self._refill(time.monotonic())
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    @property
+    def full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.burst
+
+
+class FairShare:
+    """Concurrency limit that shares freed slots between tenants.
+
+    A freed slot goes to the waiting tenant with the fewest calls in flight
+    and, among equals, the one served least recently. A session that calls
+    once in a while is served ahead of sessions that were just given slots,
+    even when those have nothing in flight at the moment. Only used from
+    coroutines on the backend loop, so it needs no lock.
+    """
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.active = 0
+        self.queued = 0
+        self._running = {}
+        self._waiting = {}
+        # tenant -> time its last call started, forgotten after SERVED_MEMORY seconds
+        self._served = {}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tenant):
+        await self._acquire(tenant)
+        try:
+            yield
+        finally:
+            self._release(tenant)
+
+    async def _acquire(self, tenant):
+        if self.active < self.slots and not self._waiting:
+            self._start(tenant)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(tenant, collections.deque()).append(future)
+        self.queued += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted just as the caller gave up
+                self._release(tenant)
+            else:
+                waiters = self._waiting.get(tenant)
+                if waiters is not None and future in waiters:
+                    waiters.remove(future)
+                    self.queued -= 1
+                    if not waiters:
+                        del self._waiting[tenant]
+            raise
+
+    def _start(self, tenant):
+        self.active += 1
+        self._running[tenant] = self._running.get(tenant, 0) + 1
+        now = time.monotonic()
+        if len(self._served) >= MAX_BUCKETS:
+            self._served = {key: served for key, served in self._served.items() if now - served < SERVED_MEMORY}
+        self._served[tenant] = now
+
+    def _release(self, tenant):
+        self.active -= 1
+        if self._running[tenant] == 1:
+            del self._running[tenant]
+        else:
+            self._running[tenant] -= 1
+        self._grant()
+
+    def _grant(self):
+        while self.active < self.slots and self._waiting:
+            tenant = min(self._waiting, key=lambda waiting: (self._running.get(waiting, 0),
+                                                             self._served.get(waiting, 0.0)))
+            waiters = self._waiting[tenant]
+            future = waiters.popleft()
+            self.queued -= 1
+            if not waiters:
+                del self._waiting[tenant]
+            # Cancelled waiters are skipped, they remove themselves
+            if not future.done():
+                self._start(tenant)
+                future.set_result(None)
+
+
+class _Flight:
+    """One call shared by every caller with the same key"""
+
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class _StreamFlight:
+    """One stream read by every caller with the same key, items are kept for those who join late"""
+
+    __slots__ = ("task", "readers", "items", "done", "error", "changed")
+
+    def __init__(self):
+        self.task = None
+        self.readers = 0
+        self.items = []
+        self.done = False
+        self.error = None
+        # Replaced by a fresh event every time items or done change
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class AsyncBackends:
+    """Background event loop with a shared HTTP pool and per-backend limits"""
+
+    def __init__(self, policies=None, pool_size=64, keepalive_timeout=30, rate_limits=True):
+        self.policies = dict(DEFAULT_POLICIES, **(policies or {}))
+        # Off for single-user tools and benchmarks that drive one session as hard as they can
+        self.rate_limits = rate_limits
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self._loop = None
+        self._http = None
+        self._limits = {}
+        # (backend, tenant) -> TokenBucket, only touched on the backend loop
+        self._buckets = {}
+        # key -> _Flight or _StreamFlight of calls in flight, also only touched on the loop
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    # Event loop and HTTP pool
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="backend-loop", daemon=True).start()
+                self._loop = loop
+        return self._loop
+
+    def http(self):
+        """The pooled aiohttp session, only usable from coroutines on the backend loop"""
+        if self._http is None or self._http.closed:
+            import aiohttp
+
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout)
+            self._http = aiohttp.ClientSession(connector=connector)
+        return self._http
+
+    def _limit(self, backend):
+        if backend not in self._limits:
+            self._limits[backend] = FairShare(self.policies[backend].concurrency)
+        return self._limits[backend]
+
+    def _count(self, backend, outcome):
+        with self._lock:
+            counters = self._stats.setdefault(
+                backend, {"calls": 0, "coalesced": 0, "retries": 0, "timeouts": 0, "errors": 0, "cancelled": 0,
+                          "rate_limited": 0}
+            )
+            counters[outcome] += 1
+
+    def stats(self):
+        """Call, coalesced call, retry, timeout, error, cancellation and rate limit counters per backend"""
+        with self._lock:
+            stats = {backend: dict(counters) for backend, counters in self._stats.items()}
+        # Read without the loop's cooperation, so these are approximate
+        for backend, limit in list(self._limits.items()):
+            stats.setdefault(backend, {}).update(in_flight=limit.active, queued=limit.queued)
+        return stats
+
+    def prometheus(self, prefix="genai_chatbot"):
+        """The stats in the Prometheus text format: calls and their outcomes, calls in flight and queued"""
+        stats = self.stats()
+        calls, outcomes = f"{prefix}_backend_calls_total", f"{prefix}_backend_call_outcomes_total"
+        lines = [f"# HELP {calls} Backend calls requested by sessions.", f"# TYPE {calls} counter"]
+        lines += [f'{calls}{{backend="{backend}"}} {counters["calls"]}' for backend, counters in sorted(stats.items())]
+        lines += [f"# HELP {outcomes} Calls coalesced into an identical one in flight, rate limited, retried, "
+                  "timed out, failed or cancelled.", f"# TYPE {outcomes} counter"]
+        for backend, counters in sorted(stats.items()):
+            for outcome, value in sorted(counters.items()):
+                if outcome not in ("calls", "in_flight", "queued"):
+                    lines.append(f'{outcomes}{{backend="{backend}",outcome="{outcome}"}} {value}')
+        for gauge, help_text in (("in_flight", "Backend calls running now."),
+                                 ("queued", "Backend calls waiting for a free slot.")):
+            name = f"{prefix}_backend_{gauge}"
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            for backend, counters in sorted(stats.items()):
+                lines.append(f'{name}{{backend="{backend}"}} {counters.get(gauge, 0)}')
+        return "\n".join(lines) + "\n"
+
+    # Coroutines (run on the backend loop)
+
+    async def _admit(self, backend, tenant):
+        """Take a token from the tenant's bucket, waiting briefly if needed, or raise RateLimited"""
+        policy = self.policies[backend]
+        if tenant is None or policy.rate is None or not self.rate_limits:
+            return
+        bucket = self._buckets.get((backend, tenant))
+        if bucket is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                self._buckets = {key: kept for key, kept in self._buckets.items() if not kept.full}
+            bucket = self._buckets[(backend, tenant)] = TokenBucket(policy.rate, policy.burst)
+        wait = bucket.reserve(policy.max_wait)
+        if wait is None:
+            self._count(backend, "rate_limited")
+            retry_after = bucket.retry_after()
+            raise RateLimited(f"Too many {backend} requests from this session, "
+                              f"try again in {math.ceil(retry_after)}s", retry_after)
+        if wait:
+            await asyncio.sleep(wait)
+
+    async def _attempts(self, backend, request):
+        """Await request() with the backend's timeout, retrying transient failures with backoff"""
+        policy = self.policies[backend]
+        attempt = 0
+        while True:
+            try:
+                return await asyncio.wait_for(request(), policy.timeout)
+            except asyncio.CancelledError:
+                self._count(backend, "cancelled")
+                raise
+            except Exception as e:
+                if attempt >= policy.retries or not is_retryable(e):
+                    if isinstance(e, asyncio.TimeoutError):
+                        self._count(backend, "timeouts")
+                        raise BackendTimeout(f"{backend} did not answer within {policy.timeout}s") from e
+                    self._count(backend, "errors")
+                    raise
+                # Exponential backoff with jitter so retries from many sessions don't line up
+                delay = min(policy.backoff * 2 ** attempt, policy.max_backoff) * random.uniform(0.5, 1.0)
+                attempt += 1
+                self._count(backend, "retries")
+                await asyncio.sleep(delay)
+
+    async def _call(self, backend, request, tenant):
+        async with self._limit(backend).slot(tenant):
+            return await self._attempts(backend, request)
+
+    async def call(self, backend, request, tenant=None, key=None):
+        """Run request(), a coroutine function, under the backend's limits and policy.
+
+        With a key, a call identical to one in flight waits for that one's result.
+        The shared call is the first caller's request(), so it runs with whatever
+        that one carries (credentials, chat history): a key must name everything
+        the result depends on.
+        """
+        self._count(backend, "calls")
+        # Joining a call in flight takes a token as well, coalescing doesn't lift a session's limit
+        await self._admit(backend, tenant)
+        if key is None:
+            return await self._call(backend, request, tenant)
+        flight = self._flights.get(key)
+        if flight is None:
+            # It takes the first caller's concurrency slot
+            flight = self._flights[key] = _Flight(asyncio.ensure_future(self._call(backend, request, tenant)))
+            flight.task.add_done_callback(lambda _: self._land(key, flight))
+        else:
+            self._count(backend, "coalesced")
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                self._drop(key, flight)
+
+    def _land(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def _drop(self, key, flight):
+        """Cancel a flight nobody waits for, callers arriving after this start a new one"""
+        self._land(key, flight)
+        flight.task.cancel()
+
+    async def _stream_items(self, backend, open_stream, tenant):
+        """Items of one stream, opened under the backend's limits and policy"""
+        policy = self.policies[backend]
+        async with self._limit(backend).slot(tenant):
+            iterator = (await self._attempts(backend, open_stream)).__aiter__()
+            while True:
+                try:
+                    item = await asyncio.wait_for(iterator.__anext__(), policy.timeout)
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError as e:
+                    self._count(backend, "timeouts")
+                    raise BackendTimeout(f"{backend} stream stalled for {policy.timeout}s") from e
+                yield item
+
+    async def _shared_stream(self, backend, open_stream, tenant, key):
+        """Items of the stream in flight with this key, from the first one, or of a new one"""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _StreamFlight()
+            flight.task = asyncio.ensure_future(
+                self._fill(backend, flight, self._stream_items(backend, open_stream, tenant))
+            )
+            flight.task.add_done_callback(lambda _: self._land(key, flight))
+        else:
+            self._count(backend, "coalesced")
+        flight.readers += 1
+        try:
+            position = 0
+            while True:
+                if position < len(flight.items):
+                    yield flight.items[position]
+                    position += 1
+                elif flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                else:
+                    await flight.changed.wait()
+        finally:
+            flight.readers -= 1
+            if not flight.readers and not flight.task.done():
+                self._drop(key, flight)
+
+    async def _fill(self, backend, flight, items):
+        try:
+            async for item in items:
+                flight.items.append(item)
+                flight.notify()
+        except asyncio.CancelledError:
+            flight.error = BackendCancelled(f"{backend} stream cancelled")
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            flight.notify()
+
+    # Synchronous API
+
+    def submit(self, backend, request, tenant=None, key=None):
+        """Schedule a call on the backend loop and return a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(self.call(backend, request, tenant, key), self.loop)
+
+    def run(self, backend, request, cancel_event=None, on_wait=None, tenant=None, key=None):
+        """Blocking call for synchronous code.
+
+        Raises BackendCancelled as soon as cancel_event is set. If on_wait
+        raises (e.g. Streamlit interrupting the script), the request is
+        cancelled as well.
+        """
+        future = self.submit(backend, request, tenant, key)
+        try:
+            while True:
+                done, _ = concurrent.futures.wait([future], timeout=WAIT_TICK)
+                if done:
+                    return future.result()
+                if cancel_event is not None and cancel_event.is_set():
+                    raise BackendCancelled(f"{backend} request cancelled")
+                if on_wait is not None:
+                    on_wait()
+        finally:
+            # No-op when finished, otherwise stops the request on the loop
+            future.cancel()
+
+    def run_many(self, backend, requests, cancel_event=None, on_wait=None, limit=None, tenant=None, keys=None):
+        """Run several calls concurrently and yield (index, result, error) as each one finishes.
+
+        At most limit calls are in flight at once (on top of the backend's own
+        concurrency limit). A failed call is yielded with its error instead of
+        stopping the others; cancellation raises BackendCancelled and stops
+        every call still pending. keys, if given, has one key (or None) per
+        request.
+        """
+        keys = keys or [None] * len(requests)
+        waiting = list(enumerate(requests))
+        running = {}
+        limit = limit or len(waiting)
+        try:
+            while waiting or running:
+                while waiting and len(running) < limit:
+                    index, request = waiting.pop(0)
+                    running[self.submit(backend, request, tenant, keys[index])] = index
+                done, _ = concurrent.futures.wait(
+                    list(running), timeout=WAIT_TICK, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    index = running.pop(future)
+                    error = future.exception()
+                    yield index, None if error else future.result(), error
+                if cancel_event is not None and cancel_event.is_set():
+                    raise BackendCancelled(f"{backend} requests cancelled")
+                if not done and on_wait is not None:
+                    on_wait()
+        finally:
+            for future in running:
+                future.cancel()
+
+    def stream(self, backend, open_stream, cancel_event=None, on_wait=None, tenant=None, key=None):
+        """Iterate an async stream from synchronous code.
+
+        open_stream() is a coroutine function returning an async iterable.
+        Opening the stream is retried like a normal call, after that the
+        timeout applies to the wait for each item. With a key, a stream
+        identical to one in flight replays that one's items.
+        """
+        items = queue.Queue()
+        end = object()
+
+        async def pump():
+            self._count(backend, "calls")
+            try:
+                await self._admit(backend, tenant)
+                if key is None:
+                    source = self._stream_items(backend, open_stream, tenant)
+                else:
+                    source = self._shared_stream(backend, open_stream, tenant, key)
+                async for item in source:
+                    items.put(item)
+            finally:
+                items.put(end)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                try:
+                    item = items.get(timeout=WAIT_TICK)
+                except queue.Empty:
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise BackendCancelled(f"{backend} stream cancelled")
+                    if on_wait is not None:
+                        on_wait()
+                    continue
+                if item is end:
+                    # Re-raises the stream's error, if any
+                    future.result()
+                    return
+                yield item
+                if cancel_event is not None and cancel_event.is_set():
+                    raise BackendCancelled(f"{backend} stream cancelled")
+        finally:
+            future.cancel()
+
+    def close(self):
+        """Cancel the calls still running, close the HTTP pool and stop the loop"""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
+
+    async def _shutdown(self):
+        self._flights.clear()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.get_running_loop().shutdown_asyncgens()
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
@@ -0,0 +1,109 @@
+"""Replay latency and hit rates of the synthesized-speech cache.
+
+Usage:
+    python benchmarks/bench_audio_cache.py --replays 20
+
+Uses the fake TTS engine from bench_speech_output.py (synthesis time grows
+with the text) and measures SpeechPipeline.render, which is what the 🔊
+button calls, for:
+  * an uncached replay (every sentence synthesized)
+  * a replay served from the in-memory LRU
+  * a replay served from the WAV files after a restart (fresh cache object)
+Then replays a session-like mix of greetings, canned command replies and
+long answers and reports the hit rate. Checks that the on-disk store stays
+under its cap.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from audio_cache import AudioCache
+from bench_speech_output import REPLY, FakeSpeechService
+from speech_output import FakeAudioSink, SpeechPipeline, split_sentences
+
+CANNED = [
+    "Good Morning! I'm your AI Assistant. Please tell me how I can help you.",
+    "Opening YouTube in a new tab.",
+    "Opening Google in a new tab.",
+    "The time is 10:42:13",
+    "Goodbye! Have a nice day.",
+]
+SETTINGS = {"voice": None, "rate": 170, "volume": 1.0}
+
+
+def timed_render(pipeline, text, runs):
+    latencies = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        pipeline.render(text, **SETTINGS)
+        latencies.append(time.perf_counter() - started)
+    return np.median(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--replays", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=300)
+    parser.add_argument("--disk-mb", type=float, default=8)
+    args = parser.parse_args()
+
+    service = FakeSpeechService()
+    directory = tempfile.mkdtemp(prefix="tts-cache-")
+    try:
+        uncached = SpeechPipeline(service, FakeAudioSink(realtime=False))
+        cold_ms = timed_render(uncached, REPLY, 3)
+
+        cache = AudioCache(directory, max_disk_bytes=int(args.disk_mb * 2**20))
+        pipeline = SpeechPipeline(service, FakeAudioSink(realtime=False), cache=cache)
+        pipeline.render(REPLY, **SETTINGS)
+        memory_ms = timed_render(pipeline, REPLY, args.replays)
+
+        restarted = SpeechPipeline(service, FakeAudioSink(realtime=False), cache=AudioCache(directory))
+        started = time.perf_counter()
+        restarted.render(REPLY, **SETTINGS)
+        disk_ms = (time.perf_counter() - started) * 1000
+
+        print(f"Replay of a {len(REPLY)}-character reply:")
+        print(f"  uncached     {cold_ms:8.1f} ms")
+        print(f"  memory hit   {memory_ms:8.2f} ms")
+        print(f"  disk hit     {disk_ms:8.2f} ms (after restart)")
+
+        # A session: mostly new answers, plus canned replies, greetings and replays of recent answers
+        rng = random.Random(0)
+        mix_cache = AudioCache(os.path.join(directory, "mix"), max_disk_bytes=int(args.disk_mb * 2**20))
+        mix = SpeechPipeline(FakeSpeechService(fixed=0, per_char=0), FakeAudioSink(realtime=False), cache=mix_cache)
+        answers = []
+        for i in range(args.messages):
+            roll = rng.random()
+            if roll < 0.3:
+                text = rng.choice(CANNED)
+            elif roll < 0.5 and answers:
+                text = rng.choice(answers[-10:])
+            else:
+                # New answers share no sentences with earlier ones
+                text = " ".join(f"In answer {i}, {sentence}" for sentence in split_sentences(REPLY))
+                answers.append(text)
+            mix.render(text, **SETTINGS)
+        stats = mix_cache.stats()
+        print(f"Session mix of {args.messages} messages: hit rate {stats['hit_rate']:.0%} "
+              f"({stats['memory_hits']} memory, {stats['disk_hits']} disk, {stats['misses']} misses), "
+              f"{stats['disk_bytes'] / 2**20:.1f} MB on disk in {stats['disk_entries']} files")
+        ok = stats["disk_bytes"] <= args.disk_mb * 2**20 and memory_ms < cold_ms / 10
+        print(f"[{'ok' if ok else 'FAIL'}] replays are served from the cache and the disk store stays under its cap")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""Backend client behaviour against the local stub server.
+
+Usage:
+    python benchmarks/bench_backend_clients.py
+
+Runs image generation and Wikipedia lookups through ChatEngine against
+stub_backends.py and checks:
+  * connection reuse: sequential calls share pooled keep-alive connections,
+    compared with a new connection per call (the old requests.post client)
+  * concurrency limits: parallel calls never exceed the backend's limit
+  * timeouts: a stalled endpoint fails after the policy timeout
+  * retries: transient 503s are retried with backoff
+  * cancellation: a pending call stops shortly after cancel is requested
+Exits non-zero if a check fails.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import aiohttp
+
+from backend_clients import AsyncBackends, BackendPolicy, BackendTimeout
+from chat_engine import ChatEngine
+from image_store import ImageStore
+from response_cache import ResponseCache
+from stub_backends import StubBackends
+
+failures = 0
+
+
+def check(ok, label):
+    global failures
+    if not ok:
+        failures += 1
+    print(f"  [{'ok' if ok else 'FAIL'}] {label}")
+
+
+def make_engine(stub, image_dir, **policies):
+    backends = AsyncBackends(policies={name: BackendPolicy(**p) for name, p in policies.items()}, rate_limits=False)
+    engine = ChatEngine(
+        response_cache=ResponseCache(),
+        image_store=ImageStore(image_dir),
+        backends=backends,
+        stability_url=stub.stability_url,
+        wikipedia_url=stub.wikipedia_url,
+    )
+    session = engine.create_session()
+    engine.configure_image_generation(session, "stub-key-0000")
+    return engine, session
+
+
+async def unpooled_posts(url, headers, payload, calls):
+    """Sequential posts, each on a connection of its own like requests.post without a session"""
+    for _ in range(calls):
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as http:
+            async with http.post(url, headers=headers, json=payload) as response:
+                await response.read()
+
+
+def bench_connection_reuse(stub, image_dir, calls):
+    print(f"Connection reuse ({calls} sequential image requests)")
+    payload = {"text_prompts": [{"text": "cold"}], "samples": 1}
+    headers = {"Authorization": "Bearer stub-key-0000", "Accept": "image/png"}
+
+    stub.peers.clear()
+    started = time.perf_counter()
+    asyncio.run(unpooled_posts(stub.stability_url, headers, payload, calls))
+    cold_ms = (time.perf_counter() - started) / calls * 1000
+    cold_connections = len(stub.peers)
+
+    engine, session = make_engine(stub, image_dir)
+    stub.peers.clear()
+    started = time.perf_counter()
+    for i in range(calls):
+        engine.generate_image(session, f"pooled {i}")
+    pooled_ms = (time.perf_counter() - started) / calls * 1000
+    pooled_connections = len(stub.peers)
+    engine.backends.close()
+
+    print(f"    unpooled post:  {cold_ms:6.2f} ms/call, {cold_connections} connections")
+    print(f"    pooled session: {pooled_ms:6.2f} ms/call, {pooled_connections} connections")
+    check(pooled_connections < cold_connections, "pooled client reuses connections")
+
+
+def bench_concurrency(stub, image_dir, limit, calls):
+    print(f"Concurrency limit ({calls} parallel requests, limit {limit})")
+    stub.latency = 0.2
+    engine, _ = make_engine(stub, image_dir, stability={"timeout": 10, "concurrency": limit})
+
+    in_flight = 0
+    peak = 0
+    lock = threading.Lock()
+    original = stub._behave
+
+    async def counting(request, extra=0.0):
+        nonlocal in_flight, peak
+        with lock:
+            in_flight += 1
+            peak = max(peak, in_flight)
+        try:
+            await original(request, extra)
+        finally:
+            with lock:
+                in_flight -= 1
+
+    stub._behave = counting
+
+    def one(i):
+        session = engine.create_session()
+        engine.configure_image_generation(session, "stub-key-0000")
+        return engine.generate_image(session, f"parallel {i}")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=calls) as pool:
+        list(pool.map(one, range(calls)))
+    elapsed = time.perf_counter() - started
+    stub._behave = original
+    stub.latency = 0.0
+    engine.backends.close()
+
+    print(f"    {elapsed:.2f}s total, peak {peak} in flight")
+    check(peak <= limit, "never more requests in flight than the limit")
+
+
+def bench_timeout(stub, image_dir):
+    print("Timeout (stalled endpoint, 0.5s timeout, no retries)")
+    stub.stall = True
+    engine, session = make_engine(stub, image_dir, stability={"timeout": 0.5, "concurrency": 4, "retries": 0})
+    started = time.perf_counter()
+    try:
+        engine.generate_image(session, "stalled")
+        timed_out = False
+    except BackendTimeout:
+        timed_out = True
+    elapsed = time.perf_counter() - started
+    stub.stall = False
+    engine.backends.close()
+
+    print(f"    gave up after {elapsed:.2f}s")
+    check(timed_out and elapsed < 1.5, "stalled call fails with BackendTimeout near the timeout")
+
+
+def bench_retries(stub, image_dir, calls):
+    print(f"Retries ({calls} lookups, 30% of requests answered with 503)")
+    stub.failure_rate = 0.3
+    stub.failures = 0
+    engine, session = make_engine(stub, image_dir, wikipedia={"timeout": 5, "concurrency": 8, "retries": 6,
+                                                              "backoff": 0.01})
+    ok = 0
+    for i in range(calls):
+        try:
+            engine.wikipedia_summary(session, f"topic {i}")
+            ok += 1
+        except Exception:
+            pass
+    stub.failure_rate = 0.0
+    retries = engine.backends.stats().get("wikipedia", {}).get("retries", 0)
+    engine.backends.close()
+
+    print(f"    {ok}/{calls} succeeded, {stub.failures} injected failures, {retries} retries")
+    check(ok == calls and retries == stub.failures, "every injected failure was retried")
+
+
+def bench_cancellation(stub, image_dir):
+    print("Cancellation (5s request, cancelled after 0.2s)")
+    stub.latency = 5.0
+    stub.disconnects = 0
+    engine, session = make_engine(stub, image_dir)
+
+    timer = threading.Timer(0.2, engine.cancel, args=(session,))
+    started = time.perf_counter()
+    timer.start()
+    message = engine.handle(session, "draw a slow picture")
+    elapsed = time.perf_counter() - started
+    time.sleep(0.2)
+    stub.latency = 0.0
+    engine.backends.close()
+
+    print(f"    turn returned after {elapsed:.2f}s: {message['content']!r}, server saw {stub.disconnects} disconnects")
+    check(message.get("cancelled") and elapsed < 0.5, "turn stops within ~0.3s of cancel")
+    check(stub.disconnects == 1, "in-flight HTTP request was aborted")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=4)
+    args = parser.parse_args()
+
+    stub = StubBackends()
+    stub.start()
+    with tempfile.TemporaryDirectory() as image_dir:
+        bench_connection_reuse(stub, image_dir, args.calls)
+        bench_concurrency(stub, image_dir, args.limit, args.limit * 4)
+        bench_timeout(stub, image_dir)
+        bench_retries(stub, image_dir, args.calls)
+        bench_cancellation(stub, image_dir)
+    stub.stop()
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
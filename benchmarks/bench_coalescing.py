@@ -0,0 +1,159 @@
+"""Upstream calls under bursty load, with and without coalescing of identical calls.
+
+Usage:
+    python benchmarks/bench_coalescing.py --users 50 --bursts 9
+
+Users share one ChatEngine. In each burst they all send a query within a few
+milliseconds of each other, picked from --distinct queries nobody asked
+before (so nothing is cached yet): Wikipedia topics, image prompts, or chat
+questions with "Reuse answers" on (streamed, as the app does). Gemini is
+fake_gemini, Stability and Wikipedia the stub_backends server.
+
+The same bursts run twice: with identical calls in flight coalesced, and with
+every call going upstream. Reports upstream calls and turn latency per flow,
+and fails if a burst made more upstream calls than it had distinct queries
+with coalescing on, if a backend never coalesced a call, or if any turn
+failed.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from backend_clients import AsyncBackends
+from chat_engine import ChatEngine
+from fake_gemini import attach
+from image_store import ImageStore
+from metrics import Tracer, quantile
+from response_cache import ResponseCache
+from stub_backends import StubBackends
+
+FLOWS = ("wikipedia", "image", "chat")
+
+
+class UncoalescedBackends(AsyncBackends):
+    """Every call goes upstream, keys are ignored"""
+
+    async def call(self, backend, request, tenant=None, key=None):
+        return await super().call(backend, request, tenant)
+
+    def stream(self, backend, open_stream, cancel_event=None, on_wait=None, tenant=None, key=None):
+        return super().stream(backend, open_stream, cancel_event, on_wait, tenant)
+
+
+def query(flow, burst, variant):
+    if flow == "wikipedia":
+        return f"wikipedia topic {burst} {variant}"
+    if flow == "image":
+        return f"generate image of scene {burst} {variant}"
+    return f"what do you think about question {burst} {variant}"
+
+
+def run(args, stub, backends):
+    workdir = tempfile.mkdtemp(prefix="bench-coalescing-")
+    engine = ChatEngine(
+        response_cache=ResponseCache(max_entries=4096),
+        image_store=ImageStore(os.path.join(workdir, "images")),
+        backends=backends,
+        stability_url=stub.stability_url,
+        wikipedia_url=stub.wikipedia_url,
+        tracer=Tracer(),
+    )
+    sessions = []
+    for i in range(args.users):
+        session = engine.create_session()
+        session.use_memory = False
+        session.cache_chat_turns = True
+        attach(session, latency=args.gemini_latency, chunks=8, chunk_interval=0.02, reply_words=40, seed=i)
+        engine.configure_image_generation(session, "stub-key-0000")
+        sessions.append(session)
+
+    upstream, latencies, failures = {}, {}, 0
+    lock = threading.Lock()
+    for burst in range(args.bursts):
+        flow = FLOWS[burst % len(FLOWS)]
+        barrier = threading.Barrier(args.users)
+        before_stub = stub.requests
+        before_gemini = sum(session.convo.calls for session in sessions)
+
+        def user(index):
+            nonlocal failures
+            session = sessions[index]
+            text = query(flow, burst, index % args.distinct)
+            barrier.wait()
+            # Arrivals spread over a few milliseconds, like clicks rather than one instant
+            time.sleep(index % 10 * 0.001)
+            started = time.perf_counter()
+            intent = engine.route(session, text)
+            message = engine.handle(session, text, intent=intent,
+                                    on_chunk=(lambda chunk: None) if intent is None else None)
+            with lock:
+                latencies.setdefault(flow, []).append(time.perf_counter() - started)
+                failures += "error" in message or message.get("content", "").startswith("Sorry")
+
+        threads = [threading.Thread(target=user, args=(i,)) for i in range(args.users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        calls = (stub.requests - before_stub) + (sum(session.convo.calls for session in sessions) - before_gemini)
+        upstream.setdefault(flow, []).append(calls)
+
+    stats = backends.stats()
+    backends.close()
+    return upstream, latencies, failures, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--bursts", type=int, default=9, help="Bursts, taking turns between the flows")
+    parser.add_argument("--distinct", type=int, default=3, help="Different queries within one burst")
+    parser.add_argument("--gemini-latency", type=float, default=0.4)
+    parser.add_argument("--backend-latency", type=float, default=0.3, help="Stub Wikipedia and Stability latency")
+    args = parser.parse_args()
+
+    stub = StubBackends(latency=args.backend_latency)
+    stub.start()
+    print(f"{args.users} users, {args.bursts} bursts of {args.distinct} distinct queries, "
+          f"Gemini {args.gemini_latency}s, backends {args.backend_latency}s")
+    print(f"  {'':<12} {'flow':<10} {'upstream/burst':>14} {'p50':>9} {'p95':>9}")
+    results = {}
+    for label, backends in (("coalesced", AsyncBackends(rate_limits=False)),
+                            ("uncoalesced", UncoalescedBackends(rate_limits=False))):
+        upstream, latencies, failures, stats = run(args, stub, backends)
+        results[label] = (upstream, failures, stats)
+        for flow in FLOWS:
+            if flow in upstream:
+                times = sorted(latencies[flow])
+                print(f"  {label:<12} {flow:<10} {statistics.mean(upstream[flow]):>14.1f} "
+                      f"{quantile(times, 0.5) * 1000:>6.0f} ms {quantile(times, 0.95) * 1000:>6.0f} ms")
+        coalesced = {backend: counters["coalesced"] for backend, counters in stats.items()}
+        print(f"  {'':<12} coalesced calls per backend: {coalesced}")
+    stub.stop()
+
+    upstream, failures, stats = results["coalesced"]
+    worst = max(max(calls) for calls in upstream.values())
+    baseline = sum(sum(calls) for calls in results["uncoalesced"][0].values())
+    total = sum(sum(calls) for calls in upstream.values())
+    checks = [
+        (worst <= args.distinct, f"at most {args.distinct} upstream calls per burst (worst {worst})"),
+        (total < baseline, f"upstream calls {baseline} -> {total} with coalescing"),
+        *((stats.get(backend, {}).get("coalesced", 0) > 0, f"{backend} calls coalesced")
+          for backend in ("wikipedia", "stability", "gemini")),
+        (not failures and not results["uncoalesced"][1], "every turn answered"),
+    ]
+    for ok, label in checks:
+        print(f"[{'ok' if ok else 'FAIL'}] {label}")
+    sys.exit(0 if all(ok for ok, _ in checks) else 1)
+
+
+if __name__ == "__main__":
+    main()
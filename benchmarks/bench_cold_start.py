@@ -0,0 +1,127 @@
+"""Cold start of genai_chatbot.py: process start to first paint, and what it imports.
+
+Usage:
+    python benchmarks/bench_cold_start.py --runs 5
+    python benchmarks/bench_cold_start.py --script /tmp/old-tree/genai_chatbot.py
+
+Each run is a fresh Python process that imports Streamlit's AppTest harness
+and runs the app script once, like the first page load after a deploy or an
+idle restart. It reports the median time from process start to the end of
+that first run (harness included, so compare numbers with each other, not
+with a browser), and the time the app's own imports take.
+
+One extra run under `python -X importtime` breaks the app's imports down by
+top-level package, after the harness is loaded. Heavy SDKs (Gemini, aiohttp,
+pymongo, speech recognition) are only needed once a key is entered, MongoDB is
+connected or the microphone is used, so the run fails if any of them was
+imported before first paint.
+
+Pass --script to measure another version of the app, e.g. one checked out from
+an earlier commit with `git worktree add`.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# Imported by features the user turns on, never needed for the first page
+DEFERRED = ("google.generativeai", "aiohttp", "pymongo", "gridfs", "speech_recognition")
+MARKER = "--- app imports ---"
+
+
+def child(script):
+    """Runs in the measured process: first run of the app, result as JSON on stdout"""
+    started = float(os.environ["COLD_START_T0"])
+    from streamlit.testing.v1 import AppTest
+    harness = time.time() - started
+    print(MARKER, file=sys.stderr, flush=True)
+    before = time.time()
+    at = AppTest.from_file(script, default_timeout=300)
+    at.run()
+    first_run = time.time() - before
+    if at.exception:
+        raise SystemExit(f"App raised: {at.exception[0].value}")
+    print(json.dumps({
+        "harness_s": harness,
+        "first_run_s": first_run,
+        "first_paint_s": time.time() - started,
+        "loaded": [name for name in DEFERRED if name in sys.modules],
+    }))
+
+
+def run_child(script, importtime=False):
+    workdir = tempfile.mkdtemp(prefix="bench-cold-start-")
+    env = dict(
+        os.environ,
+        IMAGE_STORE_DIR=os.path.join(workdir, "images"),
+        JOB_DB_PATH="",
+        RESPONSE_CACHE_PATH="",
+        MEMORY_INDEX_DIR="",
+        TTS_CACHE_DIR="",
+        METRICS_PORT="",
+        COLD_START_T0=repr(time.time()),
+    )
+    flags = ["-X", "importtime"] if importtime else []
+    command = [sys.executable, *flags, os.path.abspath(__file__), "--child", script]
+    result = subprocess.run(command, env=env, capture_output=True, text=True, cwd=workdir)
+    if result.returncode != 0:
+        raise SystemExit(f"Child failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def import_breakdown(stderr):
+    """Self time per top-level package (µs) of the imports after the harness was loaded"""
+    packages, counting = {}, False
+    for line in stderr.splitlines():
+        if line == MARKER:
+            counting = True
+        elif counting and line.startswith("import time:") and "|" in line:
+            own, _, name = line[len("import time:"):].split("|")
+            if own.strip().isdigit():
+                package = name.strip().split(".")[0]
+                packages[package] = packages.get(package, 0) + int(own)
+    return packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--script", default=os.path.join(ROOT, "genai_chatbot.py"))
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=12, help="Packages listed in the import breakdown")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    script = os.path.abspath(args.script)
+    results = [run_child(script)[0] for _ in range(args.runs)]
+    traced, stderr = run_child(script, importtime=True)
+    packages = import_breakdown(stderr)
+
+    def median_ms(key):
+        return statistics.median(result[key] for result in results) * 1000
+
+    print(f"{script}, median of {args.runs} fresh processes:")
+    print(f"  harness imports   {median_ms('harness_s'):8.0f} ms")
+    print(f"  first app run     {median_ms('first_run_s'):8.0f} ms")
+    print(f"  to first paint    {median_ms('first_paint_s'):8.0f} ms")
+    print(f"App imports (-X importtime, self time by package, {sum(packages.values()) / 1000:.0f} ms total):")
+    for package, micros in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {package:<24} {micros / 1000:8.1f} ms")
+
+    loaded = traced["loaded"]
+    print(f"[{'ok' if not loaded else 'FAIL'}] heavy SDKs deferred until first use"
+          + (f" (imported at startup: {', '.join(loaded)})" if loaded else ""))
+    sys.exit(0 if not loaded else 1)
+
+
+if __name__ == "__main__":
+    main()
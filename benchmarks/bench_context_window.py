@@ -0,0 +1,112 @@
+"""Prompt size per turn over a long chat, with and without the context window.
+
+Usage:
+    python benchmarks/bench_context_window.py --turns 200
+
+Drives ChatEngine with a fake Gemini chat that records the history it is
+sent, and compares the prompt size per turn against the old behaviour of one
+chat that keeps every turn. Also checks that a session rebuilt from its
+stored messages sends the same context as the live one.
+Exits non-zero if the prompt grows past the budget.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from backend_clients import AsyncBackends
+from chat_engine import ChatEngine
+from context_window import estimate_tokens
+
+
+class Reply:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeChat:
+    """Stands in for a Gemini ChatSession, remembers the size of each prompt"""
+
+    def __init__(self, reply_words):
+        self.reply_words = reply_words
+        self.history = []
+        self.prompt_tokens = []
+
+    async def send_message_async(self, query, stream=False):
+        sent = sum(estimate_tokens(part) for content in self.history for part in content["parts"])
+        self.prompt_tokens.append(sent + estimate_tokens(query))
+        self.last = Reply(" ".join(f"word{i}" for i in range(self.reply_words)))
+        self.history = self.history + [
+            {"role": "user", "parts": [query]},
+            {"role": "model", "parts": [self.last.text]},
+        ]
+
+
+class FakeModel:
+    """Summarizer that returns a fixed-size summary"""
+
+    async def generate_content_async(self, prompt):
+        return Reply("Summary " + "fact " * 150)
+
+
+def run(engine, turns, reply_words):
+    session = engine.create_session()
+    session.convo = FakeChat(reply_words)
+    session.model = FakeModel()
+    started = time.perf_counter()
+    for i in range(turns):
+        engine.handle(session, f"question number {i} about the earlier answers")
+        # Let the background fold finish so runs are comparable
+        while session.context.folding:
+            time.sleep(0.001)
+    elapsed = time.perf_counter() - started
+    return session, session.convo.prompt_tokens, elapsed
+
+
+def unbounded(turns, reply_words):
+    """The old behaviour: every turn stays in the chat history"""
+    chat = FakeChat(reply_words)
+    for i in range(turns):
+        asyncio.run(chat.send_message_async(f"question number {i} about the earlier answers"))
+    return chat.prompt_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--reply-words", type=int, default=120)
+    parser.add_argument("--max-tokens", type=int, default=2000)
+    parser.add_argument("--keep-turns", type=int, default=6)
+    args = parser.parse_args()
+
+    settings = {"max_tokens": args.max_tokens, "keep_turns": args.keep_turns}
+    # No per-session rate limits, the turns come back to back
+    engine = ChatEngine(context_settings=settings, backends=AsyncBackends(rate_limits=False))
+    session, windowed, elapsed = run(engine, args.turns, args.reply_words)
+    baseline = unbounded(args.turns, args.reply_words)
+
+    print(f"{'turn':>6} {'unbounded tokens':>18} {'windowed tokens':>16}")
+    for i in sorted({0, 1, 5, 10, 25, 50, 100, args.turns - 1}):
+        if i < args.turns:
+            print(f"{i + 1:>6} {baseline[i]:>18} {windowed[i]:>16}")
+    print(f"Total prompt tokens: unbounded {sum(baseline)}, windowed {sum(windowed)}")
+    print(f"Engine time: {elapsed / args.turns * 1000:.2f} ms/turn, context {session.context.stats()}")
+
+    # A session rebuilt from the stored conversation sends the same context
+    session.context.fit("")
+    restored = engine.create_session(session.session_id)
+    restored.context.restore(session.context.summary, None, session.conversation[-2 * args.keep_turns:])
+    same = restored.context.history() == session.context.history()
+    print(f"Restored context matches live context: {same}")
+
+    bounded = max(windowed) <= args.max_tokens
+    print(f"Max windowed prompt {max(windowed)} tokens, budget {args.max_tokens}: {'ok' if bounded else 'FAIL'}")
+    sys.exit(0 if bounded and same else 1)
+
+
+if __name__ == "__main__":
+    main()
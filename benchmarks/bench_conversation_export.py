@@ -0,0 +1,172 @@
+"""Export and import throughput of the conversations collection, NDJSON vs Parquet.
+
+Usage:
+    python benchmarks/bench_conversation_export.py --messages 100000
+    python benchmarks/bench_conversation_export.py --messages 1000000 --mongo mongodb://localhost:27017
+
+Fills a conversations collection (mongomock, or --mongo for a real server)
+with synthetic sessions: Zipf-distributed words, every 50th message an
+image_ref, every 500th a legacy inline image and latency stats on the
+assistant replies. For each format it exports the collection, imports it
+into an empty database, stopping after the first part and resuming, and
+checks that every message came back unchanged.
+
+Reports messages/second for export and import, bytes per message on disk
+and the peak Python heap while reading the parts back, which depends on
+--chunk-size and not on the number of messages. mongomock's cursors copy
+their result list for every document they return, so export rates without
+--mongo are far below a real server's. Exits non-zero if a round trip lost
+or changed a message.
+"""
+import argparse
+import base64
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from bson import ObjectId
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from conversation_export import FORMATS, export_conversations, import_conversations, load_manifest, read_part
+from image_store import ImageStore
+
+VOCABULARY = 20_000
+WORDS_PER_MESSAGE = (4, 60)
+MESSAGES_PER_SESSION = 20
+START = datetime.datetime(2025, 1, 1)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def generate(count, image_refs, seed=0, batch_size=20_000):
+    """Batches of message documents in timestamp order"""
+    rng = np.random.default_rng(seed)
+    inline = "data:image/png;base64," + base64.b64encode(rng.bytes(20_000)).decode()
+    for first in range(0, count, batch_size):
+        size = min(batch_size, count - first)
+        lengths = rng.integers(*WORDS_PER_MESSAGE, size=size)
+        ranks = np.minimum(rng.zipf(1.2, size=int(lengths.sum())), VOCABULARY)
+        batch, position = [], 0
+        for i in range(first, first + size):
+            words = ranks[position:position + lengths[i - first]]
+            position += lengths[i - first]
+            doc = {
+                "_id": ObjectId(),
+                "session_id": f"session-{i // MESSAGES_PER_SESSION}",
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": " ".join(f"w{rank}" for rank in words),
+                "timestamp": START + datetime.timedelta(seconds=i * 7),
+            }
+            if i % 2:
+                doc["latency"] = {"first_token_ms": float(rng.integers(100, 900)), "total_ms": 1200.0}
+            if i % 50 == 1:
+                doc["image_ref"] = image_refs[i // 50 % len(image_refs)]
+            if i % 500 == 1:
+                doc["image_url"] = inline
+            batch.append(doc)
+        yield batch
+
+
+def disk_size(directory):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+
+
+def read_peak(directory, chunk_size):
+    """Peak traced heap while reading every part of an export"""
+    tracemalloc.start()
+    for part in load_manifest(directory)["parts"]:
+        for _ in read_part(os.path.join(directory, part["file"]), chunk_size):
+            pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def same_messages(source, target):
+    """Whether both collections hold the same documents"""
+    if source.count_documents({}) != target.count_documents({}):
+        return False
+    for expected, got in zip(source.find().sort("_id", 1), target.find().sort("_id", 1)):
+        if expected != got:
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--chunk-size", type=int, default=10_000)
+    parser.add_argument("--images", type=int, default=20, help="Distinct generated images")
+    parser.add_argument("--mongo", help="MongoDB connection string, mongomock when not given")
+    args = parser.parse_args()
+
+    if args.mongo:
+        import pymongo
+        client = pymongo.MongoClient(args.mongo)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+    names = [f"bench_export_{os.getpid()}_{name}" for name in ("source", *FORMATS)]
+    source = client[names[0]]
+    workdir = tempfile.mkdtemp(prefix="bench-export-")
+    images = ImageStore(os.path.join(workdir, "images"))
+    rng = np.random.default_rng(1)
+    image_refs = [images.put(rng.bytes(50_000)) for _ in range(args.images)]
+
+    started = time.perf_counter()
+    for batch in generate(args.messages, image_refs):
+        source.conversations.insert_many(batch, ordered=False)
+    print(f"Stored {args.messages:,} messages in {time.perf_counter() - started:.1f}s "
+          f"({'mongomock' if not args.mongo else args.mongo}), parts of {args.chunk_size:,}")
+    print(f"  {'format':<8} {'export':>12} {'import':>12} {'on disk':>10} {'per msg':>9} {'read peak':>10}")
+
+    ok = True
+    for fmt, name in zip(FORMATS, names[1:]):
+        directory = os.path.join(workdir, fmt)
+        started = time.perf_counter()
+        exported = export_conversations(source, directory, fmt, args.chunk_size, images)
+        export_s = time.perf_counter() - started
+
+        target = client[name]
+        target_images = ImageStore(os.path.join(workdir, f"images-{fmt}"))
+
+        def interrupt(part):
+            raise Interrupted
+
+        started = time.perf_counter()
+        try:
+            import_conversations(target, directory, args.chunk_size, target_images, on_part=interrupt)
+        except Interrupted:
+            pass
+        imported = import_conversations(target, directory, args.chunk_size, target_images)
+        import_s = time.perf_counter() - started
+
+        parts_size = disk_size(directory) - disk_size(os.path.join(directory, "images"))
+        peak = read_peak(directory, args.chunk_size)
+        print(f"  {fmt:<8} {exported['messages'] / export_s:>8,.0f}/s {args.messages / import_s:>10,.0f}/s "
+              f"{parts_size / 2 ** 20:>7.1f} MB {parts_size / args.messages:>7.0f} B {peak / 2 ** 20:>7.1f} MB")
+
+        matches = same_messages(source.conversations, target.conversations)
+        images_ok = all(target_images.contains(ref) for ref in image_refs)
+        ok &= matches and images_ok and not imported["failed"]
+        print(f"  [{'ok' if matches else 'FAIL'}] {fmt}: all {args.messages:,} messages identical after an "
+              f"interrupted and resumed import ({imported['inserted']:,} inserted on resume)")
+        print(f"  [{'ok' if images_ok else 'FAIL'}] {fmt}: every referenced image restored from the sidecar files")
+
+    for name in names:
+        client.drop_database(name)
+    shutil.rmtree(workdir)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
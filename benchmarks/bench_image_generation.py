@@ -0,0 +1,136 @@
+"""Multi-sample image generation against the local Stability stub.
+
+Usage:
+    python benchmarks/bench_image_generation.py --samples 4 --step-latency 0.02
+
+The stub takes latency + steps x step-latency per image. For N samples of a
+prompt it compares:
+  * sequential: one generate_image call after another (the old flow, one
+    image per request and turn)
+  * parallel: generate_images fanning the samples out concurrently
+  * draft then refine: draft samples first, then the standard preset with
+    the same seeds
+and reports when the first image arrived and when the last one did. Checks
+that every sample is delivered, that the requests in flight never exceed the
+job's limit, and that thumbnails are ready when on_image is called.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from backend_clients import AsyncBackends
+from chat_engine import ChatEngine
+from image_store import ImageStore
+from response_cache import ResponseCache
+from stub_backends import StubBackends
+
+failures = 0
+
+
+def check(ok, label):
+    global failures
+    if not ok:
+        failures += 1
+    print(f"  [{'ok' if ok else 'FAIL'}] {label}")
+
+
+def make_engine(stub, image_dir, parallelism):
+    engine = ChatEngine(
+        response_cache=ResponseCache(),
+        image_store=ImageStore(image_dir),
+        backends=AsyncBackends(rate_limits=False),
+        stability_url=stub.stability_url,
+        wikipedia_url=stub.wikipedia_url,
+        image_parallelism=parallelism,
+    )
+    session = engine.create_session()
+    engine.configure_image_generation(session, "stub-key-0000")
+    return engine, session
+
+
+def count_in_flight(stub):
+    """Wrap the stub handler to record the peak number of concurrent image requests"""
+    state = {"in_flight": 0, "peak": 0}
+    lock = threading.Lock()
+    original = stub._behave
+
+    async def counting(request, extra=0.0):
+        with lock:
+            state["in_flight"] += 1
+            state["peak"] = max(state["peak"], state["in_flight"])
+        try:
+            await original(request, extra)
+        finally:
+            with lock:
+                state["in_flight"] -= 1
+
+    stub._behave = counting
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=4)
+    parser.add_argument("--parallelism", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--step-latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    stub = StubBackends(latency=args.latency, step_latency=args.step_latency)
+    stub.start()
+    in_flight = count_in_flight(stub)
+    with tempfile.TemporaryDirectory() as image_dir:
+        engine, session = make_engine(stub, image_dir, args.parallelism)
+
+        started = time.perf_counter()
+        first = None
+        for i in range(args.samples):
+            engine.generate_image(session, "sequential prompt", seed=i + 1)
+            first = first or time.perf_counter() - started
+        sequential = (first, time.perf_counter() - started)
+
+        def run(prompt, **kwargs):
+            arrivals = []
+            thumbnails_ready = []
+
+            def on_image(index, image_ref, preset):
+                arrivals.append((time.perf_counter() - started, index, preset))
+                thumbnails_ready.append(os.path.exists(
+                    engine.image_store._path(image_ref, kind="thumbnails", suffix="-512x512")))
+
+            started = time.perf_counter()
+            refs = engine.generate_images(session, prompt, samples=args.samples, on_image=on_image, **kwargs)
+            return refs, arrivals, all(thumbnails_ready)
+
+        refs, arrivals, thumbs = run("parallel prompt")
+        parallel = (arrivals[0][0], arrivals[-1][0])
+        check(len(refs) == args.samples and thumbs, f"parallel run delivered {len(refs)} images with thumbnails")
+
+        refs, arrivals, thumbs = run("refined prompt", preset="draft", refine_to="standard")
+        drafts = [a for a in arrivals if a[2] == "draft"]
+        final = [a for a in arrivals if a[2] == "standard"]
+        check(len(drafts) == len(final) == args.samples and thumbs, "every draft was refined")
+
+        print(f"{args.samples} samples, stub {args.latency}s + {args.step_latency}s/step, "
+              f"limit {args.parallelism} in flight:")
+        print(f"  sequential         first image {sequential[0]:5.2f}s, all {sequential[1]:5.2f}s")
+        print(f"  parallel           first image {parallel[0]:5.2f}s, all {parallel[1]:5.2f}s")
+        print(f"  draft then refine  first draft {drafts[0][0]:5.2f}s, all drafts {drafts[-1][0]:5.2f}s, "
+              f"all refined {final[-1][0]:5.2f}s")
+        print(f"  peak {in_flight['peak']} image requests in flight")
+        check(in_flight["peak"] <= args.parallelism, "requests in flight stayed within the limit")
+        check(parallel[1] < sequential[1] / min(args.samples, args.parallelism) * 1.5, "parallel samples overlap")
+        engine.backends.close()
+    stub.stop()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
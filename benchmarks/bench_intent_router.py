@@ -0,0 +1,89 @@
+"""Intent routing accuracy and cost as the number of registered commands grows.
+
+Usage:
+    python benchmarks/bench_intent_router.py
+
+First checks the built-in commands against intent_corpus.json, then times
+routing with thousands of extra synthetic commands registered. The old
+substring if/elif chain is timed alongside for comparison.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from intent_router import BUILTIN_COMMANDS, IntentRouter
+
+
+def check_corpus(router, path):
+    with open(path) as f:
+        cases = json.load(f)
+
+    failures = 0
+    for case in cases:
+        intent = router.route(case["query"])
+        name = intent.name if intent else None
+        args = intent.args if intent else {}
+        expected_args = case.get("args", {})
+        if name != case["intent"] or (expected_args and args != expected_args):
+            failures += 1
+            print(f"  MISMATCH {case['query']!r}: got {name} {args}, expected {case['intent']} {expected_args}")
+    print(f"Corpus: {len(cases) - failures}/{len(cases)} routed as expected")
+    return failures
+
+
+def build_router(extra_commands):
+    router = IntentRouter(BUILTIN_COMMANDS)
+    for i in range(extra_commands):
+        router.register(f"synthetic_{i}", [f"synthetic command {i}", f"run task{i}"])
+    return router
+
+
+def linear_route(phrases, query):
+    """The old approach: one substring test per phrase"""
+    for name, phrase in phrases:
+        if phrase in query:
+            return name
+    return None
+
+
+def time_per_call(func, queries, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            func(query)
+    return (time.perf_counter() - started) / (repeat * len(queries)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default=os.path.join(HERE, "intent_corpus.json"))
+    parser.add_argument("--sizes", default="0,10,100,1000,10000")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    failures = check_corpus(IntentRouter(BUILTIN_COMMANDS), args.corpus)
+
+    with open(args.corpus) as f:
+        queries = [case["query"] for case in json.load(f)]
+
+    print(f"{'commands':>10} {'trie us/route':>15} {'substring us/route':>20}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        router = build_router(size)
+        phrases = [(c["name"], p) for c in BUILTIN_COMMANDS for p in c["phrases"]]
+        phrases += [(f"synthetic_{i}", f"synthetic command {i}") for i in range(size)]
+        # Put the synthetic phrases first so general queries pay for the whole scan, like new commands would
+        phrases = phrases[len(phrases) - size:] + phrases[:len(phrases) - size]
+        trie_us = time_per_call(router.route, queries, args.repeat)
+        linear_us = time_per_call(lambda q: linear_route(phrases, q), queries, max(1, args.repeat // 10))
+        print(f"{len(BUILTIN_COMMANDS) + size:>10} {trie_us:>15.2f} {linear_us:>20.2f}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
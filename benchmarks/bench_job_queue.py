@@ -0,0 +1,137 @@
+"""How long an image request holds up the turn, with and without the job queue.
+
+Usage:
+    python benchmarks/bench_job_queue.py --latency 3 --samples 2
+
+Runs against the local Stability stub with a slow image endpoint:
+  * inline: ChatEngine.handle generates the images before it returns, so the
+    Streamlit script (and every other message of the session) waits
+  * background: handle returns a pending placeholder and a job fills it in
+Reports how long the image turn took, how long a text turn sent right after
+it took, and when the images were in. Checks that the placeholder is filled
+in memory and in MongoDB (mongomock), that the per-session cap holds, and that
+jobs cut short by a restart are not reported as still running.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import mongomock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from backend_clients import AsyncBackends
+from chat_engine import ChatEngine
+from conversation_store import ConversationWriter
+from image_store import ImageStore
+from job_queue import ACTIVE_STATUSES, JobQueue
+from response_cache import ResponseCache
+from stub_backends import StubBackends
+
+failures = 0
+
+
+def check(ok, label):
+    global failures
+    if not ok:
+        failures += 1
+    print(f"  [{'ok' if ok else 'FAIL'}] {label}")
+
+
+def make_engine(stub, image_dir, jobs=None, writer=None, samples=1):
+    engine = ChatEngine(
+        response_cache=ResponseCache(),
+        image_store=ImageStore(image_dir),
+        backends=AsyncBackends(rate_limits=False),
+        stability_url=stub.stability_url,
+        wikipedia_url=stub.wikipedia_url,
+        writer=writer,
+        jobs=jobs,
+    )
+    session = engine.create_session()
+    engine.configure_image_generation(session, "stub-key-0000")
+    session.image_samples = samples
+    return engine, session
+
+
+def timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def wait_until(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=3.0)
+    parser.add_argument("--samples", type=int, default=2)
+    args = parser.parse_args()
+
+    stub = StubBackends(latency=args.latency, step_latency=0)
+    stub.start()
+    with tempfile.TemporaryDirectory() as workdir:
+        engine, session = make_engine(stub, workdir, samples=args.samples)
+        image_turn, inline_image_s = timed(engine.handle, session, "draw a lighthouse at dusk")
+        _, inline_text_s = timed(engine.handle, session, "what's the time")
+        check("image_ref" in image_turn, "inline turn returned its images")
+        engine.backends.close()
+
+        db = mongomock.MongoClient().assistant_db
+        writer = ConversationWriter(db.conversations, sessions=db.sessions, flush_interval=0.05)
+        job_path = os.path.join(workdir, "jobs.sqlite3")
+        jobs = JobQueue(job_path, max_per_session=2)
+        engine, session = make_engine(stub, workdir, jobs=jobs, writer=writer, samples=args.samples)
+        started = time.perf_counter()
+        placeholder, background_image_s = timed(engine.handle, session, "draw a harbour at dawn")
+        _, background_text_s = timed(engine.handle, session, "what's the time")
+        check(placeholder.get("pending") and "job_id" in placeholder, "background turn returned a pending placeholder")
+
+        filled = wait_until(lambda: not placeholder.get("pending"), args.latency * 4 + 5)
+        ready_s = time.perf_counter() - started
+        check(filled and len(placeholder.get("image_refs", [placeholder.get("image_ref")])) == args.samples,
+              "job filled the placeholder with every sample")
+        stored = wait_until(lambda: (db.conversations.find_one({"job_id": placeholder["job_id"]}) or {}).get("image_ref"), 5)
+        check(stored, "stored placeholder was updated with the images")
+        check(jobs.get(placeholder["job_id"])["status"] == "done", "job recorded as done")
+
+        print(f"Image request with {args.samples} samples, stub latency {args.latency}s:")
+        print(f"  inline      image turn {inline_image_s:6.2f}s, next text turn waited {inline_image_s:6.2f}s "
+              f"and took {inline_text_s:5.3f}s")
+        print(f"  background  image turn {background_image_s:6.2f}s, next text turn took {background_text_s:5.3f}s, "
+              f"images in after {ready_s:5.2f}s")
+        check(background_image_s < 0.5, "background image turn returns right away")
+
+        # Per-session cap: two jobs in flight, the third request is refused
+        first = engine.handle(session, "draw a red kite")
+        second = engine.handle(session, "draw a blue kite")
+        third = engine.handle(session, "draw a green kite")
+        check(first.get("pending") and second.get("pending") and "error" in third,
+              "third concurrent job was refused by the per-session cap")
+
+        # Stop the process while jobs are running, the next start reports them as interrupted
+        jobs.close()
+        restarted = JobQueue(job_path)
+        statuses = {restarted.get(m["job_id"])["status"] for m in (first, second)}
+        check(statuses.isdisjoint(ACTIVE_STATUSES),
+              f"no job is left looking active after a restart ({', '.join(sorted(statuses))})")
+        restarted.close()
+        writer.close()
+        engine.backends.close()
+    stub.stop()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""Message search latency over a large synthetic history.
+
+Usage:
+    python benchmarks/bench_message_search.py --messages 1000000
+    python benchmarks/bench_message_search.py --messages 10000000 --runs 20
+    python benchmarks/bench_message_search.py --messages 100000 --mongo mongodb://localhost:27017
+
+Generates chat messages from a Zipf-distributed vocabulary spread over
+sessions and a year of timestamps, indexes them in a SearchIndex and times
+one page of results for queries with a rare word, a common word, two and
+three words, and each filter (role, session, date range) plus a deep page.
+Results are first checked against a brute-force scan of a small corpus.
+With --mongo the messages are also stored in that server and the same
+queries go through its text index.
+Exits non-zero if any query type's p95 is 100 ms or more.
+"""
+import argparse
+import datetime
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+from bson import ObjectId
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from conversation_store import ensure_indexes, search_messages
+from search_index import SearchIndex, tokenize
+
+VOCABULARY = 50_000
+WORDS_PER_MESSAGE = (4, 30)
+SESSIONS = 100_000
+START = datetime.datetime(2025, 1, 1)
+YEAR_SECONDS = 365 * 24 * 3600
+
+
+def word(rank):
+    return f"w{rank}"
+
+
+def generate(count, seed=0, batch_size=50_000):
+    """Batches of message documents in timestamp order"""
+    rng = np.random.default_rng(seed)
+    offsets = np.sort(rng.uniform(0, YEAR_SECONDS, count))
+    for first in range(0, count, batch_size):
+        size = min(batch_size, count - first)
+        lengths = rng.integers(*WORDS_PER_MESSAGE, size=size)
+        ranks = np.minimum(rng.zipf(1.2, size=int(lengths.sum())), VOCABULARY)
+        sessions = rng.integers(0, SESSIONS, size=size)
+        batch, position = [], 0
+        for i in range(size):
+            words = ranks[position:position + lengths[i]]
+            position += lengths[i]
+            batch.append({
+                "_id": ObjectId(),
+                "session_id": f"session-{sessions[i]}",
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": " ".join(map(word, words)),
+                "timestamp": START + datetime.timedelta(seconds=float(offsets[first + i])),
+            })
+        yield batch
+
+
+def query_types(rng):
+    """(name, search kwargs) pairs, a few of each type"""
+    queries = []
+    for _ in range(3):
+        rare, common = int(rng.integers(2000, 20000)), int(rng.integers(1, 5))
+        mid = int(rng.integers(20, 200))
+        month = START + datetime.timedelta(days=int(rng.integers(0, 330)))
+        queries += [
+            ("rare word", {"query": word(rare)}),
+            ("common word", {"query": word(common)}),
+            ("two words", {"query": f"{word(common)} {word(mid)}"}),
+            ("three words", {"query": f"{word(common + 1)} {word(mid)} {word(mid + 7)}"}),
+            ("role filter", {"query": word(mid), "role": "assistant"}),
+            ("session filter", {"query": word(common), "session_id": f"session-{int(rng.integers(0, SESSIONS))}"}),
+            ("date range", {"query": word(common), "since": month, "until": month + datetime.timedelta(days=30)}),
+            ("deep page", {"query": word(common), "offset": 1000}),
+        ]
+    return queries
+
+
+def brute_force(documents, query, session_id=None, role=None, since=None, until=None, offset=0, limit=20):
+    terms = set(tokenize(query))
+    matches = [
+        doc for doc in documents
+        if terms <= set(tokenize(doc["content"]))
+        and (session_id is None or doc["session_id"] == session_id)
+        and (role is None or doc["role"] == role)
+        and (since is None or doc["timestamp"] >= since)
+        and (until is None or doc["timestamp"] < until)
+    ]
+    matches.sort(key=lambda doc: doc["timestamp"], reverse=True)
+    return [doc["_id"] for doc in matches[offset:offset + limit]], len(matches)
+
+
+def verify(rng):
+    """Compare the index with a scan of a small corpus, returns the mismatching queries"""
+    documents = [doc for batch in generate(20_000, seed=1) for doc in batch]
+    index = SearchIndex()
+    index.add(documents)
+    failures = []
+    for name, kwargs in query_types(rng):
+        kwargs = dict(kwargs, session_id=documents[7]["session_id"]) if "session_id" in kwargs else kwargs
+        if "offset" in kwargs:
+            kwargs = dict(kwargs, offset=20)
+        hits, total = index.search(**kwargs)
+        expected_ids, expected_total = brute_force(documents, **kwargs)
+        if total != expected_total or [hit["_id"] for hit in hits] != expected_ids:
+            failures.append(name)
+    return failures
+
+
+def time_queries(search, queries, runs):
+    times = {}
+    for _ in range(runs):
+        for name, kwargs in queries:
+            started = time.perf_counter()
+            search(**kwargs)
+            times.setdefault(name, []).append(time.perf_counter() - started)
+    return times
+
+
+def report(label, times, totals=None):
+    print(f"{label}:")
+    worst = 0.0
+    for name, samples in times.items():
+        samples = sorted(samples)
+        p95 = samples[min(len(samples) - 1, int(0.95 * len(samples)))] * 1000
+        worst = max(worst, p95)
+        matched = f", ~{totals[name]:,} matches" if totals else ""
+        print(f"  {name:<15} p50 {statistics.median(samples) * 1000:7.2f} ms  p95 {p95:7.2f} ms  "
+              f"max {samples[-1] * 1000:7.2f} ms{matched}")
+    return worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--runs", type=int, default=5, help="Times each query is repeated")
+    parser.add_argument("--mongo", help="Also store the messages in this MongoDB and time its text index")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(2)
+    failures = verify(rng)
+    print(f"[{'ok' if not failures else 'FAIL'}] index matches a brute-force scan"
+          + (f" (wrong: {', '.join(failures)})" if failures else ""))
+
+    collection = None
+    if args.mongo:
+        import pymongo
+        db = pymongo.MongoClient(args.mongo)[f"bench_search_{os.getpid()}"]
+        ensure_indexes(db)
+        collection = db.conversations
+
+    index = SearchIndex()
+    started = time.perf_counter()
+    for batch in generate(args.messages):
+        index.add(batch)
+        if collection is not None:
+            collection.insert_many(batch, ordered=False)
+    build_s = time.perf_counter() - started
+    print(f"Indexed {len(index):,} messages in {build_s:.1f}s ({len(index) / build_s:,.0f}/s)")
+
+    queries = query_types(rng)
+    totals = {name: index.search(**kwargs)[1] for name, kwargs in queries}
+    worst = report("Local index, one page of 20", time_queries(index.search, queries, args.runs), totals)
+
+    if collection is not None:
+        def mongo_search(query, offset=0, **filters):
+            return search_messages(collection, query, page=offset // 20, page_size=20, **filters)
+        worst = max(worst, report("MongoDB text index, one page of 20 with snippets",
+                                  time_queries(mongo_search, queries, args.runs)))
+        collection.database.client.drop_database(collection.database.name)
+
+    ok = not failures and worst < 100
+    print(f"[{'ok' if worst < 100 else 'FAIL'}] every query type p95 under 100 ms (worst {worst:.1f} ms)")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""Session isolation under load: 200 users, their own Gemini keys, a few noisy neighbours.
+
+Usage:
+    python benchmarks/bench_multi_tenant.py --users 200 --noisy 10 --duration 20
+
+All users share one ChatEngine, as Streamlit sessions do. Each has an API key
+(--users-per-key users share one) and Gemini calls go through the real SDK
+on top of fake_gemini.FakeGenerativeClient, which starts every reply with the
+key it was called with; Stability and Wikipedia are the stub_backends server.
+Polite users send a query every few seconds (mostly chat, some Wikipedia and
+images). Noisy users send 4-sample draft-and-refine image prompts and chat
+queries back to back.
+
+Three phases of --duration seconds each:
+  quiet      polite users only
+  noisy      with the noisy users, per-session rate limits and fair sharing
+  no limits  the same, with a single FIFO queue per backend and no rate
+             limits, i.e. the scheduling before per-session limits
+Every reply is checked for the right key, and the run fails if any reply
+came back under another session's key, if keys weren't one client each, or
+if the polite users' p99 in the noisy phase is more than --max-slowdown
+worse than in the quiet phase.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from backend_clients import DEFAULT_POLICIES, AsyncBackends, BackendPolicy, FairShare
+from chat_engine import ChatEngine
+from client_registry import ClientRegistry
+from fake_gemini import FakeGenerativeClient
+from image_store import ImageStore
+from metrics import Tracer, quantile
+from response_cache import ResponseCache
+from stub_backends import StubBackends
+
+TOPICS = ["pandas", "volcanoes", "black holes", "jazz", "photosynthesis", "chess", "bees", "glaciers"]
+SUBJECTS = ["a lighthouse at dusk", "a cat playing piano", "a city in the rain", "a forest cabin in snow"]
+POLITE_MIX = {"chat": 0.75, "wikipedia": 0.1, "image": 0.05, "time": 0.1}
+
+
+class _Fifo(FairShare):
+    """Every caller in one queue, first come first served"""
+
+    def slot(self, tenant):
+        return super().slot(None)
+
+
+class FifoBackends(AsyncBackends):
+    """No rate limits and a plain FIFO queue per backend"""
+
+    async def _admit(self, backend, tenant):
+        return
+
+    def _limit(self, backend):
+        if backend not in self._limits:
+            self._limits[backend] = _Fifo(self.policies[backend].concurrency)
+        return self._limits[backend]
+
+
+def query_for(flow, rng):
+    if flow == "chat":
+        return f"what do you think about {rng.choice(TOPICS)} and {rng.choice(TOPICS)}"
+    if flow == "wikipedia":
+        return f"tell me about {rng.choice(TOPICS)}"
+    if flow == "image":
+        # A fresh prompt each time, so images aren't served from the cache
+        return f"generate image of {rng.choice(SUBJECTS)} number {rng.randrange(10 ** 9)}"
+    return "what's the time"
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turns = {}
+        self.errors = {}
+        self.rate_limited = {}
+        self.leaks = 0
+        self.checked = 0
+
+    def record(self, kind, flow, seconds, message, api_key):
+        with self.lock:
+            self.turns.setdefault((kind, flow), []).append(seconds)
+            content = message.get("content", "")
+            if flow == "chat" and content.startswith("[KEY-"):
+                self.checked += 1
+                self.leaks += not content.startswith(f"[{api_key}]")
+            error = message.get("error") or (content if content.startswith("Sorry") else None)
+            if error and "Too many" in error:
+                self.rate_limited[kind] = self.rate_limited.get(kind, 0) + 1
+            elif error:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def latencies(self, kind, flows=None):
+        return sorted(seconds for (who, flow), times in self.turns.items()
+                      if who == kind and (flows is None or flow in flows) for seconds in times)
+
+
+class User(threading.Thread):
+    def __init__(self, index, engine, api_key, args, results, deadline, noisy=False):
+        super().__init__(name=f"user-{index}", daemon=True)
+        self.engine = engine
+        self.api_key = api_key
+        self.args = args
+        self.results = results
+        self.deadline = deadline
+        self.noisy = noisy
+        self.rng = random.Random(args.seed * 1000 + index)
+        self.session = engine.create_session()
+        self.session.use_memory = False
+        engine.configure_gemini(self.session, api_key)
+        engine.configure_image_generation(self.session, f"stub-{api_key}")
+        if noisy:
+            self.session.image_samples = 4
+            self.session.image_preset = "draft"
+            self.session.refine_drafts = True
+
+    def run(self):
+        flows, weights = zip(*POLITE_MIX.items())
+        # Spread the start over one think time, so the first queries don't all land together
+        time.sleep(self.rng.uniform(0, self.args.think_time))
+        turn = 0
+        while time.monotonic() < self.deadline:
+            if self.noisy:
+                flow = "image" if turn % 2 == 0 else "chat"
+            else:
+                flow = self.rng.choices(flows, weights)[0]
+            self.turn(flow, query_for(flow, self.rng))
+            turn += 1
+            time.sleep(self.args.noisy_interval if self.noisy else self.rng.uniform(0, 2 * self.args.think_time))
+
+    def turn(self, flow, query):
+        started = time.perf_counter()
+        intent = self.engine.route(self.session, query)
+        message = self.engine.handle(self.session, query, intent=intent,
+                                     on_chunk=(lambda chunk: None) if intent is None else None)
+        self.results.record("noisy" if self.noisy else "polite", flow, time.perf_counter() - started,
+                            message, self.api_key)
+
+
+def run_phase(name, args, stub, noisy, backends):
+    factory_settings = dict(latency=args.gemini_latency, chunks=8, chunk_interval=0.02, reply_words=40)
+    created = []
+
+    def factory(api_key):
+        created.append(api_key)
+        return FakeGenerativeClient(api_key, seed=len(created), **factory_settings)
+
+    workdir = tempfile.mkdtemp(prefix="bench-tenant-")
+    engine = ChatEngine(
+        response_cache=ResponseCache(max_entries=4096),
+        image_store=ImageStore(os.path.join(workdir, "images")),
+        backends=backends,
+        clients=ClientRegistry(backends, factory=factory),
+        stability_url=stub.stability_url,
+        wikipedia_url=stub.wikipedia_url,
+        tracer=Tracer(),
+    )
+    results = Results()
+    count = args.users + (args.noisy if noisy else 0)
+    keys = [f"KEY-{index // args.users_per_key:04d}" for index in range(count)]
+    deadline = time.monotonic() + args.duration
+    users = [User(i, engine, keys[i], args, results, deadline, noisy=i >= args.users) for i in range(count)]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    engine.backends.close()
+
+    polite = results.latencies("polite")
+    summary = {
+        "name": name,
+        "polite_turns": len(polite),
+        "polite_p50": quantile(polite, 0.5),
+        "polite_p95": quantile(polite, 0.95),
+        "polite_p99": quantile(polite, 0.99),
+        "chat_p99": quantile(results.latencies("polite", {"chat"}), 0.99),
+        "image_p99": quantile(results.latencies("polite", {"image"}), 0.99),
+        "noisy_turns": len(results.latencies("noisy")),
+        "rate_limited": results.rate_limited,
+        "errors": results.errors,
+        "leaks": results.leaks,
+        "checked": results.checked,
+        "clients_ok": sorted(created) == sorted(set(keys)),
+    }
+    print(f"  {name:<10} {summary['polite_turns']:>6} {summary['polite_p50'] * 1000:>7.0f} ms "
+          f"{summary['polite_p95'] * 1000:>7.0f} ms {summary['polite_p99'] * 1000:>7.0f} ms "
+          f"{summary['chat_p99'] * 1000:>7.0f} ms {summary['image_p99'] * 1000:>7.0f} ms "
+          f"{summary['noisy_turns']:>6}  limited {sum(results.rate_limited.values()):>5}  "
+          f"leaks {results.leaks}/{results.checked}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200, help="Polite users")
+    parser.add_argument("--noisy", type=int, default=10, help="Users sending requests back to back")
+    parser.add_argument("--users-per-key", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=20, help="Seconds per phase")
+    parser.add_argument("--think-time", type=float, default=3.0, help="Mean pause between a polite user's queries")
+    parser.add_argument("--noisy-interval", type=float, default=0.05)
+    parser.add_argument("--gemini-latency", type=float, default=0.3)
+    parser.add_argument("--gemini-concurrency", type=int, default=32)
+    parser.add_argument("--backend-latency", type=float, default=0.15, help="Stub Wikipedia and Stability latency")
+    parser.add_argument("--step-latency", type=float, default=0.01, help="Extra stub image seconds per step")
+    parser.add_argument("--max-slowdown", type=float, default=0.5, help="Allowed p99 growth from quiet to noisy")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    stub = StubBackends(latency=args.backend_latency, step_latency=args.step_latency)
+    stub.start()
+    gemini = vars(DEFAULT_POLICIES["gemini"])
+    policies = {"gemini": BackendPolicy(**dict(gemini, concurrency=args.gemini_concurrency))}
+    print(f"{args.users} polite users ({args.users_per_key} per key), {args.noisy} noisy, {args.duration:.0f}s "
+          f"per phase, Gemini {args.gemini_latency}s x {args.gemini_concurrency}, backends {args.backend_latency}s")
+    print(f"  {'phase':<10} {'turns':>6} {'p50':>10} {'p95':>10} {'p99':>10} {'chat p99':>10} {'image p99':>10} "
+          f"{'noisy':>6}")
+    quiet = run_phase("quiet", args, stub, False, AsyncBackends(policies))
+    noisy = run_phase("noisy", args, stub, True, AsyncBackends(policies))
+    run_phase("no limits", args, stub, True, FifoBackends(policies))
+    stub.stop()
+
+    leaks = quiet["leaks"] + noisy["leaks"]
+    checked = quiet["checked"] + noisy["checked"]
+    bound = quiet["polite_p99"] * (1 + args.max_slowdown)
+    checks = [
+        (leaks == 0, f"every reply came back under its own session's key ({checked} checked)"),
+        (quiet["clients_ok"] and noisy["clients_ok"], "one Gemini client per key, shared by the sessions using it"),
+        (noisy["polite_p99"] <= bound, f"polite p99 with noisy neighbours {noisy['polite_p99'] * 1000:.0f} ms "
+                                       f"<= {bound * 1000:.0f} ms"),
+        (not quiet["errors"] and not noisy["errors"].get("polite") and not noisy["rate_limited"].get("polite"),
+         "no polite turn failed or was rate limited"),
+    ]
+    for ok, label in checks:
+        print(f"[{'ok' if ok else 'FAIL'}] {label}")
+    sys.exit(0 if all(ok for ok, _ in checks) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Wall time of a Streamlit rerun of genai_chatbot.py at 10, 100 and 1000 messages.
+
+Usage:
+    python benchmarks/bench_rerun.py --runs 5
+
+Every interaction re-executes the script, so this is the floor on how fast
+the UI can react. The app runs in Streamlit's AppTest harness (no browser,
+no backends); the conversation is filled with alternating user and assistant
+messages, every tenth with a generated image. For each size it reports the
+median full rerun with the default render window and with every message
+rendered, plus the time spent in each fragment: clicks inside a fragment
+(🔊, show earlier, cancel) rerun only that fragment, not the whole script.
+
+Pass --script to time another version of the app, e.g. one checked out from
+an earlier commit.
+"""
+import argparse
+import functools
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+# Keep the app's caches and stores out of the working tree
+WORKDIR = tempfile.mkdtemp(prefix="bench-rerun-")
+os.environ.update(
+    IMAGE_STORE_DIR=os.path.join(WORKDIR, "images"),
+    JOB_DB_PATH="",
+    RESPONSE_CACHE_PATH="",
+    MEMORY_INDEX_DIR="",
+    TTS_CACHE_DIR="",
+)
+
+import streamlit as st
+from PIL import Image
+from streamlit.testing.v1 import AppTest
+
+from image_store import ImageStore
+
+fragment_times = {}
+_fragment = st.fragment
+
+
+def timed_fragment(func=None, **kwargs):
+    """st.fragment that also records how long each run of the fragment takes"""
+    def decorate(func):
+        @functools.wraps(func)
+        def timed(*args, **kw):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kw)
+            finally:
+                fragment_times.setdefault(func.__name__, []).append(time.perf_counter() - started)
+        return _fragment(timed, **kwargs)
+    return decorate(func) if func is not None else decorate
+
+
+st.fragment = timed_fragment
+
+
+def fill_conversation(conversation, count, image_ref):
+    for i in range(count):
+        message = {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"Message {i}: " + "a few words of an ordinary chat message " * 4,
+        }
+        if i % 10 == 1:
+            message["image_ref"] = image_ref
+        conversation.append(message)
+
+
+def median_ms(values):
+    return statistics.median(values) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--script", default=os.path.join(ROOT, "genai_chatbot.py"))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (1024, 1024), (40, 90, 160)).save(buffer, format="PNG")
+    image_ref = ImageStore(os.environ["IMAGE_STORE_DIR"]).put(buffer.getvalue())
+
+    print(f"{'messages':>8}  {'rendered':>8}  {'rerun p50':>10}  fragments p50")
+    for size in args.sizes:
+        at = AppTest.from_file(os.path.abspath(args.script), default_timeout=300)
+        at.run()
+        fill_conversation(at.session_state["chat_session"].conversation, size, image_ref)
+        for window in sorted({min(size, 30), size}):
+            at.session_state["render_window"] = window
+            at.run()
+            fragment_times.clear()
+            reruns = []
+            for _ in range(args.runs):
+                started = time.perf_counter()
+                at.run()
+                reruns.append(time.perf_counter() - started)
+            if at.exception:
+                raise SystemExit(f"App raised: {at.exception[0].value}")
+            fragments = ", ".join(f"{name} {median_ms(times):.1f} ms" for name, times in sorted(fragment_times.items()))
+            print(f"{size:>8}  {window:>8}  {median_ms(reruns):>7.1f} ms  {fragments or '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""Speech input latency: VAD pipeline vs the old listen/recognize_google flow.
+
+Usage:
+    python benchmarks/bench_speech_input.py --utterances 5
+
+Generates WAV fixtures where every word is a short tone over background noise
+and replays them at real-time speed. An offline recognizer decodes the tones
+back to words and sleeps like a network recognizer would (fixed round trip
+plus time proportional to the audio). Both flows use the same recognizer:
+  * old: adjust_for_ambient_noise + listen(pause_threshold=1) + one
+    recognition of the whole phrase, as listen_for_command did
+  * new: SpeechInputService with a cached noise floor, VAD endpointing and
+    segments recognized while the phrase is still being spoken
+Reports time from the end of speech to text and from the button press to
+text, and checks that both flows return the spoken words.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import speech_recognition as sr
+
+from speech_input import SAMPLE_RATE, SpeechInputService, SegmentedRecognizer, WavSource, write_wav
+
+WORDS = "open youtube tell me about pandas what is the time generate image of a sunset over mountains draw cat".split()
+WORD_SECONDS = 0.35
+GAP_SECONDS = 0.12
+PAUSE_SECONDS = 0.45
+LEAD_SECONDS = 1.5
+TAIL_SECONDS = 2.0
+
+
+def word_frequency(word):
+    return 300 + 60 * WORDS.index(word)
+
+
+def make_fixture(words, rng, pause_after=3):
+    """PCM for the phrase and the offset (seconds) where speech ends"""
+    def noise(seconds):
+        return rng.normal(0, 80, int(seconds * SAMPLE_RATE))
+
+    chunks = [noise(LEAD_SECONDS)]
+    for i, word in enumerate(words):
+        t = np.arange(int(WORD_SECONDS * SAMPLE_RATE)) / SAMPLE_RATE
+        tone = 4000 * np.sin(2 * np.pi * word_frequency(word) * t) * np.hanning(len(t)) ** 0.2
+        chunks.append(tone + noise(WORD_SECONDS))
+        chunks.append(noise(PAUSE_SECONDS if i + 1 == pause_after else GAP_SECONDS))
+    speech_end = sum(len(c) for c in chunks[:-1]) / SAMPLE_RATE
+    chunks[-1] = noise(TAIL_SECONDS)
+    samples = np.clip(np.concatenate(chunks), -32768, 32767).astype(np.int16)
+    return samples.tobytes(), speech_end
+
+
+def tone_recognizer(round_trip=0.25, per_second=0.1):
+    """Decodes each tone burst to its word, paced like a network recognizer"""
+    def recognize(audio):
+        samples = np.frombuffer(audio.get_raw_data(), dtype=np.int16).astype(np.float32)
+        time.sleep(round_trip + per_second * len(samples) / audio.sample_rate)
+        frame = audio.sample_rate // 100
+        energy = np.sqrt(np.mean(samples[:len(samples) // frame * frame].reshape(-1, frame) ** 2, axis=1))
+        voiced = energy > 1000
+        words = []
+        start = None
+        for i, v in enumerate(np.append(voiced, False)):
+            if v and start is None:
+                start = i
+            elif not v and start is not None:
+                burst = samples[start * frame:i * frame]
+                if len(burst) >= frame * 5:
+                    peak = np.argmax(np.abs(np.fft.rfft(burst))) * audio.sample_rate / len(burst)
+                    words.append(WORDS[int(round((peak - 300) / 60))])
+                start = None
+        if not words:
+            raise sr.UnknownValueError()
+        return " ".join(words)
+    return recognize
+
+
+class RealtimeAudioFile(sr.AudioSource):
+    """WAV file paced like a microphone, for the old speech_recognition flow"""
+
+    def __init__(self, path):
+        self.source = WavSource(path, realtime=True)
+        self.SAMPLE_RATE = self.source.sample_rate
+        self.SAMPLE_WIDTH = 2
+        self.CHUNK = self.source.frame_samples
+        self.stream = self
+
+    def read(self, size):
+        return self.source.read()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.source.close()
+
+
+def old_flow(path, recognize):
+    pressed = time.perf_counter()
+    r = sr.Recognizer()
+    with RealtimeAudioFile(path) as source:
+        r.pause_threshold = 1
+        r.adjust_for_ambient_noise(source)
+        audio = r.listen(source, timeout=5, phrase_time_limit=5)
+    return recognize(audio), pressed, time.perf_counter()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--utterances", type=int, default=5)
+    parser.add_argument("--wav-dir", help="Keep the generated WAV fixtures here")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    pick = random.Random(0)
+    wav_dir = args.wav_dir or tempfile.mkdtemp(prefix="speech-fixtures-")
+    os.makedirs(wav_dir, exist_ok=True)
+    fixtures = []
+    for i in range(args.utterances):
+        words = [pick.choice(WORDS) for _ in range(pick.randint(4, 7))]
+        pcm, speech_end = make_fixture(words, rng)
+        path = os.path.join(wav_dir, f"utterance_{i}.wav")
+        write_wav(path, pcm)
+        fixtures.append((path, " ".join(words), speech_end))
+
+    recognize = tone_recognizer()
+    opened = []
+    paths = iter([path for path, _, _ in fixtures])
+
+    def open_source():
+        opened.append(time.perf_counter())
+        return WavSource(next(paths), realtime=True)
+
+    service = SpeechInputService(open_source=open_source, recognizer=SegmentedRecognizer(recognize, min_segment=1.0))
+
+    failures = 0
+    results = {"old": [], "new": []}
+    for i, (path, expected, speech_end) in enumerate(fixtures):
+        text, pressed, done = old_flow(path, recognize)
+        results["old"].append((done - (pressed + speech_end), done - pressed))
+        failures += text != expected
+
+        utterance = service.listen()
+        done = utterance.recognized_at
+        results["new"].append((done - (opened[-1] + speech_end), done - utterance.started_at))
+        failures += utterance.text != expected
+        print(f"  {expected!r}: old {results['old'][-1][0] * 1000:5.0f} ms, new {results['new'][-1][0] * 1000:5.0f} ms "
+              f"after speech ended")
+
+    for name, rows in results.items():
+        after_speech = np.array([r[0] for r in rows]) * 1000
+        after_press = np.array([r[1] for r in rows]) * 1000
+        print(f"{name}: end of speech -> text p50 {np.median(after_speech):6.0f} ms, max {after_speech.max():6.0f} ms; "
+              f"press -> text p50 {np.median(after_press):6.0f} ms")
+    print(f"Noise floor {service.noise_floor:.0f} RMS, {failures} transcription mismatches")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
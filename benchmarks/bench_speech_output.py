@@ -0,0 +1,120 @@
+"""Speech output: sentence pipeline vs speaking one sentence at a time.
+
+Usage:
+    python benchmarks/bench_speech_output.py --replies 5
+
+Uses a fake TTS engine (synthesis takes a fixed cost plus time per character,
+audio lasts about 65 ms per character) and FakeAudioSink, which plays at
+real-time pace. For each reply it measures:
+  * time to the first audio
+  * silence between sentences (old: every sentence is synthesized after the
+    previous one finished playing; new: the next chunk is rendered ahead)
+  * how long Stop takes to silence the output when pressed mid-sentence
+Exits non-zero if the pipeline stops slower than 50 ms.
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from speech_engine import AudioClip
+from speech_output import FakeAudioSink, SpeechPipeline
+
+SAMPLE_RATE = 22050
+REPLY = ("Pandas is a Python library for data analysis. It offers two main structures, the Series and the "
+         "DataFrame, which hold labelled one and two dimensional data. You can read CSV files, Excel sheets and SQL "
+         "tables into a DataFrame with a single call. Grouping, joining and reshaping are built in. Would you like "
+         "an example?")
+
+
+class FakeSpeechService:
+    """Synthesis cost and audio length proportional to the text"""
+
+    def __init__(self, fixed=0.08, per_char=0.002, audio_per_char=0.065):
+        self.fixed = fixed
+        self.per_char = per_char
+        self.audio_per_char = audio_per_char
+
+    def synthesize(self, text, **settings):
+        time.sleep(self.fixed + self.per_char * len(text))
+        samples = int(SAMPLE_RATE * self.audio_per_char * len(text))
+        return AudioClip(np.zeros(samples, dtype=np.int16).tobytes(), SAMPLE_RATE)
+
+    def say(self, text, **settings):
+        """Synthesize and play in one blocking call, like engine.say + runAndWait"""
+        clip = self.synthesize(text)
+        time.sleep(clip.seconds)
+
+
+def old_reply(service, text, stop_at):
+    """The old speak_worker loop: one blocking say() per sentence, Stop checked in between"""
+    stop = threading.Event()
+    threading.Timer(stop_at, stop.set).start()
+    started = time.perf_counter()
+    sentences = text.replace('. ', '.|').replace('? ', '?|').replace('! ', '!|').split('|')
+    gaps = []
+    for sentence in sentences:
+        if stop.is_set():
+            break
+        service.say(sentence)
+        gaps.append(service.fixed + service.per_char * len(sentence))
+    silenced_at = time.perf_counter()
+    return gaps[1:], silenced_at - (started + stop_at)
+
+
+def new_reply(service, text, stop_at):
+    sink = FakeAudioSink()
+    pipeline = SpeechPipeline(service, sink)
+    started = time.perf_counter()
+    threading.Timer(stop_at, pipeline.stop).start()
+    pipeline.speak(text)
+    while time.perf_counter() - started < stop_at or pipeline.speaking:
+        time.sleep(0.005)
+    pipeline.close()
+    gaps = [m["gap_ms"] / 1000 for m in pipeline.metrics if m.get("gap_ms") is not None]
+    return gaps, (pipeline.last_stop_ms or 0) / 1000, pipeline.metrics[0]["latency_ms"] / 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--replies", type=int, default=5)
+    args = parser.parse_args()
+
+    service = FakeSpeechService()
+    rng = random.Random(0)
+    old_gaps, old_stops, new_gaps, new_stops, first_audio = [], [], [], [], []
+    for i in range(args.replies):
+        # Stop somewhere in the middle of the reply
+        stop_at = rng.uniform(6.0, 12.0)
+        gaps, stop_latency = old_reply(service, REPLY, stop_at)
+        old_gaps += gaps
+        old_stops.append(stop_latency)
+        gaps, stop_latency, first = new_reply(service, REPLY, stop_at)
+        new_gaps += gaps
+        new_stops.append(stop_latency)
+        first_audio.append(first)
+        print(f"  reply {i}: stop at {stop_at:4.1f}s, old stopped after {old_stops[-1] * 1000:5.0f} ms, "
+              f"new after {new_stops[-1] * 1000:4.1f} ms")
+
+    ms = lambda values, q: np.percentile(np.array(values) * 1000, q) if values else 0.0
+    old_first = service.fixed + service.per_char * len(REPLY.split(". ")[0])
+    print(f"First audio:            old p50 {old_first * 1000:5.0f} ms, "
+          f"new p50 {ms(first_audio, 50):5.1f} ms")
+    print(f"Silence between chunks: old p50 {ms(old_gaps, 50):5.0f} ms, new p50 {ms(new_gaps, 50):5.1f} ms "
+          f"(p95 {ms(new_gaps, 95):5.1f} ms)")
+    print(f"Stop latency:           old p50 {ms(old_stops, 50):5.0f} ms (max {ms(old_stops, 100):5.0f}), "
+          f"new p50 {ms(new_stops, 50):5.1f} ms (max {ms(new_stops, 100):5.1f})")
+    ok = max(new_stops) < 0.05
+    print(f"[{'ok' if ok else 'FAIL'}] pipeline stops within 50 ms")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Cost of per-stage tracing, per span and per chat turn.
+
+Usage:
+    python benchmarks/bench_tracing.py --turns 200 --latency 0.02
+
+Times a span with tracing enabled, disabled and writing JSON log lines, then
+drives ChatEngine with a fake Gemini chat that answers after --latency
+seconds, once with the tracer on and once with it off. Direct timing of whole
+turns is noisier than the difference being measured, so the overhead is also
+estimated as spans per turn times the cost of a span. Exits non-zero if that
+estimate is 1% of a turn or more, or if the measured difference in p50 is
+more than --tolerance above the estimate, which means turns got slower for a
+reason the estimate doesn't cover.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from backend_clients import AsyncBackends
+from chat_engine import ChatEngine
+from metrics import Tracer, enable_json_logs, logger
+
+
+class Reply:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeChat:
+    """Answers every message after a fixed delay, streamed in a few chunks"""
+
+    history = []
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.last = None
+
+    async def send_message_async(self, query, stream=False):
+        await asyncio.sleep(self.latency)
+        self.last = Reply(f"Here is an answer to {query}.")
+        if not stream:
+            return self.last
+        return self._stream()
+
+    async def _stream(self):
+        for word in self.last.text.split():
+            yield Reply(word + " ")
+
+
+def per_span_us(tracer, count):
+    started = time.perf_counter()
+    for i in range(count):
+        with tracer.span("bench", "session-1", index=i):
+            pass
+    return (time.perf_counter() - started) / count * 1e6
+
+
+def run_turns(tracers, turns, latency, stream):
+    """Turn times per tracer, alternating between them so drift affects both alike"""
+    # No per-session rate limits, the turns come back to back
+    engines = [ChatEngine(tracer=tracer, backends=AsyncBackends(rate_limits=False)) for tracer in tracers]
+    sessions = [engine.create_session() for engine in engines]
+    for session in sessions:
+        session.convo = FakeChat(latency)
+    times = [[] for _ in tracers]
+    for i in range(turns):
+        for engine, session, samples in zip(engines, sessions, times):
+            started = time.perf_counter()
+            engine.handle(session, f"question number {i}", on_chunk=(lambda chunk: None) if stream else None)
+            samples.append(time.perf_counter() - started)
+    for engine in engines:
+        engine.backends.close()
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.02, help="Fake Gemini reply time in seconds")
+    parser.add_argument("--spans", type=int, default=100_000)
+    parser.add_argument("--tolerance", type=float, default=0.05,
+                        help="Allowed excess of the measured over the estimated overhead, for timing noise")
+    args = parser.parse_args()
+
+    enabled_us = per_span_us(Tracer(), args.spans)
+    disabled_us = per_span_us(Tracer(enabled=False), args.spans)
+    with tempfile.TemporaryDirectory() as workdir:
+        handler = enable_json_logs(os.path.join(workdir, "spans.jsonl"))
+        logged_us = per_span_us(Tracer(), args.spans)
+        logger.removeHandler(handler)
+        logger.setLevel(logging.NOTSET)
+        handler.close()
+    print(f"Per span: enabled {enabled_us:.1f} us, disabled {disabled_us:.1f} us, "
+          f"with JSON log {logged_us:.1f} us")
+
+    worst = 0.0
+    worst_excess = 0.0
+    print(f"\n{args.turns} turns, fake Gemini latency {args.latency * 1000:.0f} ms:")
+    for stream in (False, True):
+        tracer = Tracer()
+        traced, untraced = run_turns([tracer, Tracer(enabled=False)], args.turns, args.latency, stream)
+        spans_per_turn = sum(stage["count"] for stage in tracer.stats().values()) / args.turns
+        traced_ms = statistics.median(traced) * 1000
+        untraced_ms = statistics.median(untraced) * 1000
+        estimate = spans_per_turn * logged_us / 1000 / untraced_ms
+        measured = traced_ms / untraced_ms - 1
+        worst = max(worst, estimate)
+        worst_excess = max(worst_excess, measured - estimate)
+        print(f"  {'streamed' if stream else 'blocking':>8}  traced p50 {traced_ms:6.2f} ms, untraced p50 "
+              f"{untraced_ms:6.2f} ms (measured {measured:+.2%}), "
+              f"{spans_per_turn:.0f} spans/turn, estimated overhead {estimate:.3%} with JSON log")
+        for stage, values in tracer.stats().items():
+            print(f"      {stage:<14} p50 {values['p50_ms']:7.2f} ms  p95 {values['p95_ms']:7.2f} ms  "
+                  f"p99 {values['p99_ms']:7.2f} ms")
+
+    checks = [
+        (worst < 0.01, f"estimated tracing overhead below 1% of a turn ({worst:.3%})"),
+        (worst_excess <= args.tolerance, f"measured overhead within {args.tolerance:.0%} of the estimate "
+                                         f"({worst_excess:+.2%} over)"),
+    ]
+    print()
+    for ok, label in checks:
+        print(f"[{'ok' if ok else 'FAIL'}] {label}")
+    sys.exit(0 if all(ok for ok, _ in checks) else 1)
+
+
+if __name__ == "__main__":
+    main()
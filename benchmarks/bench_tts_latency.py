@@ -0,0 +1,82 @@
+"""Utterance start latency: per-request pyttsx3.init() vs the shared speech service.
+
+Usage:
+    python benchmarks/bench_tts_latency.py --runs 20
+
+Start latency is measured from the moment a request is made until the driver
+fires its 'started-utterance' callback.
+"""
+import argparse
+import gc
+import os
+import statistics
+import sys
+import time
+
+import pyttsx3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from speech_engine import SpeechEngineService
+
+
+def per_request_latency(text, rate, volume):
+    """Mirror the old speak_worker: a fresh engine with voice setup for every utterance"""
+    started = {}
+    requested_at = time.perf_counter()
+    engine = pyttsx3.init()
+    voices = engine.getProperty('voices')
+    if len(voices) > 1:
+        engine.setProperty('voice', voices[1].id)
+    engine.setProperty('rate', rate)
+    engine.setProperty('volume', volume)
+    engine.connect('started-utterance', lambda name: started.setdefault('at', time.perf_counter()))
+    engine.say(text)
+    engine.runAndWait()
+    engine.stop()
+    del engine
+    gc.collect()
+    return started['at'] - requested_at
+
+
+def service_latency(service, text, rate, volume):
+    voices = service.voices
+    voice = voices[1].id if len(voices) > 1 else None
+    request = service.say(text, voice=voice, rate=rate, volume=volume)
+    if request.error:
+        raise request.error
+    return request.start_latency
+
+
+def summarize(label, samples):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{label:<22} median {statistics.median(samples) * 1000:8.1f} ms   "
+          f"p95 {p95 * 1000:8.1f} ms   max {samples[-1] * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--text", default="Benchmark.")
+    parser.add_argument("--rate", type=int, default=250)
+    parser.add_argument("--volume", type=float, default=0.0)
+    args = parser.parse_args()
+
+    per_request = [per_request_latency(args.text, args.rate, args.volume) for _ in range(args.runs)]
+
+    service = SpeechEngineService()
+    if not service.available:
+        sys.exit(f"Speech engine unavailable: {service.error}")
+    # First request pays for nothing the later ones don't, but warm the driver anyway
+    service_latency(service, args.text, args.rate, args.volume)
+    pooled = [service_latency(service, args.text, args.rate, args.volume) for _ in range(args.runs)]
+    service.shutdown()
+
+    print(f"Utterance start latency over {args.runs} runs")
+    summarize("per-request init", per_request)
+    summarize("shared service", pooled)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Local stand-in for a Gemini chat, for benchmarks and load tests.
+
+FakeGeminiModel has the parts of genai.GenerativeModel the engine uses:
+start_chat() and generate_content_async() (context summaries).
+FakeGeminiChat answers send_message_async after a configurable delay, either
+whole or streamed in chunks a fixed interval apart, and keeps the history the
+engine assigns to it. Point a session at it with attach(session, ...).
+FakeGenerativeClient sits one level lower, under the real SDK, for tests of
+the per-key clients in client_registry.
+"""
+import asyncio
+import random
+
+
+class Reply:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGeminiChat:
+    """Answers after latency seconds, streams reply_words words in chunks"""
+
+    def __init__(self, latency=0.3, chunks=8, chunk_interval=0.02, reply_words=60, jitter=0.2, seed=None):
+        self.latency = latency
+        self.chunks = chunks
+        self.chunk_interval = chunk_interval
+        self.reply_words = reply_words
+        # Latency varies by up to this share either way, so tails aren't flat
+        self.jitter = jitter
+        self.history = []
+        self.last = None
+        self.calls = 0
+        self._random = random.Random(seed)
+
+    def _delay(self):
+        return self.latency * (1 + self._random.uniform(-self.jitter, self.jitter))
+
+    def _reply(self, query):
+        words = [f"word{i}" for i in range(self.reply_words)]
+        # Sentence breaks so streamed replies can be spoken sentence by sentence
+        for i in range(9, len(words), 10):
+            words[i] += "."
+        return f"About {query}: " + " ".join(words)
+
+    async def send_message_async(self, query, stream=False):
+        self.calls += 1
+        await asyncio.sleep(self._delay())
+        self.last = Reply(self._reply(query))
+        if not stream:
+            return self.last
+        return self._stream(self.last.text)
+
+    async def _stream(self, text):
+        words = text.split(" ")
+        size = max(1, -(-len(words) // self.chunks))
+        for start in range(0, len(words), size):
+            if start:
+                await asyncio.sleep(self.chunk_interval)
+            yield Reply(" ".join(words[start:start + size]) + " ")
+
+
+class FakeGeminiModel:
+    """start_chat() hands out FakeGeminiChats, summaries take summary_latency seconds"""
+
+    def __init__(self, summary_latency=0.5, **chat_settings):
+        self.summary_latency = summary_latency
+        self.chat_settings = chat_settings
+
+    def start_chat(self):
+        return FakeGeminiChat(**self.chat_settings)
+
+    async def generate_content_async(self, prompt):
+        await asyncio.sleep(self.summary_latency)
+        return Reply("Summary of the earlier conversation.")
+
+
+def attach(session, **settings):
+    """Use a fake Gemini chat for the session, as configure_gemini would a real one"""
+    session.model = FakeGeminiModel(**settings)
+    session.convo = session.model.start_chat()
+    return session.convo
+
+
+class FakeGenerativeClient:
+    """Stands in for the SDK's async GenerativeService client of one API key.
+
+    A real GenerativeModel and ChatSession run on top of it, so the whole SDK
+    path is exercised. Every reply starts with [api_key], which tells a test
+    which key a request actually went out under.
+    """
+
+    def __init__(self, api_key, latency=0.3, chunks=8, chunk_interval=0.02, reply_words=60, jitter=0.2, seed=None):
+        self.api_key = api_key
+        self.chat = FakeGeminiChat(latency, chunks, chunk_interval, reply_words, jitter, seed)
+
+    def _response(self, text, last=True):
+        from google.generativeai import protos
+
+        reasons = protos.Candidate.FinishReason
+        candidate = protos.Candidate(
+            index=0,
+            content=protos.Content(role="model", parts=[protos.Part(text=text)]),
+            finish_reason=reasons.STOP if last else reasons.FINISH_REASON_UNSPECIFIED,
+        )
+        return protos.GenerateContentResponse(candidates=[candidate])
+
+    def _text(self, request):
+        query = request.contents[-1].parts[0].text if request.contents else ""
+        return f"[{self.api_key}] " + self.chat._reply(query)
+
+    async def generate_content(self, request, **options):
+        self.chat.calls += 1
+        await asyncio.sleep(self.chat._delay())
+        return self._response(self._text(request))
+
+    async def stream_generate_content(self, request, **options):
+        self.chat.calls += 1
+        await asyncio.sleep(self.chat._delay())
+        return self._stream(self._text(request))
+
+    async def _stream(self, text):
+        pieces = [reply.text async for reply in self.chat._stream(text)]
+        for position, piece in enumerate(pieces):
+            yield self._response(piece, last=position == len(pieces) - 1)
@@ -0,0 +1,476 @@
+"""Offline load test: N simulated users against one ChatEngine, no live services.
+
+Usage:
+    python benchmarks/load_test.py --users 50 --turns 10
+    python benchmarks/load_test.py --users 50 --compare benchmarks/results/load_test-20261018-093000.json
+
+Everything the app talks to is replaced by a local stand-in:
+  * Gemini: fake_gemini.FakeGeminiChat, with --gemini-latency and streamed chunks
+  * Stability and Wikipedia: the stub_backends HTTP server
+  * MongoDB: mongomock, or a real server with --mongo mongodb://localhost:27017
+  * Google speech: WAV fixtures of tone "words" spoken into an always-on fake
+    microphone in real time, decoded by the offline recognizer of
+    bench_speech_input.py
+Each user runs in its own thread with its own ChatSession on one shared engine
+(as Streamlit sessions do) and sends --turns queries with a random think time
+in between. A turn does what handle_command does: route the query, stream
+general questions, and hand image requests to the background job queue.
+Voice users first listen to a fixture and then send what was recognized.
+
+Reports throughput, latency percentiles per flow (chat, wikipedia, image,
+time, voice), time to first chunk of streamed replies, image job completion
+time, per-stage percentiles from the tracer and memory per session, and
+writes them as JSON (benchmarks/results/ by default). With --compare, the
+previous run's numbers are shown next to this run's, and the exit status is
+non-zero when throughput or a flow's p95 got worse by more than
+--max-regression.
+"""
+import argparse
+import collections
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import mongomock
+import numpy as np
+import pymongo
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+from backend_clients import AsyncBackends
+from bench_speech_input import make_fixture, tone_recognizer
+from chat_engine import ChatEngine
+from conversation_store import ConversationWriter, ensure_indexes
+from fake_gemini import attach
+from image_store import ImageStore
+from job_queue import JobQueue
+from metrics import Tracer, quantile
+from response_cache import ResponseCache
+from speech_input import SAMPLE_RATE, SegmentedRecognizer, SpeechInputService, WavSource, write_wav
+from stub_backends import StubBackends
+
+RESULTS_DIR = os.path.join(HERE, "results")
+TOPICS = ["pandas", "volcanoes", "the roman empire", "black holes", "jazz", "photosynthesis", "chess", "the moon",
+          "bees", "glaciers", "the printing press", "octopuses", "rainbows", "tea", "the internet", "dinosaurs"]
+SUBJECTS = ["a lighthouse at dusk", "a cat playing piano", "a sunset over mountains", "a red kite over a beach",
+            "a city in the rain", "a forest cabin in snow", "a robot reading a book", "a harbour at dawn"]
+# Phrases the tone fixtures can spell, every word must be in bench_speech_input.WORDS
+VOICE_PHRASES = ["what is the time", "tell me about pandas", "draw cat", "open youtube",
+                 "generate image of a sunset over mountains"]
+FLOWS = ("chat", "wikipedia", "image", "time")
+
+
+def parse_mix(text):
+    """"chat=0.6,wikipedia=0.2,..." -> {flow: weight}"""
+    mix = {}
+    for part in text.split(","):
+        flow, _, weight = part.partition("=")
+        if flow.strip() not in FLOWS:
+            raise argparse.ArgumentTypeError(f"Unknown flow {flow!r}, expected one of {', '.join(FLOWS)}")
+        mix[flow.strip()] = float(weight)
+    return mix
+
+
+def query_for(flow, rng):
+    if flow == "chat":
+        return f"explain {rng.choice(TOPICS)} to me like I am {rng.randint(5, 80)}"
+    if flow == "wikipedia":
+        return f"wikipedia {rng.choice(TOPICS)}"
+    if flow == "image":
+        return f"draw {rng.choice(SUBJECTS)}"
+    return "what's the time"
+
+
+def summarize(values_s):
+    """count and p50/p95/p99/max in ms of a list of seconds"""
+    values = sorted(values_s)
+    if not values:
+        return {"count": 0}
+    summary = {"count": len(values)}
+    for q in (0.5, 0.95, 0.99):
+        summary[f"p{int(q * 100)}_ms"] = round(quantile(values, q) * 1000, 1)
+    summary["max_ms"] = round(values[-1] * 1000, 1)
+    return summary
+
+
+def current_rss():
+    """Resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        # Peak rather than current, but the best available off Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def deep_size(obj, seen):
+    """Bytes held by obj and everything it references that hasn't been counted yet"""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__") and not isinstance(obj, type):
+        size += deep_size(vars(obj), seen)
+    return size
+
+
+def session_state_size(session):
+    """What a session holds on its own: conversation, context window and latency history"""
+    return deep_size([session.conversation, session.context, session.turn_latencies], set())
+
+
+def make_voice_fixtures(wav_dir, count, rng):
+    """WAV files for the voice phrases, (path, phrase) pairs"""
+    noise = np.random.default_rng(rng.randrange(2 ** 32))
+    fixtures = []
+    for i in range(count):
+        phrase = VOICE_PHRASES[i % len(VOICE_PHRASES)]
+        pcm, _ = make_fixture(phrase.split(), noise, pause_after=len(phrase.split()))
+        path = os.path.join(wav_dir, f"voice_{i}.wav")
+        write_wav(path, pcm)
+        fixtures.append((path, phrase))
+    return fixtures
+
+
+class FixtureMicrophone:
+    """Always-on microphone that hears background noise, plus WAV fixtures when the user speaks"""
+
+    def __init__(self, seed, frame_ms=20):
+        self.sample_rate = SAMPLE_RATE
+        self.frame_samples = SAMPLE_RATE * frame_ms // 1000
+        noise = np.random.default_rng(seed).normal(0, 80, self.frame_samples * 50)
+        self._noise = [frame.astype(np.int16).tobytes() for frame in np.split(noise, 50)]
+        self._speech = collections.deque()
+        self._next_at = None
+        self._read = 0
+
+    def say(self, path):
+        """Queue a fixture, its frames are heard next"""
+        source = WavSource(path, frame_ms=self.frame_samples * 1000 // self.sample_rate)
+        while True:
+            frame = source.read()
+            if not frame:
+                break
+            self._speech.append(frame)
+        source.close()
+
+    def read(self):
+        # Paced like a live microphone
+        now = time.perf_counter()
+        self._next_at = max(self._next_at or now, now - 0.1)
+        time.sleep(max(0.0, self._next_at - now))
+        self._next_at += self.frame_samples / self.sample_rate
+        self._read += 1
+        try:
+            return self._speech.popleft()
+        except IndexError:
+            return self._noise[self._read % len(self._noise)]
+
+    def close(self):
+        pass
+
+
+class SimulatedUser(threading.Thread):
+    """One user: a session, a flow mix, think time between turns"""
+
+    def __init__(self, index, engine, args, mix, stats, voice_fixtures=None):
+        super().__init__(name=f"user-{index}", daemon=True)
+        self.engine = engine
+        self.args = args
+        self.mix = mix
+        self.stats = stats
+        self.rng = random.Random(args.seed * 1000 + index)
+        self.session = engine.create_session()
+        self.session.use_memory = False
+        attach(self.session, latency=args.gemini_latency, chunks=args.gemini_chunks,
+               chunk_interval=args.chunk_interval, reply_words=args.reply_words, seed=args.seed * 1000 + index)
+        engine.configure_image_generation(self.session, "stub-key-0000")
+        self.session.image_samples = args.image_samples
+        self.voice = None
+        if voice_fixtures:
+            self.fixtures = voice_fixtures
+            self.microphone = FixtureMicrophone(args.seed * 1000 + index)
+            self.voice = SpeechInputService(
+                open_source=lambda: self.microphone,
+                recognizer=SegmentedRecognizer(tone_recognizer(), min_segment=1.0),
+            )
+
+    def run(self):
+        flows, weights = zip(*self.mix.items())
+        for turn in range(self.args.turns):
+            time.sleep(self.rng.uniform(0, 2 * self.args.think_time))
+            try:
+                if self.voice is not None:
+                    self.voice_turn()
+                else:
+                    flow = self.rng.choices(flows, weights)[0]
+                    self.command(flow, query_for(flow, self.rng))
+            except Exception as e:
+                self.stats.record_error("voice" if self.voice else "turn", e)
+        if self.voice is not None:
+            self.voice.close()
+
+    def voice_turn(self):
+        path, expected = self.rng.choice(self.fixtures)
+        self.microphone.say(path)
+        utterance = self.voice.listen(timeout=10, phrase_time_limit=15)
+        self.stats.record_recognition(utterance.latency, utterance.text == expected)
+        self.command("voice", utterance.text)
+
+    def command(self, flow, query):
+        """What handle_command does for one query, timed"""
+        started = time.perf_counter()
+        first_chunk = None
+
+        def on_chunk(chunk):
+            nonlocal first_chunk
+            if first_chunk is None:
+                first_chunk = time.perf_counter() - started
+
+        intent = self.engine.route(self.session, query)
+        stream = intent is None and self.args.stream
+        message = self.engine.handle(self.session, query, intent=intent, on_chunk=on_chunk if stream else None)
+        elapsed = time.perf_counter() - started
+        self.stats.record_turn(flow, elapsed, first_chunk, message)
+
+
+class LoadStats:
+    """Thread-safe collection of per-turn measurements"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turns = {}
+        self.first_chunks = []
+        self.refused = 0
+        self.errors = {}
+        self.last_error = None
+        self.recognition = []
+        self.misheard = 0
+
+    def record_turn(self, flow, seconds, first_chunk, message):
+        with self.lock:
+            self.turns.setdefault(flow, []).append(seconds)
+            if first_chunk is not None:
+                self.first_chunks.append(first_chunk)
+            if "error" in message:
+                if message.get("job_id") is None and "image" in message.get("content", ""):
+                    # The per-session job cap said no, that is the designed behaviour under load
+                    self.refused += 1
+                else:
+                    self.errors[flow] = self.errors.get(flow, 0) + 1
+
+    def record_recognition(self, seconds, correct):
+        with self.lock:
+            self.recognition.append(seconds)
+            self.misheard += not correct
+
+    def record_error(self, flow, error):
+        with self.lock:
+            self.errors[flow] = self.errors.get(flow, 0) + 1
+            self.last_error = f"{type(error).__name__}: {error}"
+
+
+def wait_for_jobs(jobs, session_ids, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not any(jobs.list(session_id, active_only=True) for session_id in session_ids):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def image_job_times(jobs, session_ids):
+    durations, statuses = [], {}
+    for session_id in session_ids:
+        for job in jobs.list(session_id, limit=1000):
+            statuses[job["status"]] = statuses.get(job["status"], 0) + 1
+            if job["status"] == "done":
+                durations.append(job["finished_at"] - job["created_at"])
+    return durations, statuses
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(result, baseline, max_regression):
+    """Print this run next to the baseline, returns the regressions found"""
+    regressions = []
+    before, after = baseline["throughput_turns_per_s"], result["throughput_turns_per_s"]
+    print(f"\nCompared with {baseline.get('started_at')} ({baseline.get('git_commit') or 'unknown commit'}):")
+    changed = sorted(key for key, value in result["config"].items() if baseline.get("config", {}).get(key) != value)
+    if changed:
+        print(f"  Note: the runs differ in {', '.join(changed)}")
+    print(f"  throughput      {before:8.2f} -> {after:8.2f} turns/s")
+    if before and after < before * (1 - max_regression):
+        regressions.append("throughput")
+    for flow, summary in result["flows"].items():
+        old = baseline["flows"].get(flow, {})
+        if "p95_ms" not in old or "p95_ms" not in summary:
+            continue
+        print(f"  {flow:<14}  p95 {old['p95_ms']:8.1f} -> {summary['p95_ms']:8.1f} ms")
+        # Ignore flows that stay within a few milliseconds, their p95 is mostly noise
+        if summary["p95_ms"] > old["p95_ms"] * (1 + max_regression) and summary["p95_ms"] - old["p95_ms"] > 5:
+            regressions.append(f"{flow} p95")
+    if regressions:
+        print(f"  Regressed by more than {max_regression:.0%}: {', '.join(regressions)}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=10, help="Queries per user")
+    parser.add_argument("--think-time", type=float, default=0.5, help="Mean pause between a user's queries (s)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("chat=0.6,wikipedia=0.15,image=0.1,time=0.15"))
+    parser.add_argument("--voice-users", type=float, default=0.1, help="Share of users who speak their queries")
+    parser.add_argument("--no-stream", dest="stream", action="store_false", help="Answer chat queries in one piece")
+    parser.add_argument("--gemini-latency", type=float, default=0.4)
+    parser.add_argument("--gemini-chunks", type=int, default=8)
+    parser.add_argument("--chunk-interval", type=float, default=0.03)
+    parser.add_argument("--reply-words", type=int, default=60)
+    parser.add_argument("--backend-latency", type=float, default=0.15, help="Stub Wikipedia and Stability latency")
+    parser.add_argument("--step-latency", type=float, default=0.02, help="Extra stub image seconds per step")
+    parser.add_argument("--image-samples", type=int, default=1)
+    parser.add_argument("--mongo", default="mongomock", help="mongomock, or a MongoDB connection string")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Result file, default benchmarks/results/load_test-<time>.json")
+    parser.add_argument("--compare", help="Earlier result file to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    started_at = datetime.datetime.now()
+    rng = random.Random(args.seed)
+    stub = StubBackends(latency=args.backend_latency, step_latency=args.step_latency)
+    stub.start()
+    workdir = tempfile.mkdtemp(prefix="load-test-")
+
+    if args.mongo == "mongomock":
+        client = mongomock.MongoClient()
+    else:
+        client = pymongo.MongoClient(args.mongo)
+    db = client[f"load_test_{os.getpid()}"]
+    ensure_indexes(db)
+    writer = ConversationWriter(db.conversations, sessions=db.sessions)
+    jobs = JobQueue(None, workers=4)
+    # A fresh tracer so the stage percentiles are this run's only
+    tracer = Tracer()
+    engine = ChatEngine(
+        response_cache=ResponseCache(max_entries=4096),
+        image_store=ImageStore(os.path.join(workdir, "images")),
+        writer=writer,
+        backends=AsyncBackends(),
+        stability_url=stub.stability_url,
+        wikipedia_url=stub.wikipedia_url,
+        jobs=jobs,
+        tracer=tracer,
+    )
+
+    voice_users = round(args.users * args.voice_users)
+    fixtures = make_voice_fixtures(workdir, len(VOICE_PHRASES), rng) if voice_users else []
+    stats = LoadStats()
+    rss_before = current_rss()
+    users = [
+        SimulatedUser(i, engine, args, args.mix, stats, voice_fixtures=fixtures if i < voice_users else None)
+        for i in range(args.users)
+    ]
+    print(f"{args.users} users ({voice_users} voice) x {args.turns} turns, think time {args.think_time}s, "
+          f"Gemini {args.gemini_latency}s, backends {args.backend_latency}s, MongoDB {args.mongo.split('@')[-1]}")
+
+    run_started = time.perf_counter()
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    wall_seconds = time.perf_counter() - run_started
+    session_ids = [user.session.session_id for user in users]
+    jobs_finished = wait_for_jobs(jobs, session_ids, timeout=60)
+    writer.flush(timeout=30)
+    rss_after = current_rss()
+
+    turn_count = sum(len(times) for times in stats.turns.values())
+    all_turns = [t for times in stats.turns.values() for t in times]
+    image_durations, job_statuses = image_job_times(jobs, session_ids)
+    state_sizes = [session_state_size(user.session) for user in users]
+    result = {
+        "benchmark": "load_test",
+        "started_at": started_at.isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "wall_seconds": round(wall_seconds, 2),
+        "turns": turn_count,
+        "throughput_turns_per_s": round(turn_count / wall_seconds, 2),
+        "overall": summarize(all_turns),
+        "flows": {flow: summarize(times) for flow, times in sorted(stats.turns.items())},
+        "first_chunk": summarize(stats.first_chunks),
+        "image_jobs": dict(summarize(image_durations), statuses=job_statuses, all_finished=jobs_finished,
+                           refused=stats.refused),
+        "recognition": dict(summarize(stats.recognition), misheard=stats.misheard),
+        "errors": dict(stats.errors, last_error=stats.last_error) if stats.errors else {},
+        "memory": {
+            "rss_growth_mb": round((rss_after - rss_before) / 2 ** 20, 1),
+            "rss_per_session_kb": round((rss_after - rss_before) / 1024 / args.users, 1),
+            "state_per_session_kb": round(sum(state_sizes) / len(state_sizes) / 1024, 1),
+        },
+        "stages": tracer.stats(),
+        "mongo_writer": writer.stats(),
+        "backend_requests": stub.requests,
+    }
+
+    print(f"\n{turn_count} turns in {wall_seconds:.1f}s: {result['throughput_turns_per_s']:.2f} turns/s")
+    print(f"  {'flow':<10} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name, summary in [("all", result["overall"])] + list(result["flows"].items()) + [
+            ("first chunk", result["first_chunk"]), ("image job", result["image_jobs"]),
+            ("recognize", result["recognition"])]:
+        if summary["count"]:
+            print(f"  {name:<10} {summary['count']:>6} {summary['p50_ms']:>6.0f} ms {summary['p95_ms']:>6.0f} ms "
+                  f"{summary['p99_ms']:>6.0f} ms {summary['max_ms']:>6.0f} ms")
+    print(f"  Per-stage p95: " + ", ".join(f"{stage} {values['p95_ms']:.0f} ms"
+                                          for stage, values in result["stages"].items()))
+    print(f"  Memory: RSS +{result['memory']['rss_growth_mb']} MB "
+          f"({result['memory']['rss_per_session_kb']} KB per session), "
+          f"session state {result['memory']['state_per_session_kb']} KB")
+    print(f"  Image jobs {job_statuses}, {stats.refused} refused by the per-session cap; "
+          f"{stats.misheard} voice queries misheard; errors {stats.errors or 'none'}")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"load_test-{started_at:%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {output}")
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.max_regression)
+
+    jobs.close()
+    writer.close()
+    engine.backends.close()
+    stub.stop()
+    failed = bool(stats.errors) or not jobs_finished or bool(regressions)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Local stand-ins for the Stability and Wikipedia HTTP APIs.
+
+Usage:
+    python benchmarks/stub_backends.py --port 8765 --latency 0.5
+
+Serves the Stability text-to-image endpoint (returns a small PNG) and the
+MediaWiki query endpoint with configurable latency, failure rate and
+stalling, and counts the TCP connections it accepted so connection reuse can
+be checked. Used by the backend benchmarks and load tests; point the engine
+at it with ChatEngine(stability_url=..., wikipedia_url=...).
+"""
+import argparse
+import asyncio
+import random
+import threading
+from io import BytesIO
+
+from aiohttp import web
+from PIL import Image
+
+STABILITY_PATH = "/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
+WIKIPEDIA_PATH = "/w/api.php"
+
+
+def sample_png(seed=0, size=(64, 64)):
+    """A small PNG whose content depends on the seed, so different prompts give different images"""
+    rng = random.Random(seed)
+    img = Image.new("RGB", size, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    buffer = BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class StubBackends:
+    """aiohttp app with tunable behaviour, settings can be changed while it runs"""
+
+    def __init__(self, latency=0.0, failure_rate=0.0, stall=False, step_latency=0.0):
+        self.latency = latency
+        # Extra image latency per diffusion step, so drafts come back sooner
+        self.step_latency = step_latency
+        self.failure_rate = failure_rate
+        self.stall = stall
+        self.requests = 0
+        self.failures = 0
+        self.disconnects = 0
+        self.peers = set()
+        self.url = None
+        self._loop = None
+        self._runner = None
+
+    def app(self):
+        app = web.Application()
+        app.add_routes([
+            web.post(STABILITY_PATH, self.text_to_image),
+            web.get(WIKIPEDIA_PATH, self.wikipedia),
+        ])
+        return app
+
+    @property
+    def stability_url(self):
+        return self.url + STABILITY_PATH
+
+    @property
+    def wikipedia_url(self):
+        return self.url + WIKIPEDIA_PATH
+
+    async def _behave(self, request, extra=0.0):
+        self.requests += 1
+        self.peers.add(request.transport.get_extra_info("peername"))
+        try:
+            await asyncio.sleep(3600 if self.stall else self.latency + extra)
+        except asyncio.CancelledError:
+            # aiohttp cancels the handler when the client hangs up
+            self.disconnects += 1
+            raise
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            raise web.HTTPServiceUnavailable(text="Stub overloaded")
+
+    async def text_to_image(self, request):
+        payload = await request.json()
+        await self._behave(request, self.step_latency * payload.get("steps", 30))
+        if not request.headers.get("Authorization", "").startswith("Bearer "):
+            raise web.HTTPUnauthorized(text="Missing API key")
+        prompt = payload["text_prompts"][0]["text"]
+        seed = f"{prompt}/{payload.get('seed', 0)}/{payload.get('steps', 30)}"
+        return web.Response(body=sample_png(seed), content_type="image/png")
+
+    async def wikipedia(self, request):
+        await self._behave(request)
+        topic = request.query.get("gsrsearch", "")
+        page = {"pageid": 1, "title": topic.title(), "extract": f"{topic.title()} is a stub article. It exists for tests."}
+        return web.json_response({"query": {"pages": {"1": page}}})
+
+    def start(self, host="127.0.0.1", port=0):
+        """Serve on a background thread, returns the base URL"""
+        started = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._runner = web.AppRunner(self.app(), handler_cancellation=True)
+            self._loop.run_until_complete(self._runner.setup())
+            site = web.TCPSite(self._runner, host, port)
+            self._loop.run_until_complete(site.start())
+            bound_port = site._server.sockets[0].getsockname()[1]
+            self.url = f"http://{host}:{bound_port}"
+            started.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=serve, name="stub-backends", daemon=True).start()
+        started.wait()
+        return self.url
+
+    def stop(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result(timeout=5)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds before answering")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--stall", action="store_true", help="Never answer")
+    parser.add_argument("--step-latency", type=float, default=0.0, help="Extra image seconds per diffusion step")
+    args = parser.parse_args()
+
+    stub = StubBackends(args.latency, args.failure_rate, args.stall, args.step_latency)
+    web.run_app(stub.app(), host=args.host, port=args.port, handler_cancellation=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,721 @@
+"""Headless chat engine.
+
+Everything needed to answer a query lives here: intent routing, Gemini,
+Wikipedia, image generation, response caching and persistence. Per-user state
+is kept in an explicit ChatSession instead of st.session_state, so one engine
+can serve the Streamlit app, the HTTP/WebSocket server in chat_server.py or a
+load test, with many sessions per process.
+"""
+import datetime
+import threading
+import time
+import uuid
+import webbrowser
+import zlib
+
+from backend_clients import RETRY_STATUSES, AsyncBackends, BackendCancelled, RetryableError
+from client_registry import ClientRegistry, credential_id
+from context_window import ContextWindow
+from intent_router import BUILTIN_COMMANDS, IntentRouter
+from job_queue import JobLimitError
+from memory_index import memory_item
+from metrics import get_tracer
+from response_cache import ResponseCache, cache_key
+
+GEMINI_MODEL = 'gemini-1.5-flash-001'
+STABILITY_URL = "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
+WIKIPEDIA_API_URL = "https://en.wikipedia.org/w/api.php"
+USER_AGENT = "Gen-AI-Chatbot/1.0 (https://github.com/darkhiem/Gen-AI-Chatbot)"
+# SDXL only accepts a few fixed sizes, and the same seed at fewer steps keeps the composition,
+# so drafts save time on steps and a refined image matches its draft
+IMAGE_PRESETS = {
+    "draft": {"cfg_scale": 7, "height": 1024, "width": 1024, "steps": 10},
+    "standard": {"cfg_scale": 7, "height": 1024, "width": 1024, "steps": 30},
+    "high": {"cfg_scale": 7, "height": 1024, "width": 1024, "steps": 50},
+}
+MAX_IMAGE_SAMPLES = 4
+
+# Sites for the "open ..." commands
+SITES = {
+    "open_youtube": ("YouTube", "https://youtube.com"),
+    "open_google": ("Google", "https://google.com"),
+    "open_stackoverflow": ("Stack Overflow", "https://stackoverflow.com"),
+}
+
+# Only keep recent turns around for latency reporting
+MAX_LATENCY_HISTORY = 50
+
+# Message fields that are stored in MongoDB and sent to clients
+MESSAGE_FIELDS = ("role", "content", "image_ref", "image_refs", "image_url", "job_id", "latency")
+
+
+class ImageGenerationError(Exception):
+    """The image backend refused or failed the request"""
+
+
+class ChatSession:
+    """Everything that belongs to one user's conversation"""
+
+    def __init__(self, session_id=None, context=None):
+        self.session_id = session_id or str(uuid.uuid4())
+        self.conversation = []
+        self.convo = None
+        self.model = None
+        # Names the session's Gemini key, so only turns sent under the same key are shared
+        self.gemini_credential = None
+        # What Gemini sees: rolling summary plus recent turns, rather than the whole chat
+        self.context = context or ContextWindow()
+        self.prompt_tokens = None
+        # Recall relevant snippets from past conversations into the prompt, only from this owner's
+        # messages (e.g. everything stored in the user's database), or else only from this session's
+        self.use_memory = True
+        self.memory_owner = None
+        self.stable_diffusion_api_key = ""
+        # Images per prompt, their quality preset and whether drafts are refined to the standard preset
+        self.image_samples = 1
+        self.image_preset = "standard"
+        self.refine_drafts = False
+        self.cache_chat_turns = False
+        self.writer = None
+        self.image_store = None
+        self.turn_latencies = []
+        self.last_active = time.time()
+        # Set to cancel the turn in flight, on_wait is called while it waits on a backend
+        self.cancel_event = threading.Event()
+        self.on_wait = None
+        # Called with (index, image_ref, preset) as each image of a turn arrives
+        self.on_image = None
+        # (job_id, func) reserved during a turn, started once the turn's messages are saved
+        self.deferred_jobs = []
+        # Turns of one session run one at a time, sessions run concurrently
+        self.lock = threading.RLock()
+
+    @property
+    def gemini_initialized(self):
+        return self.convo is not None
+
+    @property
+    def image_generation_enabled(self):
+        return bool(self.stable_diffusion_api_key)
+
+
+def message_to_dict(message):
+    """JSON-friendly view of a conversation message"""
+    data = {field: message[field] for field in MESSAGE_FIELDS if field in message}
+    for field in ("action", "error", "cancelled", "pending"):
+        if field in message:
+            data[field] = message[field]
+    if isinstance(message.get("timestamp"), datetime.datetime):
+        data["timestamp"] = message["timestamp"].isoformat()
+    return data
+
+
+class ChatEngine:
+    """Answers queries for any number of ChatSessions"""
+
+    def __init__(self, response_cache=None, image_store=None, writer=None, gemini_model=GEMINI_MODEL,
+                 open_urls=False, backends=None, stability_url=STABILITY_URL, wikipedia_url=WIKIPEDIA_API_URL,
+                 context_settings=None, memory=None, recall_k=3, recall_min_score=0.3, image_parallelism=4,
+                 jobs=None, tracer=None, clients=None):
+        self.response_cache = response_cache or ResponseCache()
+        # ContextWindow arguments (max_tokens, keep_turns, summary_tokens) for new sessions
+        self.context_settings = context_settings or {}
+        # Optional MemoryIndex, every saved message is indexed and searched for recall
+        self.memory = memory
+        self.recall_k = recall_k
+        self.recall_min_score = recall_min_score
+        # Calls are rate limited and scheduled per session, see backend_clients
+        self.backends = backends or AsyncBackends()
+        # Gemini clients per API key, so sessions with different keys never share one
+        self.clients = clients or ClientRegistry(self.backends)
+        self.stability_url = stability_url
+        self.wikipedia_url = wikipedia_url
+        # Samples of one prompt requested at once, the stability policy also caps requests process-wide
+        self.image_parallelism = image_parallelism
+        # Optional JobQueue, image requests then run in the background behind a placeholder message
+        self.jobs = jobs
+        self.image_store = image_store
+        self.writer = writer
+        self.gemini_model = gemini_model
+        # Only a local, single-user client should open tabs on the machine running the engine
+        self.open_urls = open_urls
+        # Per-stage latency spans, the process-wide tracer unless one is given
+        self.tracer = tracer or get_tracer()
+        self.router = self._build_router()
+
+    def create_session(self, session_id=None):
+        return ChatSession(session_id, context=ContextWindow(**self.context_settings))
+
+    def cancel(self, session):
+        """Stop the session's turn in flight, it returns whatever was received so far"""
+        session.cancel_event.set()
+
+    # Configuration
+
+    def configure_gemini(self, session, api_key):
+        """Start a Gemini chat for the session, raises if the key or model is rejected"""
+        session.model = self.clients.gemini_model(api_key, self.gemini_model)
+        session.convo = session.model.start_chat()
+        session.gemini_credential = credential_id(api_key)
+        return True
+
+    def configure_image_generation(self, session, api_key):
+        """Enable image generation for the session, only a basic format check is done"""
+        if not api_key or len(api_key) < 8:
+            return False
+        session.stable_diffusion_api_key = api_key
+        return True
+
+    # Backends
+
+    def image_store_for(self, session):
+        return session.image_store or self.image_store
+
+    def _run(self, session, backend, request, key=None):
+        return self.backends.run(backend, request, session.cancel_event, session.on_wait,
+                                 tenant=session.session_id, key=key)
+
+    def _traced_run(self, session, backend, request, key=None):
+        with self.tracer.span(backend, session.session_id):
+            return self._run(session, backend, request, key)
+
+    def wikipedia_summary(self, session, topic, sentences=2):
+        """Wikipedia summaries rarely change, so identical topics are served from the cache"""
+        async def fetch():
+            # Top search hit and its plain-text intro in a single API request
+            params = {
+                "action": "query", "format": "json", "redirects": 1,
+                "generator": "search", "gsrsearch": topic, "gsrlimit": 1,
+                "prop": "extracts", "exintro": 1, "explaintext": 1, "exsentences": sentences,
+            }
+            async with self.backends.http().get(self.wikipedia_url, params=params,
+                                                headers={"User-Agent": USER_AGENT}) as response:
+                response.raise_for_status()
+                data = await response.json()
+            pages = data.get("query", {}).get("pages", {})
+            extracts = [page.get("extract") for page in pages.values() if page.get("extract")]
+            if not extracts:
+                raise LookupError(f"No Wikipedia page found for {topic!r}")
+            return extracts[0]
+
+        # Sessions asking for the same topic at once share one request, keyed like the cache
+        return self.response_cache.get_or_compute(
+            "wikipedia",
+            (topic, sentences),
+            lambda: self._traced_run(session, "wikipedia", fetch, key=cache_key("wikipedia", topic, sentences))
+        )
+
+    def query_gemini(self, session, query):
+        """Queries the Gemini AI model, falls back to Wikipedia if unavailable"""
+        if not session.gemini_initialized:
+            try:
+                results = self.wikipedia_summary(session, query)
+                return f"According to Wikipedia: {results}"
+            except BackendCancelled:
+                raise
+            except Exception:
+                return "I couldn't find information on that. Please initialize Gemini API for better responses."
+
+        async def send():
+            await session.convo.send_message_async(query)
+            return session.convo.last.text
+
+        try:
+            self._prepare_context(session, query)
+            request = self._gemini_request(session, query)
+            if request is not None:
+                cached = self.response_cache.get("gemini", *request)
+                if cached:
+                    session.context.add_turn(query, cached)
+                    return cached
+            key = None if request is None else cache_key("gemini", *request)
+            response = self._traced_run(session, "gemini", send, key).replace('*', '')
+            session.context.add_turn(query, response)
+            if request is not None:
+                self.response_cache.set("gemini", response, *request)
+            return response
+        except BackendCancelled:
+            raise
+        except Exception as e:
+            return f"Sorry, I couldn't process that request. Error: {str(e)}"
+
+    def query_gemini_stream(self, session, query):
+        """Streams the Gemini reply chunk by chunk, falls back to a single Wikipedia chunk"""
+        if not session.gemini_initialized:
+            yield self.query_gemini(session, query)
+            return
+
+        async def open_stream():
+            return await session.convo.send_message_async(query, stream=True)
+
+        # A suspended generator can be closed from another context, so the stream is
+        # timed by hand rather than with a span, and the time spent in the consumer is excluded
+        streamed, first_chunk_s, error, cached = 0.0, None, None, None
+        try:
+            self._prepare_context(session, query)
+            request = self._gemini_request(session, query)
+            if request is not None:
+                cached = self.response_cache.get("gemini", *request)
+                if cached:
+                    session.context.add_turn(query, cached)
+                    yield cached
+                    return
+            full_text = ""
+            started = time.perf_counter()
+            chunks = self.backends.stream("gemini", open_stream, session.cancel_event, session.on_wait,
+                                          tenant=session.session_id,
+                                          key=None if request is None else cache_key("gemini", *request))
+            for chunk in chunks:
+                text = chunk.text.replace('*', '')
+                streamed += time.perf_counter() - started
+                if first_chunk_s is None:
+                    first_chunk_s = streamed
+                if text:
+                    full_text += text
+                    yield text
+                started = time.perf_counter()
+            streamed += time.perf_counter() - started
+            session.context.add_turn(query, full_text)
+            if request is not None and full_text:
+                self.response_cache.set("gemini", full_text, *request)
+        except BackendCancelled as e:
+            error = e
+            raise
+        except Exception as e:
+            error = e
+            yield f"Sorry, I couldn't process that request. Error: {str(e)}"
+        finally:
+            # A turn answered from the cache never reached Gemini
+            if not cached:
+                self.tracer.record("gemini_stream", streamed, session.session_id, error=error,
+                                   first_chunk_ms=None if first_chunk_s is None else round(first_chunk_s * 1000, 1))
+
+    def recall(self, session, query):
+        """Snippets of past messages relevant to the query, excluding what the prompt already has"""
+        if self.memory is None or not session.use_memory:
+            return []
+        try:
+            with self.tracer.span("recall", session.session_id):
+                results = self.memory.search(query, k=self.recall_k, exclude_texts=session.context.window_texts() | {query},
+                                             min_score=self.recall_min_score,
+                                             owner=session.memory_owner or session.session_id)
+        except Exception:
+            return []
+        return [f"{'User' if r['role'] == 'user' else 'Assistant'}: {r['text']}" for r in results]
+
+    def _gemini_request(self, session, query):
+        """What a Gemini answer depends on, once the context is prepared, or None if it isn't reused.
+
+        Answers are cached and shared with identical turns in flight under the
+        API key, the history and the query together, so no session is answered
+        from another key's or another conversation's turn.
+        """
+        if not session.cache_chat_turns:
+            return None
+        return session.gemini_credential, session.context.history(), query
+
+    def _prepare_context(self, session, query):
+        """Trim the context to its budget and hand it to the chat as its history"""
+        session.prompt_tokens = session.context.fit(query, self.recall(session, query))
+        session.convo.history = session.context.history()
+
+    def fold_context(self, session):
+        """Fold turns that left the context window into the rolling summary and store it"""
+        context = session.context
+        turns = context.start_fold()
+        if turns is None:
+            return
+
+        async def summarize():
+            response = await session.model.generate_content_async(context.summary_prompt(turns))
+            return response.text
+
+        summary = None
+        if session.model is not None:
+            try:
+                with self.tracer.span("context_fold", session.session_id, turns=len(turns)):
+                    # Its own tenant, so background folds don't use up the tokens of the user's turns
+                    summary = self.backends.run("gemini", summarize, tenant=f"{session.session_id}:context")
+            except Exception:
+                pass
+        context.fold(summary or context.fallback_summary(turns), turns)
+
+        writer = session.writer or self.writer
+        if writer is not None and context.summarized_through is not None:
+            try:
+                writer.save_context(session.session_id, context.summary, context.summarized_through)
+            except Exception:
+                # The summary is rebuilt from the messages if it can't be stored
+                pass
+
+    def restore_context(self, session):
+        """Rebuild the Gemini context of a session loaded from storage"""
+        writer = session.writer or self.writer
+        if writer is not None:
+            from conversation_store import load_context
+
+            summary, through, messages = load_context(writer.collection, writer.sessions, session.session_id)
+        else:
+            summary, through, messages = "", None, session.conversation
+        session.context.restore(summary, through, messages)
+
+    def _image_request(self, session, prompt, preset, seed):
+        """Cache key parts and the request coroutine function for one image"""
+        settings = IMAGE_PRESETS[preset]
+        # Identical prompts with the same settings and seed reuse the stored image
+        cache_parts = (self.stability_url, prompt, settings["cfg_scale"], settings["steps"],
+                       settings["width"], settings["height"], seed)
+
+        # Ask for the raw PNG so it can be stored as-is, without base64 or re-encoding
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "image/png",
+            "Authorization": f"Bearer {session.stable_diffusion_api_key}"
+        }
+        payload = dict(settings, samples=1, seed=seed, text_prompts=[{"text": prompt}])
+
+        async def post():
+            async with self.backends.http().post(self.stability_url, headers=headers, json=payload) as response:
+                if response.status in RETRY_STATUSES:
+                    raise RetryableError(f"Stability API returned {response.status}")
+                if response.status != 200:
+                    raise ImageGenerationError(f"Non-200 response: {await response.text()}")
+                return await response.read()
+
+        return cache_parts, post
+
+    def generate_image(self, session, prompt, preset="standard", seed=None):
+        """Text to image through the Stability API, returns the stored image reference"""
+        return self.generate_images(session, prompt, samples=1, preset=preset,
+                                    seeds=None if seed is None else [seed])[0]
+
+    def generate_images(self, session, prompt, samples=1, preset="standard", refine_to=None, seeds=None,
+                        on_image=None, cancel_event=None, on_wait=None):
+        """Generate samples of a prompt concurrently, returns their stored image references in order.
+
+        Each sample has its own seed (derived from the prompt unless given).
+        on_image(index, image_ref, preset) is called on the calling thread as
+        soon as each image is stored, with its thumbnail already rendered. With
+        refine_to, every draft is generated again at that preset with the same
+        seed and delivered for the same index. Failed samples are skipped, an
+        error is raised only when no image could be generated. cancel_event
+        and on_wait default to the session's, i.e. those of the turn in flight.
+        """
+        if cancel_event is None:
+            cancel_event, on_wait = session.cancel_event, session.on_wait
+        store = self.image_store_for(session)
+        if seeds is None:
+            base = zlib.crc32(prompt.encode())
+            # Seed 0 asks Stability for a random one
+            seeds = [(base + i) % 4294967295 + 1 for i in range(samples)]
+        refs = [None] * len(seeds)
+        errors = []
+
+        def deliver(index, image_ref, stage):
+            refs[index] = image_ref
+            if on_image is not None:
+                store.thumbnail(image_ref)
+                on_image(index, image_ref, stage)
+
+        for stage in [preset] + ([refine_to] if refine_to and refine_to != preset else []):
+            pending, requests, keys = [], [], []
+            for index, seed in enumerate(seeds):
+                cache_parts, post = self._image_request(session, prompt, stage, seed)
+                cached_ref = self.response_cache.get("image", *cache_parts)
+                if cached_ref and store.contains(cached_ref):
+                    deliver(index, cached_ref, stage)
+                else:
+                    pending.append((index, cache_parts))
+                    requests.append(post)
+                    # The same prompt, settings and seed requested by another session right now share one call
+                    keys.append(cache_key("image", *cache_parts))
+
+            results = self.backends.run_many("stability", requests, cancel_event, on_wait,
+                                             limit=self.image_parallelism, tenant=session.session_id, keys=keys)
+            for position, image_data, error in results:
+                if error is not None:
+                    errors.append(error)
+                    continue
+                index, cache_parts = pending[position]
+                # Store the bytes and keep only the content hash in the conversation
+                image_ref = store.put(image_data)
+                self.response_cache.set("image", image_ref, *cache_parts)
+                deliver(index, image_ref, stage)
+
+        if not any(refs):
+            raise errors[0] if errors else ImageGenerationError("No image was generated")
+        return [ref for ref in refs if ref]
+
+    # Commands
+
+    def _build_router(self):
+        router = IntentRouter(BUILTIN_COMMANDS)
+        router.handler("generate_image", enabled=lambda session: session.image_generation_enabled)(
+            self._handle_image
+        )
+        router.handler("wikipedia")(self._handle_wikipedia)
+        for command_name, (site_name, url) in SITES.items():
+            router.handler(command_name)(self._open_site_handler(site_name, url))
+        router.handler("time")(self._handle_time)
+        router.handler("exit")(self._handle_exit)
+        return router
+
+    def _handle_image(self, session, query, args):
+        # If no specific prompt, use the whole query
+        img_prompt = args.get("prompt") or query
+        samples = max(1, min(session.image_samples, MAX_IMAGE_SAMPLES))
+        preset = session.image_preset
+        refine_to = "standard" if session.refine_drafts and preset == "draft" else None
+        if self.jobs is None:
+            return self._image_message(session, img_prompt, samples, preset, refine_to, on_image=session.on_image)
+        return self._queue_image_job(session, img_prompt, samples, preset, refine_to)
+
+    def _image_message(self, session, img_prompt, samples, preset, refine_to, on_image=None, cancel_event=None):
+        """Generate the images of a prompt and return the assistant message showing them"""
+        delivered = {}
+
+        def deliver(index, image_ref, stage):
+            delivered[index] = image_ref
+            if on_image is not None:
+                on_image(index, image_ref, stage)
+
+        cancelled = False
+        try:
+            with self.tracer.span("image", session.session_id, samples=samples, preset=preset):
+                img_refs = self.generate_images(session, img_prompt, samples=samples, preset=preset,
+                                                refine_to=refine_to, on_image=deliver, cancel_event=cancel_event)
+        except BackendCancelled:
+            # Keep the images (or drafts) that arrived before Stop
+            if not delivered:
+                raise
+            img_refs = [delivered[index] for index in sorted(delivered)]
+            cancelled = True
+        except Exception as e:
+            return {
+                "role": "assistant",
+                "content": "I'm sorry, I couldn't generate that image. Please try a different description.",
+                "error": f"Error generating image: {e}"
+            }
+        message = {
+            "role": "assistant",
+            "content": f"Generating an image based on: {img_prompt}",
+            "image_ref": img_refs[0]
+        }
+        if len(img_refs) > 1:
+            message["image_refs"] = img_refs
+        if cancelled:
+            message["cancelled"] = True
+        return message
+
+    def _queue_image_job(self, session, img_prompt, samples, preset, refine_to):
+        """Placeholder message for an image job, the job fills it in as images arrive"""
+        try:
+            job_id = self.jobs.reserve(session.session_id, "image", img_prompt)
+        except JobLimitError as e:
+            return {
+                "role": "assistant",
+                "content": "I'm still working on your earlier images, please wait for one of them to finish.",
+                "error": str(e)
+            }
+        placeholder = {
+            "role": "assistant",
+            "content": f"Generating an image based on: {img_prompt}",
+            "job_id": job_id,
+            "pending": True
+        }
+        deliveries = samples * (2 if refine_to else 1)
+
+        def run(job):
+            delivered = {}
+            arrived = 0
+
+            def on_image(index, image_ref, stage):
+                nonlocal arrived
+                # Show each image in the placeholder as soon as it arrives
+                delivered[index] = image_ref
+                refs = [delivered[i] for i in sorted(delivered)]
+                placeholder.update(image_ref=refs[0], **({"image_refs": refs} if len(refs) > 1 else {}))
+                arrived += 1
+                job.progress(arrived, deliveries)
+
+            try:
+                message = self._image_message(session, img_prompt, samples, preset, refine_to,
+                                              on_image=on_image, cancel_event=job.cancel_event)
+            except BackendCancelled:
+                message = {"role": "assistant", "content": "Image generation was cancelled.", "cancelled": True}
+            message.pop("role")
+            self.complete_message(session, placeholder, message)
+            return message
+
+        session.deferred_jobs.append((job_id, run))
+        return placeholder
+
+    def complete_message(self, session, message, fields):
+        """Fill in a placeholder message in place and in storage"""
+        message.update(fields)
+        message.pop("pending", None)
+        writer = session.writer or self.writer
+        if writer is not None and "_id" in message:
+            stored = {field: fields[field] for field in MESSAGE_FIELDS if field in fields}
+            try:
+                writer.update(message["_id"], stored)
+            except Exception:
+                # The job record still has the result
+                pass
+
+    def _handle_wikipedia(self, session, query, args):
+        try:
+            results = self.wikipedia_summary(session, args.get("topic") or query)
+            response = f"According to Wikipedia: {results}"
+        except BackendCancelled:
+            raise
+        except Exception:
+            response = "Sorry, I couldn't find any results on Wikipedia."
+        return {"role": "assistant", "content": response}
+
+    def _open_site_handler(self, site_name, url):
+        def handle_open_site(session, query, args):
+            if self.open_urls:
+                webbrowser.open_new_tab(url)
+            # Remote clients open the tab themselves
+            return {"role": "assistant", "content": f"Opening {site_name} in a new tab.", "action": {"open_url": url}}
+        return handle_open_site
+
+    def _handle_time(self, session, query, args):
+        strTime = datetime.datetime.now().strftime("%H:%M:%S")
+        return {"role": "assistant", "content": f"The time is {strTime}"}
+
+    def _handle_exit(self, session, query, args):
+        return {"role": "assistant", "content": "Have a good day! Refresh the page to start a new session."}
+
+    # Turns
+
+    def route(self, session, query):
+        """Intent for a query (None for a general question)"""
+        with self.tracer.span("route", session.session_id) as span:
+            intent = self.router.route(query, context=session)
+            span.set(intent=intent.name if intent is not None else None)
+        return intent
+
+    def handle(self, session, query, on_chunk=None, intent=None, on_wait=None, cancel_event=None, on_image=None):
+        """Answer one query and return the assistant message.
+
+        When on_chunk is given, general questions are streamed and on_chunk is
+        called with every piece of text as it arrives. A precomputed intent
+        can be passed to avoid routing twice. on_wait is called periodically
+        while a backend call is pending, and setting cancel_event (or calling
+        cancel()) stops the turn and keeps what was received so far.
+        on_image(index, image_ref, preset) is called as each generated image
+        arrives. With a job queue, image requests return a pending placeholder
+        right away and a background job fills it in.
+        """
+        with session.lock, self.tracer.span("turn", session.session_id) as turn:
+            session.last_active = time.time()
+            session.cancel_event = cancel_event or threading.Event()
+            session.on_wait = on_wait
+            session.on_image = on_image
+            session.deferred_jobs = []
+            session.prompt_tokens = None
+            started_at = time.perf_counter()
+            first_token_at = None
+
+            if intent is None:
+                intent = self.route(session, query)
+            turn.set(intent=intent.name if intent is not None else "chat", streamed=on_chunk is not None)
+
+            # Add user query to conversation
+            user_message = {"role": "user", "content": query}
+            session.conversation.append(user_message)
+            self.save_message(session, user_message)
+
+            response = ""
+            try:
+                if intent is not None and intent.handler is not None:
+                    assistant_message = intent.handler(session, query, intent.args)
+
+                elif on_chunk is not None:
+                    # Stream general queries so the first words reach the client right away
+                    for chunk in self.query_gemini_stream(session, query):
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                        response += chunk
+                        on_chunk(chunk)
+                    assistant_message = {"role": "assistant", "content": response}
+
+                else:
+                    # Handle general queries using Gemini AI or Wikipedia
+                    response = self.query_gemini(session, query)
+                    assistant_message = {"role": "assistant", "content": response}
+            except BackendCancelled:
+                assistant_message = {"role": "assistant", "content": response or "Stopped.", "cancelled": True}
+            except BaseException:
+                # The caller itself was interrupted (e.g. a Streamlit rerun), still close the turn
+                stopped = {"role": "assistant", "content": response or "Stopped.", "cancelled": True}
+                self._finish_turn(session, stopped, started_at, first_token_at)
+                for job_id, _ in session.deferred_jobs:
+                    self.jobs.cancel(job_id)
+                raise
+            finally:
+                session.on_wait = None
+                session.on_image = None
+
+            self._finish_turn(session, assistant_message, started_at, first_token_at)
+            if "error" in assistant_message:
+                turn.fail(assistant_message["error"])
+
+            # Jobs start once their placeholder is saved, so filling it in can't race its insert
+            for job_id, run in session.deferred_jobs:
+                self.jobs.start(job_id, run)
+            session.deferred_jobs = []
+
+            # Summarize turns that left the window off the critical path
+            session.context.stamp(assistant_message.get("timestamp"))
+            if session.context.pending:
+                threading.Thread(target=self.fold_context, args=(session,), name="context-fold", daemon=True).start()
+            return assistant_message
+
+    def _finish_turn(self, session, assistant_message, started_at, first_token_at):
+        assistant_message["latency"] = self.record_latency(session, started_at, first_token_at)
+
+        # Add assistant response to conversation
+        session.conversation.append(assistant_message)
+        self.save_message(session, assistant_message)
+        return assistant_message
+
+    def record_latency(self, session, started_at, first_token_at):
+        """Record time-to-first-token and total latency for a turn"""
+        finished_at = time.perf_counter()
+        if first_token_at is None:
+            first_token_at = finished_at
+        latency = {
+            "ttft_ms": round((first_token_at - started_at) * 1000, 1),
+            "total_ms": round((finished_at - started_at) * 1000, 1),
+        }
+        if session.prompt_tokens is not None:
+            latency["prompt_tokens"] = session.prompt_tokens
+            latency["recalled"] = len(session.context.recalled)
+        session.turn_latencies.append(latency)
+        del session.turn_latencies[:-MAX_LATENCY_HISTORY]
+        return latency
+
+    def save_message(self, session, message):
+        """Queue a message for MongoDB if the session (or engine) has a writer, and then for the memory index"""
+        writer = session.writer or self.writer
+        if writer is None:
+            # Nothing is kept on disk for a user who hasn't turned on storage, memory included
+            return
+
+        message_data = {
+            "session_id": session.session_id,
+            "timestamp": datetime.datetime.now(),
+        }
+        message_data.update({field: message[field] for field in MESSAGE_FIELDS if field in message})
+        writer.put(message_data)
+
+        # Remember where the message is stored so it can be paged out of memory later
+        message["_id"] = message_data["_id"]
+        message["timestamp"] = message_data["timestamp"]
+
+        if self.memory is not None and message.get("content"):
+            self.memory.put(memory_item(message_data, session.memory_owner))
+
@@ -0,0 +1,331 @@
+"""HTTP/WebSocket server for the chat engine.
+
+Serves many chat sessions from one process without Streamlit:
+
+    python chat_server.py --port 8080
+
+    POST   /sessions                    create a session, optional API keys and image settings
+                                        (image_samples, image_preset, refine_drafts) in the JSON body,
+                                        session_id to resume a stored session (409 if it is active)
+    GET    /sessions/{id}               session info and conversation
+    DELETE /sessions/{id}               forget a session
+    POST   /sessions/{id}/messages      {"text": ...} -> assistant message
+    POST   /sessions/{id}/cancel        stop the reply being generated
+    GET    /sessions/{id}/ws            WebSocket, send {"text": ...}, receive streamed chunks and
+                                        generated images as they arrive,
+                                        send {"type": "cancel"} to stop the reply
+    GET    /sessions/{id}/metrics       per-stage p50/p95/p99 latency of the session and its recent spans
+    GET    /images/{ref}[/thumbnail]    stored generated images
+    GET    /metrics                     per-stage latency histograms and backend call counters
+                                        (coalesced, rate limited, ...) in the Prometheus text format
+
+Keys default to GEMINI_API_KEY and STABLE_DIFFUSION_API_KEY from the
+environment. MONGODB_CONNECTION_STRING enables conversation storage, and
+TRACE_LOG (a file, or "-" for stderr) writes every span as a JSON line.
+Engine calls are blocking, so every turn runs on a bounded thread pool while
+the event loop keeps serving other sessions.
+"""
+import argparse
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import WSMsgType, web
+
+from chat_engine import IMAGE_PRESETS, MAX_IMAGE_SAMPLES, ChatEngine, message_to_dict
+from image_store import ImageStore, is_image_key
+from metrics import configure_from_env
+from response_cache import ResponseCache, persistent_tier
+
+SESSION_IDLE_TIMEOUT = 30 * 60
+
+
+def message_text(body):
+    """The stripped "text" of a message body, empty when it's missing or not a string"""
+    text = body.get("text")
+    return text.strip() if isinstance(text, str) else ""
+
+
+class ChatServer:
+    """Session registry plus the aiohttp routes around a ChatEngine"""
+
+    def __init__(self, engine, workers=32, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.engine = engine
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat-turn")
+
+    def app(self):
+        app = web.Application()
+        app.add_routes([
+            web.post("/sessions", self.create_session),
+            web.get("/sessions/{session_id}", self.get_session),
+            web.delete("/sessions/{session_id}", self.delete_session),
+            web.post("/sessions/{session_id}/messages", self.post_message),
+            web.post("/sessions/{session_id}/cancel", self.cancel),
+            web.get("/sessions/{session_id}/ws", self.websocket),
+            web.get("/images/{image_ref}", self.get_image),
+            web.get("/sessions/{session_id}/metrics", self.get_session_metrics),
+            web.get("/images/{image_ref}/thumbnail", self.get_thumbnail),
+            web.get("/metrics", self.get_metrics),
+        ])
+        app.on_startup.append(self._start_reaper)
+        app.on_cleanup.append(self._shutdown)
+        return app
+
+    def _session(self, request):
+        session = self.sessions.get(request.match_info["session_id"])
+        if session is None:
+            raise web.HTTPNotFound(text="Unknown session")
+        return session
+
+    async def _json_body(self, request):
+        """The request's JSON object, empty without a body, 400 for anything else"""
+        if not request.can_read_body:
+            return {}
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="Body must be valid JSON")
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text="Body must be a JSON object")
+        return body
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: func(*args, **kwargs))
+
+    async def create_session(self, request):
+        body = await self._json_body(request)
+        session_id = body.get("session_id")
+        if session_id is not None and (not isinstance(session_id, str) or not session_id):
+            raise web.HTTPBadRequest(text="session_id must be a non-empty string")
+        if session_id in self.sessions:
+            raise web.HTTPConflict(text="Session is already active")
+        try:
+            image_samples = int(body.get("image_samples", 1))
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text="image_samples must be a number")
+        image_preset = body.get("image_preset", "standard")
+        if image_preset not in IMAGE_PRESETS:
+            raise web.HTTPBadRequest(text=f"Unknown image preset: {image_preset}")
+
+        session = self.engine.create_session(session_id)
+        gemini_key = body.get("gemini_api_key") or os.environ.get("GEMINI_API_KEY")
+        if gemini_key:
+            try:
+                await self._run(self.engine.configure_gemini, session, gemini_key)
+            except Exception as e:
+                raise web.HTTPBadRequest(text=f"Error initializing Gemini API: {e}")
+        stability_key = body.get("stability_api_key") or os.environ.get("STABLE_DIFFUSION_API_KEY")
+        if stability_key:
+            self.engine.configure_image_generation(session, stability_key)
+        session.cache_chat_turns = bool(body.get("cache_chat_turns", False))
+        session.image_samples = max(1, min(image_samples, MAX_IMAGE_SAMPLES))
+        session.image_preset = image_preset
+        session.refine_drafts = bool(body.get("refine_drafts", False))
+        if session_id and self.engine.writer is not None:
+            # Resuming a stored session, continue from its context summary
+            await self._run(self.engine.restore_context, session)
+
+        # Another request may have taken the id while this one was setting up
+        if session.session_id in self.sessions:
+            raise web.HTTPConflict(text="Session is already active")
+        self.sessions[session.session_id] = session
+        return web.json_response(self._describe(session), status=201)
+
+    def _describe(self, session, include_conversation=False):
+        data = {
+            "session_id": session.session_id,
+            "gemini": session.gemini_initialized,
+            "image_generation": session.image_generation_enabled,
+        }
+        if include_conversation:
+            data["conversation"] = [message_to_dict(m) for m in session.conversation]
+        return data
+
+    async def get_session(self, request):
+        return web.json_response(self._describe(self._session(request), include_conversation=True))
+
+    async def get_session_metrics(self, request):
+        session = self._session(request)
+        tracer = self.engine.tracer
+        return web.json_response({
+            "session_id": session.session_id,
+            "stages": tracer.stats(session.session_id),
+            "recent": tracer.recent_spans(session.session_id, limit=20),
+        })
+
+    async def get_metrics(self, request):
+        text = self.engine.tracer.prometheus() + self.engine.backends.prometheus()
+        return web.Response(text=text, content_type="text/plain")
+
+    async def delete_session(self, request):
+        session = self._session(request)
+        del self.sessions[session.session_id]
+        return web.Response(status=204)
+
+    async def post_message(self, request):
+        session = self._session(request)
+        text = message_text(await self._json_body(request))
+        if not text:
+            raise web.HTTPBadRequest(text="Message text is required")
+        cancel_event = threading.Event()
+        try:
+            message = await self._run(self.engine.handle, session, text, cancel_event=cancel_event)
+        except asyncio.CancelledError:
+            # The client disconnected, don't keep a backend busy for nobody
+            cancel_event.set()
+            raise
+        return web.json_response(message_to_dict(message))
+
+    async def cancel(self, request):
+        self.engine.cancel(self._session(request))
+        return web.Response(status=204)
+
+    async def websocket(self, request):
+        session = self._session(request)
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+
+        # Messages keep being read while a reply streams, so a cancel is seen right away
+        turn = None
+        cancel_event = None
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            try:
+                data = msg.json()
+            except ValueError:
+                data = {}
+            if not isinstance(data, dict):
+                data = {}
+            if data.get("type") == "cancel":
+                if cancel_event is not None:
+                    cancel_event.set()
+                continue
+
+            text = message_text(data)
+            if not text:
+                await ws.send_json({"type": "error", "error": "Message text is required"})
+                continue
+            if turn is not None and not turn.done():
+                await ws.send_json({"type": "error", "error": "A reply is still being generated"})
+                continue
+            cancel_event = threading.Event()
+            turn = asyncio.ensure_future(self._stream_turn(ws, session, text, cancel_event))
+
+        # The client went away, stop the reply nobody will read
+        if turn is not None and not turn.done():
+            cancel_event.set()
+            await asyncio.gather(turn, return_exceptions=True)
+        return ws
+
+    async def _stream_turn(self, ws, session, text, cancel_event):
+        loop = asyncio.get_running_loop()
+
+        # Chunks and images are produced on a worker thread and forwarded in order by the loop
+        chunks = asyncio.Queue()
+
+        def on_chunk(chunk):
+            loop.call_soon_threadsafe(chunks.put_nowait, {"type": "chunk", "text": chunk})
+
+        def on_image(index, image_ref, preset):
+            event = {"type": "image", "index": index, "image_ref": image_ref, "preset": preset}
+            loop.call_soon_threadsafe(chunks.put_nowait, event)
+
+        turn = asyncio.ensure_future(self._run(
+            self.engine.handle, session, text, on_chunk=on_chunk, on_image=on_image, cancel_event=cancel_event
+        ))
+        while not (turn.done() and chunks.empty()):
+            getter = asyncio.ensure_future(chunks.get())
+            await asyncio.wait({getter, turn}, return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                if not ws.closed:
+                    await ws.send_json(getter.result())
+            else:
+                getter.cancel()
+
+        if ws.closed:
+            return
+        try:
+            message = turn.result()
+        except Exception as e:
+            await ws.send_json({"type": "error", "error": str(e)})
+            return
+        await ws.send_json({"type": "message", "message": message_to_dict(message)})
+
+    async def get_image(self, request):
+        image_ref = request.match_info["image_ref"]
+        data = await self._run(self.engine.image_store.get, image_ref) if is_image_key(image_ref) else None
+        if data is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=data, content_type="image/png")
+
+    async def get_thumbnail(self, request):
+        image_ref = request.match_info["image_ref"]
+        data = await self._run(self.engine.image_store.thumbnail, image_ref) if is_image_key(image_ref) else None
+        if data is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=data, content_type="image/jpeg")
+
+    async def _reap_idle_sessions(self):
+        while True:
+            await asyncio.sleep(60)
+            cutoff = time.time() - self.idle_timeout
+            for session_id, session in list(self.sessions.items()):
+                if session.last_active < cutoff:
+                    self.sessions.pop(session_id, None)
+
+    async def _start_reaper(self, app):
+        app["reaper"] = asyncio.ensure_future(self._reap_idle_sessions())
+
+    async def _shutdown(self, app):
+        app["reaper"].cancel()
+        self.executor.shutdown(wait=False)
+        self.engine.backends.close()
+        if self.engine.writer is not None:
+            self.engine.writer.close()
+
+
+def build_engine(image_store_dir, mongodb_connection_string=None):
+    """Engine with the same storage layout as the Streamlit app"""
+    client = None
+    writer = None
+    bucket = None
+    if mongodb_connection_string:
+        import gridfs
+        import pymongo
+
+        from conversation_store import ConversationWriter, ensure_indexes
+
+        client = pymongo.MongoClient(mongodb_connection_string)
+        db = client.assistant_db
+        ensure_indexes(db)
+        writer = ConversationWriter(db.conversations, sessions=db.sessions)
+        bucket = gridfs.GridFSBucket(db, bucket_name="images")
+
+    return ChatEngine(
+        response_cache=ResponseCache(max_entries=4096, backing=persistent_tier(None, client)),
+        image_store=ImageStore(image_store_dir, bucket=bucket),
+        writer=writer,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the chat engine over HTTP and WebSocket")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=32, help="Concurrent turns across all sessions")
+    parser.add_argument("--image-dir", default=os.environ.get("IMAGE_STORE_DIR", "generated_images"))
+    args = parser.parse_args()
+
+    configure_from_env()
+    engine = build_engine(args.image_dir, os.environ.get("MONGODB_CONNECTION_STRING"))
+    web.run_app(ChatServer(engine, workers=args.workers).app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
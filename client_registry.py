@@ -0,0 +1,78 @@
+"""Backend clients shared by every session that uses the same credential.
+
+genai.configure() sets one API key for the whole process, so two sessions
+with different keys overwrite each other and calls go out under whichever
+key was configured last. The registry builds one Gemini client per key
+instead and gives each session a model bound to its own key's client;
+sessions with the same key share the client and its connection. Entries
+are indexed by a hash of the key, so stats and logs never show a key.
+
+Stability keys travel with each request and MongoDB connections are
+already shared per connection string (the app's get_mongo_connection), so
+only Gemini needs this.
+"""
+import asyncio
+import collections
+import hashlib
+import threading
+
+
+def credential_id(secret):
+    """Short, stable name for a credential that doesn't reveal it"""
+    return hashlib.sha256(secret.encode()).hexdigest()[:16]
+
+
+def gemini_async_client(api_key):
+    """Async Gemini client for one key, without touching the SDK's process-wide configuration"""
+    from google.generativeai import client
+
+    manager = client._ClientManager()
+    manager.configure(api_key=api_key)
+    return manager.get_default_client("generative_async")
+
+
+class ClientRegistry:
+    """Gemini clients keyed by API key, at most max_clients kept for reuse"""
+
+    def __init__(self, backends, factory=gemini_async_client, max_clients=256):
+        # Clients are made on the backend loop: gRPC channels belong to the loop they are created on
+        self.backends = backends
+        self.factory = factory
+        self.max_clients = max_clients
+        self.created = 0
+        self._clients = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def gemini_client(self, api_key):
+        """The client for this key, created on first use"""
+        key = credential_id(api_key)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                async def create():
+                    return self.factory(api_key)
+
+                client = asyncio.run_coroutine_threadsafe(create(), self.backends.loop).result()
+                self._clients[key] = client
+                self.created += 1
+                # Sessions keep using an evicted client, it just isn't handed out again
+                while len(self._clients) > self.max_clients:
+                    self._clients.popitem(last=False)
+            else:
+                self._clients.move_to_end(key)
+            return client
+
+    def gemini_model(self, api_key, model_name):
+        """A GenerativeModel whose calls go out under api_key"""
+        # The SDK takes a third of a second to import, so it waits until a key is entered
+        import google.generativeai as genai
+
+        model = genai.GenerativeModel(model_name)
+        # The SDK has no per-model key, so the model gets its client instead of the process-wide default.
+        # The engine only makes async calls; a sync call would find no key configured and fail.
+        model._async_client = self.gemini_client(api_key)
+        return model
+
+    def stats(self):
+        with self._lock:
+            return {"gemini_clients": len(self._clients), "created": self.created}
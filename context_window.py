@@ -0,0 +1,180 @@
+"""Bounded Gemini chat context.
+
+The prompt for each turn is a rolling summary of older turns followed by the
+most recent turns verbatim, trimmed to a token budget. Turns that fall out of
+the window wait in `pending` until they are folded into the summary, which is
+updated incrementally (old summary + new turns -> new summary) so its cost
+doesn't depend on the length of the conversation.
+
+Tokens are estimated from text length (about four characters per token for
+English), which is close enough for budgeting and needs no API round trip.
+"""
+import math
+import threading
+
+CHARS_PER_TOKEN = 4
+
+SUMMARY_PROMPT = """Update the running summary of a conversation between a user and an AI assistant.
+Keep facts, names, preferences, decisions and open questions the assistant may need later.
+Reply with the updated summary only, in at most {words} words.
+
+Current summary:
+{summary}
+
+New turns:
+{turns}"""
+
+
+def estimate_tokens(text):
+    """Rough token count of a text"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+class Turn:
+    """One user message and the model's reply"""
+
+    def __init__(self, user, model, timestamp=None):
+        self.user = user
+        self.model = model
+        self.timestamp = timestamp
+
+    def text(self):
+        return f"User: {self.user}\nAssistant: {self.model}"
+
+
+class ContextWindow:
+    """Rolling summary plus the last turns verbatim, kept under a token budget"""
+
+    def __init__(self, max_tokens=4000, keep_turns=6, summary_tokens=400, count_tokens=estimate_tokens):
+        self.max_tokens = max_tokens
+        self.keep_turns = keep_turns
+        self.summary_tokens = summary_tokens
+        self.count_tokens = count_tokens
+        self.summary = ""
+        # Timestamp of the newest message already folded into the summary
+        self.summarized_through = None
+        self.turns = []
+        self.pending = []
+        # Snippets recalled from past conversations for the current turn only
+        self.recalled = []
+        self.folding = False
+        # Folding runs in the background while new turns keep coming in
+        self._lock = threading.Lock()
+
+    def _summary_contents(self):
+        contents = []
+        if self.summary:
+            contents += [
+                {"role": "user", "parts": [f"Summary of our conversation so far: {self.summary}"]},
+                {"role": "model", "parts": ["Got it, I'll keep that in mind."]},
+            ]
+        if self.recalled:
+            notes = "\n".join(f"- {snippet}" for snippet in self.recalled)
+            contents += [
+                {"role": "user", "parts": [f"Possibly relevant notes from earlier conversations:\n{notes}"]},
+                {"role": "model", "parts": ["Noted, I'll use them if they help."]},
+            ]
+        return contents
+
+    def _tokens(self, turns):
+        return sum(self.count_tokens(t.user) + self.count_tokens(t.model) for t in turns)
+
+    def prompt_tokens(self, query=""):
+        """Estimated size of the prompt sent with the query"""
+        summary = self.count_tokens(self.summary) + sum(self.count_tokens(s) for s in self.recalled)
+        return summary + self._tokens(self.turns) + self.count_tokens(query)
+
+    def fit(self, query, recalled=()):
+        """Move the oldest turns to pending until the prompt fits, returns its estimated size"""
+        with self._lock:
+            self.recalled = list(recalled)
+            while self.turns and (
+                len(self.turns) > self.keep_turns or self.prompt_tokens(query) > self.max_tokens
+            ):
+                self.pending.append(self.turns.pop(0))
+            return self.prompt_tokens(query)
+
+    def history(self):
+        """Chat history for the model: the summary exchange, then the verbatim turns"""
+        with self._lock:
+            contents = self._summary_contents()
+            turns = list(self.turns)
+        for turn in turns:
+            contents.append({"role": "user", "parts": [turn.user]})
+            contents.append({"role": "model", "parts": [turn.model]})
+        return contents
+
+    def add_turn(self, user, model, timestamp=None):
+        with self._lock:
+            self.turns.append(Turn(user, model, timestamp))
+
+    def stamp(self, timestamp):
+        """Set the storage timestamp of turns added since the last call"""
+        for turn in reversed(self.turns):
+            if turn.timestamp is not None:
+                break
+            turn.timestamp = timestamp
+
+    def start_fold(self):
+        """Claim the pending turns for folding, None if there are none or a fold is running"""
+        with self._lock:
+            if self.folding or not self.pending:
+                return None
+            self.folding = True
+            return list(self.pending)
+
+    def summary_prompt(self, turns):
+        """Prompt asking the model to fold turns into the summary"""
+        return SUMMARY_PROMPT.format(
+            words=int(self.summary_tokens * 0.75),
+            summary=self.summary or "(none yet)",
+            turns="\n\n".join(turn.text() for turn in turns),
+        )
+
+    def fallback_summary(self, turns):
+        """Summary update without a model: the start of each turn appended to the old summary"""
+        notes = [f"User asked: {turn.user[:160]} Assistant answered: {turn.model[:160]}" for turn in turns]
+        return " ".join([self.summary] + notes).strip()
+
+    def fold(self, summary, turns):
+        """Replace the summary with one that also covers the given (claimed) turns"""
+        # Keep the most recent part if the new summary overshoots its budget
+        max_chars = self.summary_tokens * CHARS_PER_TOKEN
+        with self._lock:
+            self.summary = summary.strip()[-max_chars:]
+            stamps = [turn.timestamp for turn in turns if turn.timestamp is not None]
+            if stamps:
+                self.summarized_through = max(stamps)
+            self.pending = self.pending[len(turns):]
+            self.folding = False
+
+    def restore(self, summary, summarized_through, messages):
+        """Rebuild the window from a stored summary and the messages stored after it"""
+        turns = []
+        user = None
+        for message in messages:
+            if message["role"] == "user":
+                user = message
+            elif user is not None and message.get("content"):
+                turns.append(Turn(user["content"], message["content"], message.get("timestamp")))
+                user = None
+        with self._lock:
+            self.summary = summary or ""
+            self.summarized_through = summarized_through
+            self.turns = turns
+            self.pending = []
+        self.fit("")
+
+    def window_texts(self):
+        """Texts already in the prompt verbatim, recalling them again would be redundant"""
+        with self._lock:
+            return {text for turn in self.turns for text in (turn.user, turn.model)}
+
+    def stats(self):
+        return {
+            "summary_tokens": self.count_tokens(self.summary),
+            "recalled": len(self.recalled),
+            "turns": len(self.turns),
+            "pending": len(self.pending),
+            "prompt_tokens": self.prompt_tokens(),
+        }
@@ -0,0 +1,467 @@
+"""Bulk export and import of the conversations collection.
+
+An export is a directory: message documents in numbered part files of at
+most chunk_size messages each, as NDJSON (MongoDB extended JSON, one message
+per line) or Parquet (one column per message field, anything else as
+extended JSON in `extra`), the image bytes they refer to as sidecar files
+under images/, and manifest.json listing the finished parts.
+
+    manifest.json
+    messages-00000.ndjson    or messages-00000.parquet
+    images/ab/ab12...        content addressed, like ImageStore
+
+Messages are read in _id order, one query per part (the app's _ids are all
+ObjectIds, which sort by creation time), so memory stays at one chunk
+whatever the collection size. A part is written
+to a temp file and only listed in the manifest once it is complete; an
+interrupted export resumes after the last listed part's _id.
+
+Images referenced by image_ref/image_refs are copied from an ImageStore
+(local files, then GridFS) when one is given. Legacy inline data URLs in
+image_url are moved to the sidecar files too and replaced by image_file and
+image_mime, so part files only hold text.
+
+Imports keep every message's _id and insert each chunk unordered, skipping
+messages that are already there, so importing twice (or resuming an import
+that stopped halfway through a part) never duplicates anything. Finished
+parts are recorded in the target database's `imports` collection, and the
+sessions catalog is updated for the messages actually inserted.
+
+    python conversation_export.py export backup/ --format parquet
+    python conversation_export.py import backup/ --mongo mongodb://other-host
+"""
+import argparse
+import base64
+import binascii
+import datetime
+import json
+import os
+import tempfile
+import time
+import uuid
+
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError
+
+from conversation_store import DUPLICATE_KEY, catalog_updates
+
+FORMATS = ("ndjson", "parquet")
+MANIFEST = "manifest.json"
+CHUNK_SIZE = 10000
+VERSION = 1
+
+# Parquet columns and the Python type their values must have, anything else goes to `extra`
+PARQUET_COLUMNS = {
+    "_id": str,
+    "session_id": str,
+    "role": str,
+    "content": str,
+    "timestamp": datetime.datetime,
+    "image_ref": str,
+    "image_refs": list,
+    "image_file": str,
+    "image_mime": str,
+    "job_id": str,
+}
+
+_JSON_OPTIONS = json_util.JSONOptions(json_mode=json_util.JSONMode.RELAXED, tz_aware=False)
+
+
+class ExportError(Exception):
+    """The export directory is missing, damaged or doesn't match the requested format"""
+
+
+def _parquet():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ExportError("Parquet needs the pyarrow package (pip install pyarrow)") from None
+    return pyarrow, pyarrow.parquet
+
+
+def _parquet_schema(pa):
+    return pa.schema([
+        ("_id", pa.string()),
+        ("session_id", pa.string()),
+        ("role", pa.string()),
+        ("content", pa.string()),
+        ("timestamp", pa.timestamp("ms")),
+        ("image_ref", pa.string()),
+        ("image_refs", pa.list_(pa.string())),
+        ("image_file", pa.string()),
+        ("image_mime", pa.string()),
+        ("job_id", pa.string()),
+        ("extra", pa.string()),
+    ])
+
+
+# Sidecar images
+
+def _sidecar_path(directory, key):
+    """Path of an image's sidecar file, None for a key that isn't an image key (and could leave the directory)"""
+    from image_store import is_image_key
+
+    if not is_image_key(key):
+        return None
+    return os.path.join(directory, "images", key[:2], key)
+
+
+def _write_atomic(path, data, mode="wb"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, mode) as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _parse_data_url(value):
+    """(mime, bytes) of a base64 data URL, or None for anything else"""
+    if not isinstance(value, str) or not value.startswith("data:"):
+        return None
+    header, _, payload = value.partition(",")
+    if not header.endswith(";base64"):
+        return None
+    try:
+        return header[5:-7] or "application/octet-stream", base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def _image_refs(doc):
+    refs = doc.get("image_refs")
+    if isinstance(refs, list):
+        return [ref for ref in refs if isinstance(ref, str)]
+    return [doc["image_ref"]] if isinstance(doc.get("image_ref"), str) else []
+
+
+# Documents to records and back
+
+def to_record(doc, directory, image_store=None, stats=None):
+    """Export form of a message document, writing its images to the sidecar directory"""
+    from image_store import image_key
+
+    stats = stats if stats is not None else {}
+    record = dict(doc)
+    inline = _parse_data_url(record.get("image_url"))
+    if inline is not None:
+        mime, data = inline
+        key = image_key(data)
+        path = _sidecar_path(directory, key)
+        if not os.path.exists(path):
+            _write_atomic(path, data)
+        del record["image_url"]
+        record["image_file"] = key
+        record["image_mime"] = mime
+        stats["images"] = stats.get("images", 0) + 1
+
+    for key in _image_refs(doc):
+        path = _sidecar_path(directory, key)
+        if path is not None and os.path.exists(path):
+            continue
+        data = image_store.get(key) if image_store is not None and path is not None else None
+        if data is None:
+            stats["missing_images"] = stats.get("missing_images", 0) + 1
+            continue
+        _write_atomic(path, data)
+        stats["images"] = stats.get("images", 0) + 1
+    return record
+
+
+def from_record(record, directory, image_store=None, stats=None, imported_keys=None):
+    """Message document for an exported record, storing its sidecar images"""
+    stats = stats if stats is not None else {}
+    doc = dict(record)
+    key = doc.pop("image_file", None)
+    mime = doc.pop("image_mime", None)
+    if key is not None:
+        path = _sidecar_path(directory, key)
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as f:
+                payload = base64.b64encode(f.read()).decode()
+            doc["image_url"] = f"data:{mime or 'application/octet-stream'};base64,{payload}"
+        else:
+            stats["missing_images"] = stats.get("missing_images", 0) + 1
+
+    if image_store is not None:
+        for ref in _image_refs(doc):
+            if imported_keys is not None and ref in imported_keys:
+                continue
+            path = _sidecar_path(directory, ref)
+            if path is not None and os.path.exists(path):
+                with open(path, "rb") as f:
+                    image_store.put(f.read())
+                stats["images"] = stats.get("images", 0) + 1
+            else:
+                stats["missing_images"] = stats.get("missing_images", 0) + 1
+            if imported_keys is not None:
+                imported_keys.add(ref)
+    return doc
+
+
+def _parquet_row(record):
+    row, extra = {}, {}
+    for field, value in record.items():
+        kind = PARQUET_COLUMNS.get(field)
+        if field == "_id" and isinstance(value, ObjectId):
+            row["_id"] = str(value)
+        elif kind is list and isinstance(value, list) and value and all(isinstance(item, str) for item in value):
+            row[field] = value
+        elif kind is not None and kind is not list and isinstance(value, kind) and field != "_id":
+            row[field] = value
+        else:
+            extra[field] = value
+    row["extra"] = json_util.dumps(extra, json_options=_JSON_OPTIONS) if extra else None
+    return row
+
+
+def _from_parquet_row(row):
+    record = {}
+    extra = row.pop("extra", None)
+    for field, value in row.items():
+        if value is None:
+            continue
+        record[field] = ObjectId(value) if field == "_id" else value
+    if extra:
+        record.update(json_util.loads(extra, json_options=_JSON_OPTIONS))
+    return record
+
+
+# Part files
+
+def _part_name(index, fmt):
+    return f"messages-{index:05d}.{fmt}"
+
+
+def _write_part(path, records, fmt):
+    """Write one part to a temp file and move it into place"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        if fmt == "ndjson":
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json_util.dumps(record, json_options=_JSON_OPTIONS))
+                    f.write("\n")
+        else:
+            os.close(fd)
+            pa, pq = _parquet()
+            schema = _parquet_schema(pa)
+            rows = [_parquet_row(record) for record in records]
+            table = pa.Table.from_pydict({name: [row.get(name) for row in rows] for name in schema.names}, schema)
+            pq.write_table(table, tmp_path, compression="zstd")
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_part(path, chunk_size=CHUNK_SIZE):
+    """Records of one part file, in batches of at most chunk_size"""
+    if path.endswith(".ndjson"):
+        batch = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    batch.append(json_util.loads(line, json_options=_JSON_OPTIONS))
+                if len(batch) == chunk_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+    else:
+        _, pq = _parquet()
+        for table in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield [_from_parquet_row(row) for row in table.to_pylist()]
+
+
+def load_manifest(directory):
+    """The export's manifest, or None when the directory has none"""
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_manifest(directory, manifest):
+    _write_atomic(os.path.join(directory, MANIFEST), json.dumps(manifest, indent=1), mode="w")
+
+
+# Export and import
+
+def export_conversations(db, directory, fmt="ndjson", chunk_size=CHUNK_SIZE, image_store=None, resume=True,
+                         on_part=None):
+    """Write every message of db.conversations to directory, returns counters.
+
+    With resume, an unfinished export in the directory is continued after
+    its last complete part; otherwise the directory must not hold one.
+    on_part(part) is called after each part is listed in the manifest.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt!r}, expected one of {', '.join(FORMATS)}")
+    if fmt == "parquet":
+        _parquet()
+    os.makedirs(directory, exist_ok=True)
+
+    manifest = load_manifest(directory)
+    if manifest is not None and not resume:
+        raise ExportError(f"{directory} already holds an export, pass resume or use another directory")
+    if manifest is not None and manifest["format"] != fmt:
+        raise ExportError(f"{directory} holds a {manifest['format']} export, not {fmt}")
+    if manifest is None:
+        manifest = {
+            "version": VERSION,
+            "export_id": uuid.uuid4().hex,
+            "format": fmt,
+            "collection": db.conversations.full_name,
+            "started_at": datetime.datetime.now().isoformat(),
+            "complete": False,
+            "messages": 0,
+            "parts": [],
+        }
+        _save_manifest(directory, manifest)
+
+    stats = {"messages": 0, "parts": 0, "images": 0, "missing_images": 0}
+    if manifest["complete"]:
+        return stats
+    # Parts that were being written when an earlier run stopped
+    for name in os.listdir(directory):
+        if name.endswith(".tmp"):
+            os.remove(os.path.join(directory, name))
+
+    last_id = json_util.loads(manifest["parts"][-1]["last_id"]) if manifest["parts"] else None
+    while True:
+        # One short query per part, paged by _id, rather than a cursor kept open for the whole export
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        records = [to_record(doc, directory, image_store, stats)
+                   for doc in db.conversations.find(query).sort("_id", 1).limit(chunk_size)]
+        if not records:
+            break
+        part = {
+            "file": _part_name(len(manifest["parts"]), fmt),
+            "messages": len(records),
+            "last_id": json_util.dumps(records[-1]["_id"]),
+        }
+        _write_part(os.path.join(directory, part["file"]), records, fmt)
+        manifest["parts"].append(part)
+        manifest["messages"] += len(records)
+        _save_manifest(directory, manifest)
+        stats["messages"] += len(records)
+        stats["parts"] += 1
+        last_id = records[-1]["_id"]
+        if on_part is not None:
+            on_part(part)
+
+    manifest["complete"] = True
+    manifest["finished_at"] = datetime.datetime.now().isoformat()
+    _save_manifest(directory, manifest)
+    return stats
+
+
+def import_conversations(db, directory, chunk_size=CHUNK_SIZE, image_store=None, resume=True, on_part=None):
+    """Insert the messages of an export into db.conversations, returns counters.
+
+    Messages keep their _id and ones already present are skipped. With
+    resume, parts recorded as imported into this database are not read
+    again. on_part(part) is called after each part is recorded.
+    """
+    manifest = load_manifest(directory)
+    if manifest is None:
+        raise ExportError(f"{directory} has no {MANIFEST}")
+    if manifest.get("version", VERSION) > VERSION:
+        raise ExportError(f"{directory} was written by a newer version (format {manifest['version']})")
+    if not manifest["complete"]:
+        raise ExportError(f"The export in {directory} is unfinished, resume it before importing")
+
+    progress = db.imports.find_one({"_id": manifest["export_id"]}) if resume else None
+    done = set((progress or {}).get("parts", []))
+    stats = {"messages": 0, "inserted": 0, "duplicates": 0, "failed": 0, "parts": 0, "images": 0,
+             "missing_images": 0}
+    imported_keys = set()
+
+    for part in manifest["parts"]:
+        if part["file"] in done:
+            continue
+        for records in read_part(os.path.join(directory, part["file"]), chunk_size):
+            docs = [from_record(record, directory, image_store, stats, imported_keys) for record in records]
+            failed = set()
+            try:
+                db.conversations.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    failed.add(error["index"])
+                    if error.get("code") == DUPLICATE_KEY:
+                        stats["duplicates"] += 1
+                    else:
+                        stats["failed"] += 1
+            inserted = [doc for i, doc in enumerate(docs) if i not in failed]
+            if inserted:
+                try:
+                    db.sessions.bulk_write(catalog_updates(inserted), ordered=True)
+                except Exception as e:
+                    # The messages are in, the catalog can be rebuilt from them (rebuild_session_catalog)
+                    stats["catalog_error"] = f"Session catalog update failed: {e}"
+            stats["messages"] += len(docs)
+            stats["inserted"] += len(inserted)
+
+        db.imports.update_one(
+            {"_id": manifest["export_id"]},
+            {"$addToSet": {"parts": part["file"]}, "$set": {"updated_at": datetime.datetime.now()}},
+            upsert=True,
+        )
+        stats["parts"] += 1
+        if on_part is not None:
+            on_part(part)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import the conversations collection")
+    parser.add_argument("command", choices=("export", "import"))
+    parser.add_argument("directory", help="Export directory")
+    parser.add_argument("--mongo", default=os.environ.get("MONGODB_CONNECTION_STRING"))
+    parser.add_argument("--db", default="assistant_db")
+    parser.add_argument("--format", choices=FORMATS, default="ndjson", help="Part file format of a new export")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Messages per part and per insert")
+    parser.add_argument("--image-dir", default=os.environ.get("IMAGE_STORE_DIR", "generated_images"))
+    parser.add_argument("--no-images", action="store_true", help="Skip image_ref images")
+    parser.add_argument("--restart", action="store_true", help="Don't resume an earlier run")
+    args = parser.parse_args()
+    if not args.mongo:
+        parser.error("--mongo or MONGODB_CONNECTION_STRING is required")
+
+    import gridfs
+    import pymongo
+
+    from conversation_store import ensure_indexes
+    from image_store import ImageStore
+
+    db = pymongo.MongoClient(args.mongo)[args.db]
+    image_store = None
+    if not args.no_images:
+        image_store = ImageStore(args.image_dir, bucket=gridfs.GridFSBucket(db, bucket_name="images"))
+
+    def report(part):
+        print(f"  {part['file']}: {part['messages']} messages")
+
+    started = time.perf_counter()
+    try:
+        if args.command == "export":
+            stats = export_conversations(db, args.directory, args.format, args.chunk_size, image_store,
+                                         resume=not args.restart, on_part=report)
+        else:
+            stats = import_conversations(db, args.directory, args.chunk_size, image_store,
+                                         resume=not args.restart, on_part=report)
+            # Indexes are built once at the end rather than updated by every insert
+            ensure_indexes(db)
+    except ExportError as e:
+        raise SystemExit(str(e))
+    elapsed = time.perf_counter() - started
+    rate = stats["messages"] / elapsed if elapsed else 0
+    print(f"{args.command.capitalize()}ed {stats['messages']} messages in {elapsed:.1f}s ({rate:.0f}/s): "
+          + ", ".join(f"{name} {value}" for name, value in stats.items() if name != "messages"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+"""MongoDB persistence for conversation messages.
+
+ConversationWriter is a write-behind queue: the app hands it message documents
+and returns immediately, while a background thread batches them into unordered
+insert_many calls. Every document gets its _id when it is queued, so a batch
+retried after a transient failure can't insert the same message twice.
+
+The writer also maintains the `sessions` catalog (one small document per
+session) so listing sessions never has to scan the messages themselves.
+"""
+import queue
+import threading
+import time
+import weakref
+
+import pymongo
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, PyMongoError
+
+from metrics import get_tracer
+from search_index import highlight, tokenize
+
+DUPLICATE_KEY = 11000
+TITLE_LENGTH = 80
+
+# Writers still alive in this process, drained by close_all_writers at exit
+_writers = weakref.WeakSet()
+
+
+def is_transient(error):
+    """Network blips and elections are worth retrying, anything else is not"""
+    if isinstance(error, ConnectionFailure):
+        return True
+    return isinstance(error, PyMongoError) and (
+        error.has_error_label("RetryableWriteError") or error.has_error_label("TransientTransactionError")
+    )
+
+
+def ensure_indexes(db):
+    """Create the indexes the app's queries rely on, a no-op when they already exist"""
+    db.conversations.create_index([("session_id", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)])
+    # Full-text search across sessions, see search_messages
+    db.conversations.create_index([("content", pymongo.TEXT)], name="content_text", default_language="english")
+    db.sessions.create_index([("updated_at", pymongo.DESCENDING)])
+
+
+def rebuild_session_catalog(db):
+    """Backfill the sessions catalog from existing messages (one-off, server side)"""
+    db.conversations.aggregate([
+        {"$group": {
+            "_id": "$session_id",
+            "created_at": {"$min": "$timestamp"},
+            "updated_at": {"$max": "$timestamp"},
+            "message_count": {"$sum": 1},
+        }},
+        {"$merge": {"into": "sessions", "whenMatched": "merge", "whenNotMatched": "insert"}},
+    ])
+    # Titles come from each session's first user message
+    db.conversations.aggregate([
+        {"$match": {"role": "user"}},
+        {"$sort": {"session_id": 1, "timestamp": 1}},
+        {"$group": {"_id": "$session_id", "title": {"$first": {"$substrCP": ["$content", 0, TITLE_LENGTH]}}}},
+        {"$merge": {"into": "sessions", "whenMatched": "merge", "whenNotMatched": "discard"}},
+    ])
+
+
+def list_sessions(db, page=0, page_size=20):
+    """One page of the session catalog, most recently updated first, returns (sessions, has_more)"""
+    cursor = db.sessions.find().sort("updated_at", pymongo.DESCENDING).skip(page * page_size).limit(page_size + 1)
+    sessions = [
+        {
+            "session_id": doc["_id"],
+            "title": doc.get("title"),
+            "created_at": doc.get("created_at"),
+            "updated_at": doc.get("updated_at"),
+            "message_count": doc.get("message_count", 0),
+        }
+        for doc in cursor
+    ]
+    return sessions[:page_size], len(sessions) > page_size
+
+
+def load_history_page(collection, session_id, before=None, limit=50):
+    """Latest messages of a session older than the (timestamp, _id) cursor, without image payloads.
+
+    Returns (messages oldest first, has_more). Image references are small and
+    kept, while messages with a legacy inline image_url carry has_image so the
+    payload can be fetched on demand with load_message_image.
+    """
+    match = {"session_id": session_id}
+    if before is not None:
+        timestamp, message_id = before
+        match["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lt": message_id}},
+        ]
+    docs = list(collection.aggregate([
+        {"$match": match},
+        {"$sort": {"timestamp": -1, "_id": -1}},
+        {"$limit": limit + 1},
+        {"$project": {
+            "role": 1,
+            "content": 1,
+            "timestamp": 1,
+            "image_ref": 1,
+            "image_refs": 1,
+            "job_id": 1,
+            "has_image": {"$gt": ["$image_url", None]},
+        }},
+    ]))
+    has_more = len(docs) > limit
+    messages = []
+    for doc in reversed(docs[:limit]):
+        message = {"role": doc["role"], "content": doc["content"], "_id": doc["_id"], "timestamp": doc["timestamp"]}
+        if "image_ref" in doc:
+            message["image_ref"] = doc["image_ref"]
+            if "image_refs" in doc:
+                message["image_refs"] = doc["image_refs"]
+        elif doc.get("has_image"):
+            message["has_image"] = True
+        if "job_id" in doc:
+            message["job_id"] = doc["job_id"]
+        messages.append(message)
+    return messages, has_more
+
+
+def search_messages(collection, query, session_id=None, role=None, since=None, until=None, page=0, page_size=20,
+                    index=None):
+    """One page of messages containing every word of the query, newest first, returns (results, has_more).
+
+    Searches all sessions unless session_id is given; since is inclusive and
+    until exclusive. Uses the collection's text index, or a SearchIndex when
+    one is passed (e.g. for mongomock, which has no $text). Results carry the
+    message's session, role and timestamp plus a snippet with the matched
+    words in **bold**. Image payloads are never read.
+    """
+    terms = tokenize(query)
+    if not terms:
+        return [], False
+    projection = {"session_id": 1, "role": 1, "content": 1, "timestamp": 1, "image_ref": 1}
+
+    if index is not None:
+        hits, total = index.search(query, session_id=session_id, role=role, since=since, until=until,
+                                   offset=page * page_size, limit=page_size)
+        docs = {doc["_id"]: doc for doc in collection.find({"_id": {"$in": [hit["_id"] for hit in hits]}}, projection)}
+        # A message can't vanish from the index, but it can from the collection
+        ordered = [docs[hit["_id"]] for hit in hits if hit["_id"] in docs]
+        has_more = total > (page + 1) * page_size
+    else:
+        # Quoted terms must all be present, unquoted ones would match any of them
+        match = {"$text": {"$search": " ".join(f'"{term}"' for term in terms)}}
+        if session_id is not None:
+            match["session_id"] = session_id
+        if role is not None:
+            match["role"] = role
+        if since is not None or until is not None:
+            match["timestamp"] = {}
+            if since is not None:
+                match["timestamp"]["$gte"] = since
+            if until is not None:
+                match["timestamp"]["$lt"] = until
+        cursor = collection.find(match, projection) \
+            .sort([("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]) \
+            .skip(page * page_size).limit(page_size + 1)
+        ordered = list(cursor)
+        has_more = len(ordered) > page_size
+        ordered = ordered[:page_size]
+
+    results = []
+    for doc in ordered:
+        result = {
+            "_id": doc["_id"],
+            "session_id": doc["session_id"],
+            "role": doc["role"],
+            "timestamp": doc["timestamp"],
+            "snippet": highlight(doc.get("content") or "", terms),
+        }
+        if "image_ref" in doc:
+            result["image_ref"] = doc["image_ref"]
+        results.append(result)
+    return results, has_more
+
+
+def load_context(collection, sessions, session_id, limit=100):
+    """Stored context summary of a session and the messages after it.
+
+    Returns (summary, summarized_through, messages oldest first). Only the
+    latest `limit` messages are read, older ones should already be covered
+    by the summary.
+    """
+    doc = sessions.find_one({"_id": session_id}, {"context": 1}) if sessions is not None else None
+    context = (doc or {}).get("context") or {}
+    summarized_through = context.get("through")
+
+    match = {"session_id": session_id}
+    if summarized_through is not None:
+        match["timestamp"] = {"$gt": summarized_through}
+    docs = collection.find(match, {"role": 1, "content": 1, "timestamp": 1}) \
+        .sort([("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]).limit(limit)
+    messages = [
+        {"role": doc["role"], "content": doc["content"], "timestamp": doc["timestamp"]}
+        for doc in reversed(list(docs))
+    ]
+    return context.get("summary", ""), summarized_through, messages
+
+
+def save_context_summary(sessions, session_id, summary, through):
+    """Store a session's rolling context summary in its catalog entry"""
+    sessions.update_one(
+        {"_id": session_id},
+        {"$set": {"context": {"summary": summary, "through": through}}},
+    )
+
+
+def load_message_image(collection, message_id):
+    """Image payload of a single message, or None"""
+    doc = collection.find_one({"_id": message_id}, {"image_url": 1})
+    return doc.get("image_url") if doc else None
+
+
+def catalog_updates(documents):
+    """Session catalog upserts for a batch of stored messages"""
+    sessions = {}
+    for doc in documents:
+        entry = sessions.setdefault(doc["session_id"], {
+            "first": doc["timestamp"], "last": doc["timestamp"], "count": 0, "title": None,
+        })
+        entry["first"] = min(entry["first"], doc["timestamp"])
+        entry["last"] = max(entry["last"], doc["timestamp"])
+        entry["count"] += 1
+        if entry["title"] is None and doc.get("role") == "user" and doc.get("content"):
+            entry["title"] = doc["content"][:TITLE_LENGTH]
+
+    updates = []
+    for session_id, entry in sessions.items():
+        updates.append(UpdateOne(
+            {"_id": session_id},
+            {
+                "$setOnInsert": {"created_at": entry["first"]},
+                "$max": {"updated_at": entry["last"]},
+                "$inc": {"message_count": entry["count"]},
+            },
+            upsert=True,
+        ))
+        if entry["title"]:
+            # Only the first user message names the session
+            updates.append(UpdateOne({"_id": session_id, "title": None}, {"$set": {"title": entry["title"]}}))
+    return updates
+
+
+class ConversationWriter:
+    """Batches message inserts on a background thread"""
+
+    def __init__(self, collection, sessions=None, batch_size=50, flush_interval=0.25, max_retries=5,
+                 retry_backoff=0.2):
+        self.collection = collection
+        self.sessions = sessions
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+        self._queue = queue.Queue()
+        self._closed = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "written": 0,
+            "failed": 0,
+            "batches": 0,
+            "retries": 0,
+            "last_flush_ms": None,
+            "max_flush_ms": None,
+            "total_flush_ms": 0.0,
+            "last_error": None,
+        }
+
+        self._thread = threading.Thread(target=self._run, name="mongo-writer", daemon=True)
+        self._thread.start()
+        _writers.add(self)
+
+    def put(self, document):
+        """Queue a message document for insertion, returns its _id"""
+        if self._closed.is_set():
+            raise RuntimeError("ConversationWriter is closed")
+        document.setdefault("_id", ObjectId())
+        self._queue.put(document)
+        return document["_id"]
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def flush(self, timeout=5):
+        """Wait until everything queued so far has been written, returns False on timeout"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() > deadline or not self._thread.is_alive():
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self, timeout=10):
+        """Stop accepting messages and drain the queue"""
+        self._closed.set()
+        self._thread.join(timeout=timeout)
+        _writers.discard(self)
+        return not self._thread.is_alive()
+
+    def save_context(self, session_id, summary, through, timeout=5):
+        """Store a session's context summary once the messages it covers are written"""
+        if self.sessions is None:
+            return False
+        # The catalog entry is created by the message writes, so let those land first
+        self.flush(timeout)
+        self._with_retries(lambda: save_context_summary(self.sessions, session_id, summary, through))
+        return True
+
+    def update(self, message_id, fields, timeout=5):
+        """Change a stored message, e.g. a placeholder filled in by a background job"""
+        # The message itself may still be queued, let its insert land first
+        self.flush(timeout)
+        with get_tracer().span("mongo_update"):
+            self._with_retries(lambda: self.collection.update_one({"_id": message_id}, {"$set": fields}))
+
+    def stats(self):
+        """Queue depth plus write and flush latency counters"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        batches = stats.pop("batches")
+        total_flush_ms = stats.pop("total_flush_ms")
+        stats["batches"] = batches
+        stats["avg_flush_ms"] = round(total_flush_ms / batches, 1) if batches else None
+        stats["queue_depth"] = self.queue_depth
+        return stats
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                if self._closed.is_set():
+                    return
+                continue
+
+            # Collect until the batch is full or the oldest message has waited long enough
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        started_at = time.perf_counter()
+        failed, error = [], None
+        try:
+            self._with_retries(lambda: self.collection.insert_many(batch, ordered=False))
+        except BulkWriteError as e:
+            # Duplicate keys mean an earlier attempt already stored the message
+            failed = [w for w in e.details.get("writeErrors", []) if w.get("code") != DUPLICATE_KEY]
+            error = failed[0].get("errmsg") if failed else None
+        except Exception as e:
+            failed = [{"index": i} for i in range(len(batch))]
+            error = str(e)
+
+        failed_indexes = {w.get("index") for w in failed}
+        stored = [doc for i, doc in enumerate(batch) if i not in failed_indexes]
+        if stored and self.sessions is not None:
+            try:
+                self._with_retries(lambda: self.sessions.bulk_write(catalog_updates(stored), ordered=True))
+            except Exception as e:
+                error = f"Session catalog update failed: {e}"
+
+        elapsed = time.perf_counter() - started_at
+        get_tracer().record("mongo_write", elapsed, error=error, documents=len(batch), failed=len(failed))
+        flush_ms = round(elapsed * 1000, 1)
+        with self._stats_lock:
+            self._stats["written"] += len(stored)
+            self._stats["failed"] += len(failed)
+            self._stats["batches"] += 1
+            self._stats["last_flush_ms"] = flush_ms
+            self._stats["max_flush_ms"] = max(self._stats["max_flush_ms"] or 0, flush_ms)
+            self._stats["total_flush_ms"] += flush_ms
+            if error:
+                self._stats["last_error"] = error
+
+    def _with_retries(self, operation):
+        attempt = 0
+        while True:
+            try:
+                return operation()
+            except BulkWriteError:
+                raise
+            except Exception as e:
+                if not is_transient(e) or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                with self._stats_lock:
+                    self._stats["retries"] += 1
+                time.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+
+
+def close_all_writers(timeout=10):
+    """Drain every live writer, used from the app's atexit cleanup"""
+    for writer in list(_writers):
+        writer.close(timeout=timeout)
@@ -1,90 +1,210 @@
 import streamlit as st
-import pyttsx3
-import speech_recognition as sr
 import datetime
-import wikipedia
-import webbrowser
+import logging
 import os
 import smtplib
-import google.generativeai as genai
-import threading
+import sys
 import time
-from io import BytesIO
-import base64
-import pymongo
 import uuid
-import queue
-import requests
-from PIL import Image
-import io
+import re
+from speech_engine import get_speech_service
+from speech_output import PyAudioSink, SpeechPipeline
+from audio_cache import AudioCache
+from image_store import ImageStore
+from response_cache import ResponseCache, persistent_tier
+from chat_engine import IMAGE_PRESETS, MAX_IMAGE_SAMPLES, ChatEngine
+from memory_index import MemoryIndex
+from job_queue import JobQueue, close_all_queues
+from metrics import configure_from_env, get_tracer, serve_metrics
+# The MongoDB driver, Gemini SDK and speech recognition are imported where they are first used,
+# so the first page doesn't wait for SDKs the user may never turn on
 
 # Set page config
 st.set_page_config(page_title="Voice Assistant", layout="wide")
 
+# Conversation history windowing
+HISTORY_PAGE_SIZE = 50  # Messages fetched from MongoDB per page
+RENDER_WINDOW = 30  # Messages rendered in the chat container by default
+MAX_LOADED_MESSAGES = 200  # Older persisted messages are dropped from memory past this
+SEARCH_PAGE_SIZE = 10  # Search results shown per page
+
+# Generated images are kept on disk (and in GridFS when MongoDB is connected)
+IMAGE_STORE_DIR = os.environ.get("IMAGE_STORE_DIR", "generated_images")
+
+# Backend responses are cached in memory and in MongoDB when MONGODB_CONNECTION_STRING is set,
+# otherwise in SQLite unless this is set to an empty string
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+MEMORY_INDEX_DIR = os.environ.get("MEMORY_INDEX_DIR", "memory_index")
+# Synthesized speech is kept in memory and, unless this is set to an empty string, as WAV files on disk
+TTS_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", "tts_cache")
+# Background jobs are recorded in SQLite, unless this is set to an empty string
+JOB_DB_PATH = os.environ.get("JOB_DB_PATH", "jobs.sqlite3")
+MAX_JOBS_PER_SESSION = 2
+JOB_POLL_SECONDS = 1.0
+# Prometheus metrics are served on this port when it is set, TRACE_LOG writes spans as JSON lines
+METRICS_PORT = os.environ.get("METRICS_PORT", "")
+
+# MongoDB client and message writer, shared by every session that uses the same connection string
+@st.cache_resource(show_spinner=False)
+def get_mongo_connection(connection_string):
+    import pymongo
+    from conversation_store import ConversationWriter, ensure_indexes, rebuild_session_catalog
+
+    client = pymongo.MongoClient(connection_string)
+    # Test the connection
+    client.admin.command('ping')
+    db = client.assistant_db
+    ensure_indexes(db)
+    # Older databases only have messages, build the session catalog from them once
+    if db.sessions.estimated_document_count() == 0 and db.conversations.estimated_document_count() > 0:
+        rebuild_session_catalog(db)
+    # Messages are written in batches off the request path, the writer keeps the catalog in sync
+    return client, ConversationWriter(db.conversations, sessions=db.sessions)
+
+# Response cache shared by every session in the process
+@st.cache_resource
+def get_response_cache():
+    client = None
+    connection_string = os.environ.get("MONGODB_CONNECTION_STRING")
+    if connection_string:
+        from pymongo.errors import PyMongoError
+
+        # The app's own client, persistent_tier falls back to SQLite if the server can't be reached
+        try:
+            client, _ = get_mongo_connection(connection_string)
+        except PyMongoError as e:
+            logging.getLogger("genai_chatbot.response_cache").warning(
+                "MongoDB is unavailable, caching responses locally instead: %s", e)
+    return ResponseCache(max_entries=1024, backing=persistent_tier(RESPONSE_CACHE_PATH, client))
+
+# Background jobs shared by every session in the process, so they keep running across reruns
+@st.cache_resource
+def get_job_queue():
+    return JobQueue(JOB_DB_PATH or None, workers=4, max_per_session=MAX_JOBS_PER_SESSION)
+
+# Chat engine shared by every session in the process, per-user state lives in a ChatSession
+@st.cache_resource
+def get_chat_engine():
+    # The app runs on the user's machine, so "open ..." commands open tabs locally
+    return ChatEngine(
+        response_cache=get_response_cache(),
+        image_store=ImageStore(IMAGE_STORE_DIR),
+        memory=MemoryIndex(MEMORY_INDEX_DIR) if MEMORY_INDEX_DIR else None,
+        open_urls=True,
+        jobs=get_job_queue()
+    )
+
+# Metrics endpoint and span log, set up once per process
+@st.cache_resource
+def start_tracing():
+    configure_from_env()
+    return serve_metrics(int(METRICS_PORT)) if METRICS_PORT else None
+
+# Audio output device shared by every session in the process
+@st.cache_resource
+def get_audio_sink():
+    return PyAudioSink()
+
+# Synthesized speech shared by every session in the process
+@st.cache_resource
+def get_audio_cache():
+    return AudioCache(TTS_CACHE_DIR or None)
+
+start_tracing()
+
 # Initialize session state variables if they don't exist
-if 'conversation' not in st.session_state:
-    st.session_state.conversation = []
+if 'chat_session' not in st.session_state:
+    st.session_state.chat_session = get_chat_engine().create_session()
 if 'listening' not in st.session_state:
     st.session_state.listening = False
 if 'initialized' not in st.session_state:
     st.session_state.initialized = False
-if 'speaking' not in st.session_state:
-    st.session_state.speaking = False
-if 'paused' not in st.session_state:
-    st.session_state.paused = False
+# Clip shown under the message whose 🔊 button was pressed last
+if 'replay_audio' not in st.session_state:
+    st.session_state.replay_audio = None
+if 'last_utterance' not in st.session_state:
+    st.session_state.last_utterance = None
 if 'user_input' not in st.session_state:
     st.session_state.user_input = ""
-if 'api_key' not in st.session_state:
-    st.session_state.api_key = ""
-if 'gemini_initialized' not in st.session_state:
-    st.session_state.gemini_initialized = False
-if 'session_id' not in st.session_state:
-    st.session_state.session_id = str(uuid.uuid4())
 if 'mongodb_connected' not in st.session_state:
     st.session_state.mongodb_connected = False
 if 'mongo_client' not in st.session_state:
     st.session_state.mongo_client = None
-if 'stop_speaking' not in st.session_state:
-    st.session_state.stop_speaking = False
-if 'speech_queue' not in st.session_state:
-    st.session_state.speech_queue = queue.Queue()
-if 'speech_thread_running' not in st.session_state:
-    st.session_state.speech_thread_running = False
+if 'mongo_writer' not in st.session_state:
+    st.session_state.mongo_writer = None
+if 'session_page' not in st.session_state:
+    st.session_state.session_page = 0
+if 'search_page' not in st.session_state:
+    st.session_state.search_page = 0
+# Cursor of the oldest loaded message, older pages are fetched from MongoDB on demand
+if 'history_cursor' not in st.session_state:
+    st.session_state.history_cursor = None
+if 'history_has_more' not in st.session_state:
+    st.session_state.history_has_more = False
+if 'render_window' not in st.session_state:
+    st.session_state.render_window = RENDER_WINDOW
+# Sentences are synthesized ahead while the previous one plays
+if 'speech_pipeline' not in st.session_state:
+    st.session_state.speech_pipeline = SpeechPipeline(get_speech_service(), get_audio_sink(), cache=get_audio_cache())
 # New state variables for image generation
-if 'stable_diffusion_api_key' not in st.session_state:
-    st.session_state.stable_diffusion_api_key = ""
-if 'image_generation_enabled' not in st.session_state:
-    st.session_state.image_generation_enabled = False
 if 'generated_images' not in st.session_state:
     st.session_state.generated_images = []
+# Chat turns depend on the conversation so far, only cache them when asked to
+if 'cache_chat_turns' not in st.session_state:
+    st.session_state.cache_chat_turns = False
+if 'use_memory' not in st.session_state:
+    st.session_state.use_memory = True
+# Image generation settings, copied to the chat session before each turn
+if 'image_samples' not in st.session_state:
+    st.session_state.image_samples = 1
+if 'image_preset' not in st.session_state:
+    st.session_state.image_preset = "standard"
+if 'refine_drafts' not in st.session_state:
+    st.session_state.refine_drafts = True
+# What the background jobs of this session looked like at the last rerun
+if 'job_snapshot' not in st.session_state:
+    st.session_state.job_snapshot = None
+# State variables for streamed responses
+if 'stream_responses' not in st.session_state:
+    st.session_state.stream_responses = True
+if 'pending_query' not in st.session_state:
+    st.session_state.pending_query = None
+if 'show_debug_panel' not in st.session_state:
+    st.session_state.show_debug_panel = False
+# Voice settings passed with every speech request
+if 'voice_settings' not in st.session_state:
+    st.session_state.voice_settings = {"voice": None, "rate": 170, "volume": 1.0}
 
 # App title and description
 st.title("Voice Assistant")
 st.markdown("Your personal AI voice assistant with text and image generation")
 
-# Initialize the voice engine - Modified for better reliability
+# Get the shared voice engine - started once per process and reused across reruns
 def init_engine():
-    try:
-        engine = pyttsx3.init()
-        voices = engine.getProperty('voices')
-        # Set voice (try to use a female voice if available)
-        if len(voices) > 1:
-            engine.setProperty('voice', voices[1].id)  # Female voice
-        engine.setProperty('rate', 170)  # Adjust speech speed
-        engine.setProperty('volume', 1.0)  # Max volume
-        return engine
-    except Exception as e:
-        st.error(f"Error initializing speech engine: {e}")
+    service = get_speech_service()
+    if not service.available:
+        st.error(f"Error initializing speech engine: {service.error}")
         return None
+    return service
 
 # Initialize MongoDB connection
 def init_mongodb(connection_string):
     try:
-        client = pymongo.MongoClient(connection_string)
-        # Test the connection
-        client.admin.command('ping')
+        import gridfs
+
+        from client_registry import credential_id
+
+        client, writer = get_mongo_connection(connection_string)
+        db = client.assistant_db
         st.session_state.mongodb_connected = True
         st.session_state.mongo_client = client
+        st.session_state.mongo_writer = writer
+        chat = st.session_state.chat_session
+        chat.writer = st.session_state.mongo_writer
+        # Past conversations are recalled from this database's messages only
+        chat.memory_owner = credential_id(connection_string)
+        # New images are mirrored to GridFS so sessions loaded elsewhere can show them
+        chat.image_store = ImageStore(IMAGE_STORE_DIR, bucket=gridfs.GridFSBucket(db, bucket_name="images"))
         return client
     except Exception as e:
         st.error(f"Failed to connect to MongoDB: {e}")
@@ -97,58 +217,160 @@ def save_to_mongodb(message):
         return
     
     try:
-        db = st.session_state.mongo_client.assistant_db
-        collection = db.conversations
-        
-        message_data = {
-            "session_id": st.session_state.session_id,
-            "timestamp": datetime.datetime.now(),
-            "role": message["role"],
-            "content": message["content"]
-        }
-        
-        # Add image URL if exists
-        if "image_url" in message:
-            message_data["image_url"] = message["image_url"]
-        
-        collection.insert_one(message_data)
+        # Queued for the background writer, which batches inserts
+        get_chat_engine().save_message(st.session_state.chat_session, message)
     except Exception as e:
         st.error(f"Failed to save to MongoDB: {e}")
 
+# Page through the session catalog, cached briefly so reruns don't hit the database
+@st.cache_data(ttl=30, show_spinner=False)
+def load_session_page(_db, connection_key, page, page_size=20):
+    from conversation_store import list_sessions
+
+    return list_sessions(_db, page=page, page_size=page_size)
+
+# Label for a session in the sidebar selectbox
+def describe_session(info):
+    title = info["title"] or f"Session {info['session_id'][:8]}..."
+    updated = info["updated_at"].strftime("%Y-%m-%d %H:%M") if info["updated_at"] else "unknown"
+    return f"{title} ({info['message_count']} msgs, {updated})"
+
 # Load conversation history from MongoDB
-def load_from_mongodb(session_id=None):
+def load_from_mongodb(session_id=None, page=0):
     if not st.session_state.mongodb_connected or not st.session_state.mongo_client:
-        return []
+        return [] if session_id else ([], False)
     
     try:
+        from conversation_store import load_history_page
+
         db = st.session_state.mongo_client.assistant_db
         collection = db.conversations
         
         if session_id:
-            # Load specific session
-            cursor = collection.find({"session_id": session_id}).sort("timestamp", 1)
-        else:
-            # Load list of session IDs
-            cursor = collection.distinct("session_id")
-            return cursor
-        
-        conversation = []
-        for doc in cursor:
-            message = {
-                "role": doc["role"],
-                "content": doc["content"]
-            }
+            # Make sure queued messages are visible before reading them back
+            if st.session_state.mongo_writer:
+                st.session_state.mongo_writer.flush()
             
-            # Add image URL if exists
-            if "image_url" in doc:
-                message["image_url"] = doc["image_url"]
-                
-            conversation.append(message)
-        
-        return conversation
+            # Load the latest page of a specific session, older pages are fetched on demand
+            conversation, has_more = load_history_page(collection, session_id, limit=HISTORY_PAGE_SIZE)
+            st.session_state.history_has_more = has_more
+            st.session_state.history_cursor = history_cursor(conversation)
+            return conversation
+        else:
+            # Load a page of sessions from the catalog, most recent first
+            return load_session_page(db, id(st.session_state.mongo_client), page)
     except Exception as e:
         st.error(f"Failed to load from MongoDB: {e}")
-        return []
+        return [] if session_id else ([], False)
+
+# Cursor pointing at the oldest message of a loaded conversation
+def history_cursor(conversation):
+    if conversation and "_id" in conversation[0]:
+        return (conversation[0]["timestamp"], conversation[0]["_id"])
+    return None
+
+# Prepend the previous page of the current session
+def load_older_messages():
+    if not st.session_state.mongodb_connected or not st.session_state.history_cursor:
+        st.session_state.history_has_more = False
+        return
+    
+    chat = st.session_state.chat_session
+    try:
+        from conversation_store import load_history_page
+
+        collection = st.session_state.mongo_client.assistant_db.conversations
+        older, has_more = load_history_page(
+            collection,
+            chat.session_id,
+            before=st.session_state.history_cursor,
+            limit=HISTORY_PAGE_SIZE
+        )
+        chat.conversation = older + chat.conversation
+        st.session_state.history_has_more = has_more
+        st.session_state.history_cursor = history_cursor(chat.conversation)
+        st.session_state.render_window += len(older)
+    except Exception as e:
+        st.error(f"Failed to load older messages: {e}")
+
+# Fetch the image of a message that was loaded without its payload
+def load_image_for_message(message_idx):
+    message = st.session_state.chat_session.conversation[message_idx]
+    try:
+        from conversation_store import load_message_image
+
+        collection = st.session_state.mongo_client.assistant_db.conversations
+        image_url = load_message_image(collection, message["_id"])
+        if image_url:
+            message["image_url"] = image_url
+    except Exception as e:
+        st.error(f"Failed to load image: {e}")
+
+# Keep memory flat in long sessions by dropping the oldest messages that are safely stored
+def trim_conversation():
+    chat = st.session_state.chat_session
+    excess = len(chat.conversation) - MAX_LOADED_MESSAGES
+    if excess <= 0 or not st.session_state.mongodb_connected:
+        return
+    if not all("_id" in message for message in chat.conversation[:excess + 1]):
+        return
+    
+    chat.conversation = chat.conversation[excess:]
+    st.session_state.history_cursor = history_cursor(chat.conversation)
+    st.session_state.history_has_more = True
+    st.session_state.render_window = min(st.session_state.render_window, MAX_LOADED_MESSAGES)
+
+# Local search index for databases without $text (mongomock), one per connection
+@st.cache_resource(show_spinner=False)
+def get_search_index(connection_key):
+    from search_index import SearchIndex
+
+    return SearchIndex()
+
+# Search messages across sessions, returns (results, has_more)
+def search_conversations(query, role=None, session_id=None, since=None, until=None, page=0):
+    from conversation_store import search_messages
+
+    db = st.session_state.mongo_client.assistant_db
+    # Let queued messages land so the latest turns can be found
+    if st.session_state.mongo_writer:
+        st.session_state.mongo_writer.flush()
+    filters = {"session_id": session_id, "role": role, "since": since, "until": until,
+               "page": page, "page_size": SEARCH_PAGE_SIZE}
+    try:
+        return search_messages(db.conversations, query, **filters)
+    except NotImplementedError:
+        # No text search in this database, use a local index kept in sync with the collection
+        index = get_search_index(id(st.session_state.mongo_client))
+        index.sync(db.conversations)
+        return search_messages(db.conversations, query, index=index, **filters)
+
+# Start a search from its first page
+def reset_search_page():
+    st.session_state.search_page = 0
+
+# Switch to the session a search result belongs to
+def open_session(session_id):
+    conversation = load_from_mongodb(session_id)
+    if conversation:
+        st.session_state.chat_session.session_id = session_id
+        reset_history(conversation)
+
+# Reset the history window for a fresh or newly loaded session
+def reset_history(conversation=None):
+    chat = st.session_state.chat_session
+    chat.conversation = conversation or []
+    st.session_state.render_window = RENDER_WINDOW
+    if conversation is None:
+        st.session_state.history_cursor = None
+        st.session_state.history_has_more = False
+        chat.context.restore("", None, [])
+    else:
+        # Gemini continues from the stored summary and the latest turns
+        try:
+            get_chat_engine().restore_context(chat)
+        except Exception as e:
+            st.error(f"Failed to restore chat context: {e}")
 
 # Initialize Gemini AI
 def init_gemini(api_key):
@@ -156,10 +378,7 @@ def init_gemini(api_key):
         return False
     
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-1.5-flash-001')
-        convo = model.start_chat()
-        return convo
+        return get_chat_engine().configure_gemini(st.session_state.chat_session, api_key)
     except Exception as e:
         st.error(f"Error initializing Gemini API: {e}")
         return False
@@ -170,70 +389,18 @@ def init_stable_diffusion(api_key):
         return False
     
     try:
-        # Simple test request to validate API key
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        
         # Just checking if the API key format is valid, not making a real request
-        if len(api_key) < 8:  # Basic validation
-            return False
-            
-        st.session_state.image_generation_enabled = True
-        st.session_state.stable_diffusion_api_key = api_key
-        return True
+        return get_chat_engine().configure_image_generation(st.session_state.chat_session, api_key)
     except Exception as e:
         st.error(f"Error initializing Stable Diffusion API: {e}")
         return False
 
-# Text to image generation using Stable Diffusion API
-def generate_image(prompt):
-    if not st.session_state.image_generation_enabled:
-        return None
-    
+# Thumbnail bytes for a stored image, None if it can't be found
+def load_thumbnail(image_ref):
     try:
-        url = "https://api.stability.ai/v1/generation/stable-diffusion-xl-1024-v1-0/text-to-image"
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Authorization": f"Bearer {st.session_state.stable_diffusion_api_key}"
-        }
-        
-        payload = {
-            "text_prompts": [{"text": prompt}],
-            "cfg_scale": 7,
-            "height": 1024,
-            "width": 1024,
-            "samples": 1,
-            "steps": 30,
-        }
-        
-        with st.spinner("Generating image..."):
-            response = requests.post(url, headers=headers, json=payload)
-            
-            if response.status_code != 200:
-                st.error(f"Non-200 response: {response.text}")
-                return None
-                
-            data = response.json()
-            
-            # Process and return the image
-            for i, image in enumerate(data["artifacts"]):
-                image_data = base64.b64decode(image["base64"])
-                img = Image.open(io.BytesIO(image_data))
-                img_byte_arr = io.BytesIO()
-                img.save(img_byte_arr, format='PNG')
-                img_byte_arr = img_byte_arr.getvalue()
-                
-                # Add to session state
-                img_b64 = base64.b64encode(img_byte_arr).decode()
-                return f"data:image/png;base64,{img_b64}"
-                
-        return None
+        return get_chat_engine().image_store_for(st.session_state.chat_session).thumbnail(image_ref)
     except Exception as e:
-        st.error(f"Error generating image: {e}")
+        st.error(f"Failed to load image: {e}")
         return None
 
 # Callback for API key input
@@ -241,10 +408,7 @@ def process_api_key():
     api_key = st.session_state.api_key_input
     if api_key:
         with st.spinner("Initializing Gemini API..."):
-            st.session_state.convo = init_gemini(api_key)
-            if st.session_state.convo:
-                st.session_state.gemini_initialized = True
-                st.session_state.api_key = api_key  # Save it for later use
+            init_gemini(api_key)
 
 # Callback for Stable Diffusion API key
 def process_sd_api_key():
@@ -263,103 +427,37 @@ def process_mongodb_connection():
             if client:
                 st.success("Connected to MongoDB successfully!")
 
-# Fixed speech functions
-def speak_worker():
-    """Worker thread that processes speech queue"""
-    st.session_state.speech_thread_running = True
-    
-    while True:
-        try:
-            # Get text from queue with a timeout to allow checking for app exit
-            try:
-                text = st.session_state.speech_queue.get(timeout=0.5)
-            except queue.Empty:
-                # No items in queue, check if we should exit
-                if not st.session_state.speech_thread_running:
-                    break
-                continue
-            
-            # Initialize engine for each speech request to avoid resource issues
-            engine = init_engine()
-            if not engine:
-                st.session_state.speaking = False
-                st.session_state.speech_queue.task_done()
-                continue
-                
-            st.session_state.speaking = True
-            st.session_state.stop_speaking = False
-            
-            # Split text into sentences for better pause control
-            sentences = text.replace('. ', '.|').replace('? ', '?|').replace('! ', '!|').split('|')
-            
-            for sentence in sentences:
-                if st.session_state.stop_speaking:
-                    break
-                
-                while st.session_state.paused:
-                    time.sleep(0.1)
-                    if st.session_state.stop_speaking:
-                        break
-                
-                if sentence.strip():
-                    try:
-                        engine.say(sentence)
-                        engine.runAndWait()
-                    except Exception as e:
-                        st.error(f"Speech error: {e}")
-                        break
-            
-            # Clean up engine after use
-            try:
-                engine.stop()
-            except:
-                pass
-            
-            st.session_state.speaking = False
-            st.session_state.paused = False
-            st.session_state.speech_queue.task_done()
-            
-        except Exception as e:
-            st.error(f"Speech worker error: {e}")
-            st.session_state.speaking = False
-            st.session_state.paused = False
-            try:
-                st.session_state.speech_queue.task_done()
-            except:
-                pass
-
-def start_speech_worker():
-    """Start the speech worker thread if not already running"""
-    if not st.session_state.speech_thread_running:
-        threading.Thread(target=speak_worker, daemon=True).start()
-
+# Speech output functions
 def speak_text(text):
-    """Add text to the speech queue"""
-    start_speech_worker()
-    st.session_state.speech_queue.put(text)
+    """Queue text on this session's speech pipeline"""
+    st.session_state.speech_pipeline.speak(text, **st.session_state.voice_settings)
 
 def pause_resume_speech():
     """Toggle pause/resume of speech"""
-    st.session_state.paused = not st.session_state.paused
+    pipeline = st.session_state.speech_pipeline
+    if pipeline.paused:
+        pipeline.resume()
+    else:
+        pipeline.pause()
 
 def stop_speech():
     """Stop speech completely"""
-    st.session_state.stop_speaking = True
-    st.session_state.paused = False
-    
-    # Clear the queue
-    while not st.session_state.speech_queue.empty():
-        try:
-            st.session_state.speech_queue.get_nowait()
-            st.session_state.speech_queue.task_done()
-        except:
-            pass
+    st.session_state.speech_pipeline.stop()
 
 def read_message_aloud(message_idx):
     """Read a specific message from the conversation aloud"""
-    if 0 <= message_idx < len(st.session_state.conversation):
-        message = st.session_state.conversation[message_idx]["content"]
-        speak_text(message)
+    conversation = st.session_state.chat_session.conversation
+    if 0 <= message_idx < len(conversation):
+        message = conversation[message_idx]["content"]
+        try:
+            # Cached sentences make replays instant, the browser plays the clip
+            clip = st.session_state.speech_pipeline.render(message, **st.session_state.voice_settings)
+        except Exception:
+            clip = None
+        if clip is None:
+            speak_text(message)
+            return
+        st.session_state.replay_audio = {"index": message_idx, "wav": clip.to_wav(), "autoplay": True}
 
 # Listening function
 def listen_for_command():
@@ -367,19 +465,27 @@ def listen_for_command():
     st.session_state.listening = True
     status_placeholder = st.empty()
     status_placeholder.info("Listening... (Speak now)")
-    
-    r = sr.Recognizer()
+
+    def on_partial(text):
+        status_placeholder.info(f"Listening... {text}")
+
+    import speech_recognition as sr
+    from speech_input import get_speech_input
+
     try:
-        with sr.Microphone() as source:
-            r.pause_threshold = 1
-            r.adjust_for_ambient_noise(source)
-            audio = r.listen(source, timeout=5, phrase_time_limit=5)
-        
-        status_placeholder.info("Processing your speech...")
-        query = r.recognize_google(audio, language='en-in')
-        status_placeholder.success(f"I heard: {query}")
+        # The microphone stays open and calibrated between presses
+        utterance = get_speech_input().listen(timeout=5, phrase_time_limit=15, on_partial=on_partial)
+        status_placeholder.success(f"I heard: {utterance.text}")
+        get_tracer().record("recognition", utterance.latency, st.session_state.chat_session.session_id,
+                            speech_ms=round(utterance.speech_seconds * 1000))
+        st.session_state.last_utterance = {
+            "latency_ms": round(utterance.latency * 1000),
+            "speech_ms": round(utterance.speech_seconds * 1000),
+        }
         st.session_state.listening = False
-        return query.lower()
+        return utterance.text.lower()
+    except sr.WaitTimeoutError:
+        status_placeholder.error("I didn't hear anything.")
     except sr.UnknownValueError:
         status_placeholder.error("Sorry, I didn't catch that.")
     except sr.RequestError:
@@ -390,130 +496,192 @@ def listen_for_command():
     st.session_state.listening = False
     return None
 
-def query_gemini(query):
-    """Queries the Gemini AI model, falls back to Wikipedia if unavailable"""
-    if not st.session_state.gemini_initialized:
-        try:
-            results = wikipedia.summary(query, sentences=2)
-            return f"According to Wikipedia: {results}"
-        except:
-            return "I couldn't find information on that. Please initialize Gemini API for better responses."
-    
-    try:
-        st.session_state.convo.send_message(query)
-        response = st.session_state.convo.last.text.replace('*', '')
-        return response
-    except Exception as e:
-        return f"Sorry, I couldn't process that request. Error: {str(e)}"
+# Sentence boundary used to hand finished sentences to the speech queue
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
 
-def handle_command(query):
-    """Process the command and return a response"""
-    if not query:
-        return "I didn't hear anything. Please try again."
+def pop_complete_sentences(buffer):
+    """Split the finished sentences off a streaming buffer, returns (sentences, remainder)"""
+    parts = SENTENCE_END.split(buffer)
+    return parts[:-1], parts[-1]
+
+def stream_response(query, placeholder):
+    """Render a streamed reply into the placeholder and speak each sentence as it completes"""
+    response = ""
+    unspoken = ""
     
-    # Check if this is an image generation request
-    generate_img = False
-    img_prompt = None
-    
-    if query.startswith("generate image") or query.startswith("create image") or "draw" in query or "picture of" in query:
-        generate_img = True
-        # Extract the prompt from the query
-        if query.startswith("generate image"):
-            img_prompt = query.replace("generate image", "", 1).strip()
-        elif query.startswith("create image"):
-            img_prompt = query.replace("create image", "", 1).strip()
-        elif "draw" in query:
-            img_prompt = query.replace("draw", "", 1).strip()
-        elif "picture of" in query:
-            img_prompt = query.replace("picture of", "", 1).strip()
+    def on_chunk(chunk):
+        nonlocal response, unspoken
+        response += chunk
+        placeholder.markdown(f"**Assistant:** {response}▌")
         
-        # If no specific prompt, use the whole query
-        if not img_prompt:
-            img_prompt = query
+        sentences, unspoken = pop_complete_sentences(unspoken + chunk)
+        for sentence in sentences:
+            speak_text(sentence)
     
-    # Add user query to conversation
-    user_message = {"role": "user", "content": query}
-    st.session_state.conversation.append(user_message)
+    def on_wait():
+        # Redrawing also lets Streamlit interrupt the turn when Stop is pressed
+        placeholder.markdown(f"**Assistant:** {response}▌")
     
-    # Save to MongoDB if connected
-    if st.session_state.mongodb_connected:
-        save_to_mongodb(user_message)
-    
-    # Process different commands
-    if generate_img and st.session_state.image_generation_enabled:
-        response = f"Generating an image based on: {img_prompt}"
-        img_url = generate_image(img_prompt)
-        if img_url:
-            assistant_message = {
-                "role": "assistant", 
-                "content": response,
-                "image_url": img_url
-            }
-        else:
-            assistant_message = {
-                "role": "assistant", 
-                "content": "I'm sorry, I couldn't generate that image. Please try a different description."
-            }
+    assistant_message = get_chat_engine().handle(
+        st.session_state.chat_session, query, on_chunk=on_chunk, on_wait=on_wait
+    )
     
-    elif 'wikipedia' in query:
-        response = "Searching Wikipedia..."
-        query = query.replace("wikipedia", "")
-        try:
-            results = wikipedia.summary(query, sentences=2)
-            response = f"According to Wikipedia: {results}"
-        except:
-            response = "Sorry, I couldn't find any results on Wikipedia."
-        assistant_message = {"role": "assistant", "content": response}
-    
-    elif 'open youtube' in query:
-        response = "Opening YouTube in a new tab."
-        webbrowser.open_new_tab("https://youtube.com")
-        assistant_message = {"role": "assistant", "content": response}
-    
-    elif 'open google' in query:
-        response = "Opening Google in a new tab."
-        webbrowser.open_new_tab("https://google.com")
-        assistant_message = {"role": "assistant", "content": response}
-    
-    elif 'open stackoverflow' in query:
-        response = "Opening Stack Overflow in a new tab."
-        webbrowser.open_new_tab("https://stackoverflow.com")
-        assistant_message = {"role": "assistant", "content": response}
-    
-    elif 'the time' in query:
-        strTime = datetime.datetime.now().strftime("%H:%M:%S")
-        response = f"The time is {strTime}"
-        assistant_message = {"role": "assistant", "content": response}
-    
-    elif 'goodbye' in query or 'exit' in query:
-        response = "Have a good day! Refresh the page to start a new session."
-        assistant_message = {"role": "assistant", "content": response}
+    if unspoken.strip():
+        speak_text(unspoken)
+    placeholder.markdown(f"**Assistant:** {assistant_message['content']}")
+    return assistant_message
+
+def waiting_indicator(placeholder):
+    """on_wait callback showing how long a backend call has been pending"""
+    started_at = time.perf_counter()
+    
+    def on_wait():
+        # Every update is also a point where Streamlit can interrupt the turn when Stop is pressed
+        placeholder.caption(f"Waiting for a reply... {time.perf_counter() - started_at:.1f}s")
+    return on_wait
+
+def show_images(image_refs, captions=None):
+    """Thumbnails side by side, one column per image"""
+    columns = st.columns(len(image_refs)) if len(image_refs) > 1 else [st.container()]
+    for i, (column, image_ref) in enumerate(zip(columns, image_refs)):
+        with column:
+            thumbnail = load_thumbnail(image_ref)
+            if thumbnail:
+                st.image(thumbnail, caption=captions[i] if captions else "Generated Image")
+            else:
+                st.caption("Image no longer available")
+
+def job_status(message):
+    """Caption for a message whose images come from a background job"""
+    job = get_job_queue().get(message["job_id"])
+    if job is None:
+        return "Generating images..."
+    if job["status"] == "queued":
+        return "Waiting for an earlier image to finish..."
+    if job["status"] == "running":
+        progress = f" ({job['progress_done']}/{job['progress_total']})" if job["progress_total"] else ""
+        return f"Generating images...{progress}"
+    if job["status"] == "interrupted":
+        return "Image generation was interrupted by a restart."
+    return None
+
+def cancel_job(job_id):
+    """Stop a background job, the images that already arrived are kept"""
+    get_job_queue().cancel(job_id)
+
+def pending_jobs_snapshot(conversation):
+    """Pending placeholders and the images they show so far"""
+    return tuple(
+        (message["job_id"], len(message.get("image_refs") or [message.get("image_ref")]))
+        for message in conversation if message.get("pending")
+    )
+
+# Rerun the page when a background job of this session has made progress since it was drawn
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def watch_jobs():
+    snapshot = pending_jobs_snapshot(st.session_state.chat_session.conversation)
+    if snapshot != st.session_state.job_snapshot:
+        st.session_state.job_snapshot = snapshot
+        st.rerun()
+
+# Callback for "Show earlier messages": widen the window, then page in older stored messages
+def show_earlier_messages():
+    chat = st.session_state.chat_session
+    if len(chat.conversation) > st.session_state.render_window:
+        st.session_state.render_window += HISTORY_PAGE_SIZE
+    else:
+        load_older_messages()
+
+# Message history as a fragment, so its buttons (🔊, show earlier, cancel) only redraw the conversation
+@st.fragment
+def show_conversation():
+    chat = st.session_state.chat_session
+    # Only the most recent window of messages is rendered
+    first_visible = max(0, len(chat.conversation) - st.session_state.render_window)
+    if first_visible > 0 or st.session_state.history_has_more:
+        st.button("Show earlier messages", key="show_earlier", on_click=show_earlier_messages)
+    
+    for i in range(first_visible, len(chat.conversation)):
+        message = chat.conversation[i]
+        if message["role"] == "user":
+            # User messages have no buttons, so they don't need a row of columns
+            st.markdown(f"**You:** {message['content']}")
+            continue
+        
+        msg_col, btn_col = st.columns([10, 1])
+        with msg_col:
+            st.markdown(f"**Assistant:** {message['content']}")
+            # Display image if exists, stored images are shown as cached thumbnails
+            if "image_ref" in message:
+                show_images(message.get("image_refs") or [message["image_ref"]])
+            elif "image_url" in message:
+                st.image(message["image_url"], caption="Generated Image")
+            elif message.get("has_image"):
+                # Loaded from history without the payload, fetch it on request
+                st.button("🖼️ Show image", key=f"image_{i}", on_click=load_image_for_message, args=(i,))
+            # Images still being generated by a background job
+            if message.get("pending"):
+                st.caption(f"⏳ {job_status(message) or 'Generating images...'}")
+                st.button("Cancel", key=f"cancel_job_{i}", on_click=cancel_job, args=(message["job_id"],))
+            elif "job_id" in message and "image_ref" not in message:
+                # Loaded from history, the job may have been cut short by a restart
+                status = job_status(message)
+                if status:
+                    st.caption(status)
+            replay = st.session_state.replay_audio
+            if replay and replay["index"] == i:
+                st.audio(replay["wav"], format="audio/wav", autoplay=replay["autoplay"])
+                replay["autoplay"] = False
+        with btn_col:
+            # Add a read aloud button for each assistant message
+            st.button("🔊", key=f"read_{i}", help="Read this message aloud", on_click=read_message_aloud, args=(i,))
+
+def handle_command(query, stream_placeholder=None):
+    """Process the command and return a response"""
+    if not query:
+        return "I didn't hear anything. Please try again."
+    
+    chat = st.session_state.chat_session
+    chat.cache_chat_turns = st.session_state.cache_chat_turns
+    chat.use_memory = st.session_state.use_memory
+    chat_engine = get_chat_engine()
+    spoken = False
     
+    # Commands are answered by the engine, general queries may be streamed
+    intent = chat_engine.route(chat, query)
+    on_wait = waiting_indicator(stream_placeholder) if stream_placeholder is not None else None
+    if intent is not None and intent.name == "generate_image":
+        chat.image_samples = st.session_state.image_samples
+        chat.image_preset = st.session_state.image_preset
+        chat.refine_drafts = st.session_state.refine_drafts
+        # Returns a placeholder right away, the images are generated by a background job
+        assistant_message = chat_engine.handle(chat, query, intent=intent, on_wait=on_wait)
+    elif intent is None and stream_placeholder is not None and st.session_state.stream_responses:
+        assistant_message = stream_response(query, stream_placeholder)
+        spoken = True
     else:
-        # Handle general queries using Gemini AI or Wikipedia
-        response = query_gemini(query)
-        assistant_message = {"role": "assistant", "content": response}
+        assistant_message = chat_engine.handle(chat, query, intent=intent, on_wait=on_wait)
     
-    # Add assistant response to conversation
-    st.session_state.conversation.append(assistant_message)
+    if "error" in assistant_message:
+        st.error(assistant_message["error"])
     
-    # Save to MongoDB if connected
-    if st.session_state.mongodb_connected:
-        save_to_mongodb(assistant_message)
+    # Speak the response (text part only), streamed replies were spoken as they arrived
+    if not spoken:
+        speak_text(assistant_message["content"])
     
-    # Speak the response (text part only)
-    speak_text(assistant_message["content"])
+    trim_conversation()
     
-    return response
+    return assistant_message["content"]
 
 # Callback function to handle user input
 def submit_text():
     if st.session_state.user_input:
         query = st.session_state.user_input
         st.session_state.user_input = ""  # Clear the input
-        handle_command(query)
+        # Handled inside the chat container so the reply can be streamed there
+        st.session_state.pending_query = query
 
-# Initialize speech engine - done once at page load, but not cached
+# Speech engine is shared by the whole process, voices are enumerated only once
 engine = init_engine()
 
 # Sidebar controls
@@ -523,18 +691,21 @@ with st.sidebar:
     # Voice selection - modified to handle potential errors
     if engine:
         try:
-            voices = engine.getProperty('voices')
+            voices = engine.voices
             voice_options = {voice.name: i for i, voice in enumerate(voices)}
             selected_voice = st.selectbox("Select Voice", options=list(voice_options.keys()), index=1 if len(voices) > 1 else 0)
-            engine.setProperty('voice', voices[voice_options[selected_voice]].id)
             
             # Speech rate
             speech_rate = st.slider("Speech Rate", min_value=100, max_value=250, value=170, step=10)
-            engine.setProperty('rate', speech_rate)
             
             # Speech volume
             speech_volume = st.slider("Volume", min_value=0.0, max_value=1.0, value=1.0, step=0.1)
-            engine.setProperty('volume', speech_volume)
+            
+            st.session_state.voice_settings = {
+                "voice": voices[voice_options[selected_voice]].id if voices else None,
+                "rate": speech_rate,
+                "volume": speech_volume,
+            }
         except Exception as e:
             st.error(f"Error configuring voice settings: {e}")
     else:
@@ -542,9 +713,78 @@ with st.sidebar:
     
     st.markdown("---")
     
+    # Response settings
+    st.header("Response Settings")
+    st.toggle("Stream responses", key="stream_responses", help="Show and speak replies while they are being generated")
+    st.toggle(
+        "Cache chat responses",
+        key="cache_chat_turns",
+        help="Reuse Gemini answers to the same question asked with the same API key and conversation so far."
+    )
+    st.toggle(
+        "Recall past conversations",
+        key="use_memory",
+        help="Add relevant snippets from earlier chats to the Gemini prompt"
+    )
+    cache_stats = get_response_cache().stats()["sources"]
+    if cache_stats:
+        st.caption("Cache: " + ", ".join(
+            f"{source} {counters['hits']}/{counters['hits'] + counters['misses']} hits"
+            for source, counters in sorted(cache_stats.items())
+        ))
+    if st.session_state.chat_session.turn_latencies:
+        last_turn = st.session_state.chat_session.turn_latencies[-1]
+        st.caption(f"Last reply: first token {last_turn['ttft_ms']:.0f} ms, total {last_turn['total_ms']:.0f} ms")
+        if "prompt_tokens" in last_turn:
+            context_stats = st.session_state.chat_session.context.stats()
+            st.caption(
+                f"Prompt: ~{last_turn['prompt_tokens']} tokens "
+                f"({context_stats['turns']} recent turns, ~{context_stats['summary_tokens']} token summary, "
+                f"{last_turn.get('recalled', 0)} recalled)"
+            )
+    
+    speech_stats = st.session_state.speech_pipeline.stats()
+    if speech_stats:
+        stop_note = f", last stop {speech_stats['last_stop_ms']:.0f} ms" if speech_stats["last_stop_ms"] is not None else ""
+        st.caption(f"Speech: chunk latency p50 {speech_stats['latency_p50_ms']:.0f} ms{stop_note}")
+    audio_stats = get_audio_cache().stats()
+    if audio_stats["hit_rate"] is not None:
+        st.caption(
+            f"Speech cache: {audio_stats['hit_rate']:.0%} hits "
+            f"({audio_stats['memory_hits']} memory, {audio_stats['disk_hits']} disk, {audio_stats['misses']} misses)"
+        )
+    
+    # Per-stage latency of this session's turns
+    st.toggle("Latency debug panel", key="show_debug_panel", help="Show p50/p95/p99 per stage and the latest spans")
+    if st.session_state.show_debug_panel:
+        tracer = get_tracer()
+        stage_stats = tracer.stats(st.session_state.chat_session.session_id)
+        if stage_stats:
+            st.dataframe(
+                [{"stage": stage, **values} for stage, values in stage_stats.items()],
+                hide_index=True
+            )
+            with st.expander("Recent spans"):
+                st.json(tracer.recent_spans(st.session_state.chat_session.session_id, limit=20), expanded=False)
+        else:
+            st.caption("No spans recorded for this session yet")
+        # Shared by all sessions: calls in flight, waiting for a slot, refused by per-session rate limits
+        # and answered by an identical call already in flight
+        backend_stats = get_chat_engine().backends.stats()
+        if backend_stats:
+            st.caption("Backends: " + ", ".join(
+                f"{backend} {counters.get('in_flight', 0)} in flight, {counters.get('queued', 0)} queued, "
+                f"{counters['rate_limited']} rate limited, {counters['coalesced']}/{counters['calls']} coalesced"
+                for backend, counters in sorted(backend_stats.items())
+            ))
+        if METRICS_PORT:
+            st.caption(f"Prometheus metrics at http://localhost:{METRICS_PORT}/metrics")
+    
+    st.markdown("---")
+    
     # Gemini API setup
     st.header("Gemini API Setup")
-    if not st.session_state.gemini_initialized:
+    if not st.session_state.chat_session.gemini_initialized:
         st.text_input(
             "Enter your Gemini API Key:", 
             type="password",
@@ -555,15 +795,14 @@ with st.sidebar:
     else:
         st.success("✅ Gemini API initialized successfully!")
         if st.button("Reset API Key"):
-            st.session_state.gemini_initialized = False
-            st.session_state.api_key = ""
+            st.session_state.chat_session.convo = None
             st.rerun()
     
     st.markdown("---")
     
     # Stable Diffusion API setup
     st.header("Image Generation Setup")
-    if not st.session_state.image_generation_enabled:
+    if not st.session_state.chat_session.image_generation_enabled:
         st.text_input(
             "Enter Stable Diffusion API Key:", 
             type="password",
@@ -573,9 +812,16 @@ with st.sidebar:
         st.caption("Get a key at: https://stability.ai/")
     else:
         st.success("✅ Image generation enabled!")
+        st.slider("Images per prompt", 1, MAX_IMAGE_SAMPLES, key="image_samples")
+        st.selectbox("Image quality", list(IMAGE_PRESETS), key="image_preset")
+        if st.session_state.image_preset == "draft":
+            st.checkbox("Refine drafts", key="refine_drafts",
+                        help="Show quick drafts first, then replace them with full-quality images")
+        active_jobs = get_job_queue().list(st.session_state.chat_session.session_id, active_only=True)
+        if active_jobs:
+            st.caption(f"{len(active_jobs)} of {MAX_JOBS_PER_SESSION} image jobs in progress")
         if st.button("Reset Image API"):
-            st.session_state.image_generation_enabled = False
-            st.session_state.stable_diffusion_api_key = ""
+            st.session_state.chat_session.stable_diffusion_api_key = ""
             st.rerun()
     
     st.markdown("---")
@@ -594,32 +840,105 @@ with st.sidebar:
     else:
         st.success("✅ Connected to MongoDB!")
         
+        # Background writer health
+        if st.session_state.mongo_writer:
+            writer_stats = st.session_state.mongo_writer.stats()
+            last_flush = writer_stats["last_flush_ms"]
+            st.caption(
+                f"Pending writes: {writer_stats['queue_depth']} · "
+                f"last flush: {f'{last_flush:.0f} ms' if last_flush is not None else 'n/a'}"
+            )
+            if writer_stats["failed"]:
+                st.warning(f"{writer_stats['failed']} messages failed to save: {writer_stats['last_error']}")
+        
         # Session management
         st.subheader("Session Management")
         
         # Create new session button
         if st.button("Start New Session"):
-            st.session_state.session_id = str(uuid.uuid4())
-            st.session_state.conversation = []
+            st.session_state.chat_session.session_id = str(uuid.uuid4())
+            reset_history()
+            st.session_state.session_page = 0
+            load_session_page.clear()
             st.rerun()
         
-        # Load previous sessions
-        previous_sessions = load_from_mongodb()
+        # Load previous sessions, one catalog page at a time
+        previous_sessions, has_more_sessions = load_from_mongodb(page=st.session_state.session_page)
         if previous_sessions and len(previous_sessions) > 0:
+            session_info = {s["session_id"]: s for s in previous_sessions}
             selected_session = st.selectbox(
                 "Load Previous Session:",
-                options=previous_sessions,
-                format_func=lambda x: f"Session {x[:8]}... ({x})"
+                options=list(session_info),
+                format_func=lambda x: describe_session(session_info[x])
             )
             
+            prev_col, next_col = st.columns(2)
+            with prev_col:
+                if st.button("◀ Newer", disabled=st.session_state.session_page == 0):
+                    st.session_state.session_page -= 1
+                    st.rerun()
+            with next_col:
+                if st.button("Older ▶", disabled=not has_more_sessions):
+                    st.session_state.session_page += 1
+                    st.rerun()
+            
             if st.button("Load Selected Session"):
                 conversation = load_from_mongodb(selected_session)
                 if conversation:
-                    st.session_state.conversation = conversation
-                    st.session_state.session_id = selected_session
+                    st.session_state.chat_session.session_id = selected_session
+                    reset_history(conversation)
                     st.rerun()
+        
+        # Full-text search across every stored session
+        st.subheader("Search Conversations")
+        st.text_input("Search messages:", key="search_query", on_change=reset_search_page)
+        role_col, scope_col = st.columns(2)
+        with role_col:
+            search_role = st.selectbox("From", ["anyone", "user", "assistant"], key="search_role",
+                                       on_change=reset_search_page)
+        with scope_col:
+            this_session_only = st.checkbox("This session only", key="search_this_session",
+                                            on_change=reset_search_page)
+        search_dates = st.date_input("Between", value=[], key="search_dates", on_change=reset_search_page)
+        if st.session_state.search_query.strip():
+            since = until = None
+            if search_dates:
+                since = datetime.datetime.combine(search_dates[0], datetime.time.min)
+                # The end date is included, so search up to the start of the next day
+                until = datetime.datetime.combine(search_dates[-1], datetime.time.min) + datetime.timedelta(days=1)
+            try:
+                results, has_more_results = search_conversations(
+                    st.session_state.search_query,
+                    role=None if search_role == "anyone" else search_role,
+                    session_id=st.session_state.chat_session.session_id if this_session_only else None,
+                    since=since, until=until, page=st.session_state.search_page,
+                )
+            except Exception as e:
+                st.error(f"Search failed: {e}")
+                results, has_more_results = [], False
+            if not results:
+                st.caption("No matching messages")
+            for i, result in enumerate(results):
+                st.markdown(
+                    f"**{result['role'].capitalize()}** · {result['timestamp']:%Y-%m-%d %H:%M} · "
+                    f"session {result['session_id'][:8]}...\n\n{result['snippet']}"
+                )
+                if result["session_id"] != st.session_state.chat_session.session_id:
+                    st.button("Open session", key=f"open_result_{i}", on_click=open_session,
+                              args=(result["session_id"],))
+            if st.session_state.search_page > 0 or has_more_results:
+                prev_col, next_col = st.columns(2)
+                with prev_col:
+                    if st.button("◀ Previous", key="search_prev", disabled=st.session_state.search_page == 0):
+                        st.session_state.search_page -= 1
+                        st.rerun()
+                with next_col:
+                    if st.button("Next ▶", key="search_next", disabled=not has_more_results):
+                        st.session_state.search_page += 1
+                        st.rerun()
 
 # Main interface
+chat = st.session_state.chat_session
 col1, col2 = st.columns([2, 1])
 
 with col1:
@@ -628,36 +947,35 @@ with col1:
     chat_container = st.container(height=400)
     
     with chat_container:
-        for i, message in enumerate(st.session_state.conversation):
-            if message["role"] == "user":
-                user_col, btn_col = st.columns([10, 1])
-                with user_col:
-                    st.markdown(f"**You:** {message['content']}")
-            else:
-                msg_col, btn_col = st.columns([10, 1])
-                with msg_col:
-                    st.markdown(f"**Assistant:** {message['content']}")
-                    # Display image if exists
-                    if "image_url" in message:
-                        st.image(message["image_url"], caption="Generated Image")
-                with btn_col:
-                    # Add a read aloud button for each assistant message
-                    button_key = f"read_{i}"  # Create unique key for each button
-                    if st.button("🔊", key=button_key, help="Read this message aloud"):
-                        read_message_aloud(i)
+        show_conversation()
+        
+        # Stream the pending reply into the chat container as it is generated
+        if st.session_state.pending_query:
+            query = st.session_state.pending_query
+            st.session_state.pending_query = None
+            st.markdown(f"**You:** {query}")
+            # Pressing Stop reruns the script, which interrupts the turn and cancels its backend call
+            st.button("⏹️ Stop", key="stop_reply", on_click=stop_speech, help="Stop generating this reply")
+            handle_command(query, stream_placeholder=st.empty())
+            st.rerun()
+
+        # Keep checking on images that are generated in the background
+        st.session_state.job_snapshot = pending_jobs_snapshot(chat.conversation)
+        if st.session_state.job_snapshot:
+            watch_jobs()
     
     # Audio controls
     audio_cols = st.columns(3)
     with audio_cols[0]:
-        if st.session_state.speaking and not st.session_state.paused:
+        if st.session_state.speech_pipeline.speaking and not st.session_state.speech_pipeline.paused:
             if st.button("⏸️ Pause", key="pause_button"):
                 pause_resume_speech()
-        elif st.session_state.speaking and st.session_state.paused:
+        elif st.session_state.speech_pipeline.speaking and st.session_state.speech_pipeline.paused:
             if st.button("▶️ Resume", key="resume_button"):
                 pause_resume_speech()
     
     with audio_cols[1]:
-        if st.session_state.speaking:
+        if st.session_state.speech_pipeline.speaking:
             if st.button("⏹️ Stop", key="stop_button"):
                 stop_speech()
     
@@ -678,21 +996,23 @@ with col2:
         if st.button("🎤 Activate Microphone", disabled=st.session_state.listening):
             query = listen_for_command()
             if query:
-                handle_command(query)
+                st.session_state.pending_query = query
                 st.rerun()
     
     with status_col:
         if st.session_state.listening:
             st.info("Listening...")
-        elif st.session_state.speaking and st.session_state.paused:
+        elif st.session_state.speech_pipeline.speaking and st.session_state.speech_pipeline.paused:
             st.warning("Paused")
-        elif st.session_state.speaking:
+        elif st.session_state.speech_pipeline.speaking:
             st.info("Speaking...")
         else:
             st.success("Ready")
+        if st.session_state.last_utterance:
+            st.caption(f"Heard {st.session_state.last_utterance['latency_ms']} ms after you stopped")
     
     # Welcome message on first load
-    if len(st.session_state.conversation) == 0:
+    if len(chat.conversation) == 0:
         # Wish user based on time
         hour = int(datetime.datetime.now().hour)
         if 0 <= hour < 12:
@@ -704,7 +1024,7 @@ with col2:
         
         welcome_msg = f"{greeting} I'm your AI Assistant. Please tell me how I can help you."
         welcome_message = {"role": "assistant", "content": welcome_msg}
-        st.session_state.conversation.append(welcome_message)
+        chat.conversation.append(welcome_message)
         
         # Save to MongoDB if connected
         if st.session_state.mongodb_connected:
@@ -734,22 +1054,22 @@ with col2:
     if st.session_state.mongodb_connected:
         st.markdown("---")
         st.subheader("Current Session")
-        st.code(st.session_state.session_id)
+        st.code(chat.session_id)
 
 # Clean up when app is closed
 def cleanup():
-    # Stop the speech thread
-    st.session_state.speech_thread_running = False
-    st.session_state.stop_speaking = True
+    # Stop background jobs, the ones cut short are marked interrupted at the next start
+    close_all_queues()
     
-    # Wait for queue to empty
-    if 'speech_queue' in st.session_state:
-        while not st.session_state.speech_queue.empty():
-            try:
-                st.session_state.speech_queue.get_nowait()
-                st.session_state.speech_queue.task_done()
-            except:
-                pass
+    # Drain pending MongoDB writes first, they don't depend on the session
+    # (there are none if MongoDB was never connected and the store never imported)
+    conversation_store = sys.modules.get("conversation_store")
+    if conversation_store is not None:
+        conversation_store.close_all_writers()
+    
+    # Stop speaking and end the pipeline threads
+    if 'speech_pipeline' in st.session_state:
+        st.session_state.speech_pipeline.close()
 
 # Register cleanup
 import atexit
@@ -0,0 +1,135 @@
+"""Content-addressed storage for generated images.
+
+Images are kept as the exact bytes the API returned, keyed by their SHA-256,
+so conversation messages only need to carry the key. Files live on local disk
+and are optionally mirrored to a GridFS bucket so other app instances (and
+sessions loaded later from MongoDB) can fetch them.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image
+
+THUMBNAIL_SIZE = (512, 512)
+THUMBNAIL_CACHE_SIZE = 128
+
+# Thumbnails are content addressed too, so one cache serves every session in the process
+_thumbnails = OrderedDict()
+_thumbnails_lock = threading.Lock()
+
+
+def image_key(data):
+    """SHA-256 hex digest used as the image reference"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_image_key(key):
+    """Whether key is an image reference, keys come from URLs and imports and end up in paths"""
+    return isinstance(key, str) and re.fullmatch(r"[0-9a-f]{64}", key) is not None
+
+
+class ImageStore:
+    """Raw image bytes on disk keyed by content hash, with an optional GridFS mirror"""
+
+    def __init__(self, root, bucket=None):
+        self.root = root
+        self.bucket = bucket
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key, kind="images", suffix=""):
+        if not is_image_key(key):
+            raise ValueError(f"Not an image key: {key!r}")
+        return os.path.join(self.root, kind, key[:2], key + suffix)
+
+    def _write_file(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file first so readers never see a partial image
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def put(self, data):
+        """Store image bytes and return their key, storing identical images only once"""
+        key = image_key(data)
+        path = self._path(key)
+        if not os.path.exists(path):
+            self._write_file(path, data)
+
+        if self.bucket is not None:
+            from gridfs.errors import FileExists
+
+            # Skip the upload when another session already stored the same image
+            try:
+                if not any(True for _ in self.bucket.find({"_id": key}).limit(1)):
+                    self.bucket.upload_from_stream_with_id(key, key, BytesIO(data))
+            except FileExists:
+                pass
+        return key
+
+    def contains(self, key):
+        """Whether the image is available locally or in GridFS"""
+        if not is_image_key(key):
+            return False
+        if os.path.exists(self._path(key)):
+            return True
+        if self.bucket is not None:
+            return any(True for _ in self.bucket.find({"_id": key}).limit(1))
+        return False
+
+    def get(self, key):
+        """Image bytes for a key, or None when neither tier has it"""
+        if not is_image_key(key):
+            return None
+        path = self._path(key)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+
+        if self.bucket is not None:
+            from gridfs.errors import NoFile
+
+            try:
+                data = self.bucket.open_download_stream(key).read()
+            except NoFile:
+                return None
+            # Keep a local copy for the next request
+            self._write_file(path, data)
+            return data
+        return None
+
+    def thumbnail(self, key, size=THUMBNAIL_SIZE):
+        """Downscaled JPEG of an image for the chat view, cached in memory and on disk"""
+        if not is_image_key(key):
+            return None
+        cache_key = (key, size)
+        with _thumbnails_lock:
+            if cache_key in _thumbnails:
+                _thumbnails.move_to_end(cache_key)
+                return _thumbnails[cache_key]
+
+        path = self._path(key, kind="thumbnails", suffix=f"-{size[0]}x{size[1]}")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                thumb = f.read()
+        else:
+            data = self.get(key)
+            if data is None:
+                return None
+            img = Image.open(BytesIO(data))
+            img.thumbnail(size)
+            buffer = BytesIO()
+            img.convert("RGB").save(buffer, format="JPEG", quality=85)
+            thumb = buffer.getvalue()
+            self._write_file(path, thumb)
+
+        with _thumbnails_lock:
+            _thumbnails[cache_key] = thumb
+            while len(_thumbnails) > THUMBNAIL_CACHE_SIZE:
+                _thumbnails.popitem(last=False)
+        return thumb
@@ -0,0 +1,137 @@
+"""Token-boundary intent routing for assistant commands.
+
+Commands are declared as phrases ("open youtube", "draw", ...) and compiled
+into a trie over lowercase word tokens. Routing walks the trie from every
+token of the query once, so its cost depends on the query length and the
+longest phrase, not on how many commands are registered. Phrases only match
+whole words: "withdraw" never triggers "draw".
+
+Handlers are attached separately so the command table stays plain data that
+can be loaded, benchmarked and tested without the app.
+"""
+import re
+
+_TOKEN = re.compile(r"[\w']+")
+
+# Built-in commands, in priority order (earlier entries win when several match)
+BUILTIN_COMMANDS = [
+    {"name": "generate_image", "phrases": ["generate image", "create image"], "anchor": "start", "arg": "prompt"},
+    {"name": "generate_image", "phrases": ["draw", "picture of"], "arg": "prompt"},
+    {"name": "wikipedia", "phrases": ["wikipedia"], "arg": "topic", "take": "rest"},
+    {"name": "open_youtube", "phrases": ["open youtube"]},
+    {"name": "open_google", "phrases": ["open google"]},
+    {"name": "open_stackoverflow", "phrases": ["open stackoverflow", "open stack overflow"]},
+    {"name": "time", "phrases": ["the time"]},
+    {"name": "exit", "phrases": ["goodbye", "exit"]},
+]
+
+
+def tokenize(text):
+    """Lowercase word tokens with their character spans in the original text"""
+    return [(m.group().lower(), m.start(), m.end()) for m in _TOKEN.finditer(text)]
+
+
+class Command:
+    """A registered command phrase and how to extract its argument"""
+
+    def __init__(self, name, phrase, priority, anchor="anywhere", arg=None, take="after"):
+        self.name = name
+        self.phrase = phrase
+        self.priority = priority
+        self.anchor = anchor
+        self.arg = arg
+        self.take = take
+
+
+class Intent:
+    """Routing result: the command name, its handler and extracted arguments"""
+
+    def __init__(self, name, args, handler=None, phrase=None):
+        self.name = name
+        self.args = args
+        self.handler = handler
+        self.phrase = phrase
+
+    def __repr__(self):
+        return f"Intent({self.name!r}, {self.args!r})"
+
+
+class IntentRouter:
+    """Compiles command phrases into a token trie and routes queries through it"""
+
+    _TERMINAL = object()
+
+    def __init__(self, specs=None):
+        self._trie = {}
+        self._handlers = {}
+        self._enabled = {}
+        self._count = 0
+        for spec in specs or []:
+            self.register(**spec)
+
+    def register(self, name, phrases, anchor="anywhere", arg=None, take="after", handler=None, priority=None):
+        """Add phrases for a command, anchor is "start" or "anywhere", take is "after" or "rest"."""
+        if priority is None:
+            priority = self._count
+        self._count += 1
+
+        for phrase in phrases:
+            node = self._trie
+            for token, _, _ in tokenize(phrase):
+                node = node.setdefault(token, {})
+            node.setdefault(self._TERMINAL, []).append(Command(name, phrase, priority, anchor, arg, take))
+        if handler is not None:
+            self._handlers[name] = handler
+
+    def handler(self, name, enabled=None):
+        """Decorator attaching a handler to a command.
+
+        enabled, if given, is called with the routing context and decides
+        whether the command is available for this query.
+        """
+        def decorator(func):
+            self._handlers[name] = func
+            if enabled is not None:
+                self._enabled[name] = enabled
+            return func
+        return decorator
+
+    def matches(self, text):
+        """Every command phrase found in the text as (command, start token, end token)"""
+        tokens = tokenize(text)
+        found = []
+        for start in range(len(tokens)):
+            node = self._trie
+            for end in range(start, len(tokens)):
+                node = node.get(tokens[end][0])
+                if node is None:
+                    break
+                for command in node.get(self._TERMINAL, ()):
+                    if command.anchor == "start" and start != 0:
+                        continue
+                    found.append((command, start, end))
+        return tokens, found
+
+    def route(self, text, context=None):
+        """Best matching intent for the text, or None for a general query"""
+        tokens, found = self.matches(text)
+        best = None
+        for command, start, end in found:
+            enabled = self._enabled.get(command.name)
+            if enabled is not None and not enabled(context):
+                continue
+            # Highest priority first, then the earliest and longest phrase
+            rank = (command.priority, start, -(end - start))
+            if best is None or rank < best[0]:
+                best = (rank, command, start, end)
+
+        if best is None:
+            return None
+
+        _, command, start, end = best
+        args = {}
+        if command.arg:
+            before = text[:tokens[start][1]].strip()
+            after = text[tokens[end][2]:].strip()
+            args[command.arg] = after if command.take == "after" else " ".join(p for p in (before, after) if p)
+        return Intent(command.name, args, self._handlers.get(command.name), command.phrase)
@@ -0,0 +1,276 @@
+"""Background jobs for long-running work such as image generation.
+
+A turn that starts a job returns right away with a placeholder message, while
+the job runs on a small thread pool and fills the placeholder in when it is
+done. Every job has a row in a SQLite table (session, kind, status, progress,
+result, error), so its state outlives Streamlit reruns and the page that
+started it, and a restart can tell which jobs never finished: the callables
+themselves can't be persisted, so jobs that were queued or running when their
+process stopped are marked interrupted. Each row records the process and queue
+that own it, so several processes (the Streamlit app and chat_server, say) can
+share the table without one's startup interrupting the other's live jobs.
+
+Each session may only have a few jobs queued or running at once, so one user
+can't fill the pool for everyone else.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+ACTIVE_STATUSES = ("queued", "running")
+FINISHED_STATUSES = ("done", "failed", "cancelled", "interrupted")
+
+# Queues still alive in this process, stopped by close_all_queues at exit
+_queues = weakref.WeakSet()
+
+
+def _pid_alive(pid):
+    """Whether a process with this pid is still running"""
+    if pid == os.getpid():
+        return True
+    if os.name == "nt":
+        # os.kill(pid, 0) would send CTRL_C_EVENT on Windows
+        import ctypes
+
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        try:
+            code = ctypes.c_ulong()
+            return bool(kernel32.GetExitCodeProcess(handle, ctypes.byref(code))) and code.value == 259  # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Someone else's process, but alive
+        return True
+    return True
+
+
+class JobLimitError(Exception):
+    """The session already has as many active jobs as it may"""
+
+
+class Job:
+    """Handle passed to a running job: its ids, a cancel event and progress reporting"""
+
+    def __init__(self, queue, job_id, session_id, kind):
+        self.queue = queue
+        self.job_id = job_id
+        self.session_id = session_id
+        self.kind = kind
+        self.cancel_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def progress(self, done, total=None):
+        """Record how far the job got, e.g. images delivered out of images requested"""
+        self.queue._update(self.job_id, progress_done=done, progress_total=total)
+
+
+class JobQueue:
+    """Thread pool for background jobs with a persistent job table and a per-session cap"""
+
+    def __init__(self, path=None, workers=4, max_per_session=2, max_finished=10_000):
+        self.max_per_session = max_per_session
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        # Identifies this queue's rows in a table shared with other queues and processes
+        self._owner = uuid.uuid4().hex
+        # job_id -> (Job, callable) for jobs that are reserved or running in this process
+        self._live = {}
+        self._conn = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, session_id TEXT NOT NULL, kind TEXT NOT NULL, description TEXT, "
+            "status TEXT NOT NULL, progress_done INTEGER, progress_total INTEGER, result TEXT, error TEXT, "
+            "created_at REAL NOT NULL, started_at REAL, finished_at REAL, owner TEXT, owner_pid INTEGER)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "owner" not in columns:
+            # Tables from before owners: their jobs count as owned by no one
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN owner_pid INTEGER")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_session ON jobs (session_id, status)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at)")
+        self._recover()
+        self._conn.commit()
+        _queues.add(self)
+
+    def _recover(self):
+        """Mark interrupted the active jobs whose owner is gone: a dead process, or a queue of ours that was closed"""
+        live_here = {jobs._owner for jobs in list(_queues)}
+        owners = self._conn.execute(
+            "SELECT DISTINCT owner, owner_pid FROM jobs WHERE status IN ('queued', 'running')"
+        ).fetchall()
+        gone = []
+        for owner, pid in owners:
+            if owner is None:
+                continue
+            alive = owner in live_here if pid == os.getpid() else _pid_alive(pid)
+            if not alive:
+                gone.append(owner)
+        now = time.time()
+        self._conn.execute(
+            "UPDATE jobs SET status = 'interrupted', finished_at = ? "
+            "WHERE status IN ('queued', 'running') AND owner IS NULL",
+            (now,),
+        )
+        self._conn.executemany(
+            "UPDATE jobs SET status = 'interrupted', finished_at = ? "
+            "WHERE status IN ('queued', 'running') AND owner = ?",
+            [(now, owner) for owner in gone],
+        )
+
+    # Submitting
+
+    def reserve(self, session_id, kind, description=""):
+        """Create a queued job without starting it, returns its id.
+
+        Raises JobLimitError when the session is at its cap. Use this when the
+        job's result has to go somewhere that doesn't exist yet (e.g. a
+        message that is saved after the turn), then start() it.
+        """
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            (active,) = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE session_id = ? AND status IN ('queued', 'running')",
+                (session_id,),
+            ).fetchone()
+            if active >= self.max_per_session:
+                raise JobLimitError(f"Session already has {active} jobs in progress")
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, session_id, kind, description, status, created_at, owner, owner_pid) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, session_id, kind, description, time.time(), self._owner, os.getpid()),
+            )
+            self._conn.commit()
+            self._live[job_id] = (Job(self, job_id, session_id, kind), None)
+        return job_id
+
+    def start(self, job_id, func):
+        """Run func(job) on the pool for a reserved job, its return value (JSON) is the result"""
+        with self._lock:
+            job, _ = self._live[job_id]
+            self._live[job_id] = (job, func)
+        self._executor.submit(self._execute, job, func)
+
+    def submit(self, session_id, kind, func, description=""):
+        """Reserve and start a job, returns its id right away"""
+        job_id = self.reserve(session_id, kind, description)
+        self.start(job_id, func)
+        return job_id
+
+    def cancel(self, job_id):
+        """Ask a job to stop, a job that hasn't started yet never runs"""
+        with self._lock:
+            live = self._live.get(job_id)
+        if live is None:
+            return False
+        job, func = live
+        job.cancel_event.set()
+        if func is None:
+            # Reserved but never started
+            self._finish(job_id, "cancelled")
+        return True
+
+    def cancel_session(self, session_id):
+        with self._lock:
+            job_ids = [job_id for job_id, (job, _) in self._live.items() if job.session_id == session_id]
+        for job_id in job_ids:
+            self.cancel(job_id)
+
+    # Running
+
+    def _execute(self, job, func):
+        if job.cancelled:
+            self._finish(job.job_id, "cancelled")
+            return
+        self._update(job.job_id, status="running", started_at=time.time())
+        try:
+            result = func(job)
+        except Exception as e:
+            self._finish(job.job_id, "failed", error=str(e))
+            return
+        self._finish(job.job_id, "cancelled" if job.cancelled else "done", result=result)
+
+    def _update(self, job_id, **fields):
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*fields.values(), job_id))
+            self._conn.commit()
+
+    def _finish(self, job_id, status, result=None, error=None):
+        with self._lock:
+            self._live.pop(job_id, None)
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE job_id = ?",
+                (status, None if result is None else json.dumps(result), error, time.time(), job_id),
+            )
+            # Forget the oldest finished jobs once over the cap
+            self._conn.execute(
+                "DELETE FROM jobs WHERE job_id IN ("
+                "SELECT job_id FROM jobs WHERE finished_at IS NOT NULL "
+                "ORDER BY finished_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_finished,),
+            )
+            self._conn.commit()
+
+    # Queries
+
+    @staticmethod
+    def _row(row):
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def get(self, job_id):
+        """Job record (status, progress, result, error, timestamps) or None"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._row(row) if row else None
+
+    def list(self, session_id, active_only=False, limit=50):
+        """A session's jobs, newest first"""
+        query = "SELECT * FROM jobs WHERE session_id = ?"
+        if active_only:
+            query += " AND status IN ('queued', 'running')"
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY created_at DESC LIMIT ?", (session_id, limit)).fetchall()
+        return [self._row(row) for row in rows]
+
+    def stats(self):
+        """Number of jobs per status"""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = dict.fromkeys(ACTIVE_STATUSES + FINISHED_STATUSES, 0)
+        counts.update({status: count for status, count in rows})
+        return counts
+
+    def close(self, wait=False):
+        """Cancel what is still queued or running and stop the pool"""
+        with self._lock:
+            live = list(self._live)
+        for job_id in live:
+            self.cancel(job_id)
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+        _queues.discard(self)
+
+
+def close_all_queues():
+    """Stop every live queue, used from the app's atexit cleanup"""
+    for jobs in list(_queues):
+        jobs.close()
@@ -0,0 +1,452 @@
+"""Vector index over stored messages for recalling relevant past exchanges.
+
+Messages are embedded as they are saved and appended to a flat float32 file
+that is memory-mapped for search, so opening an index with millions of
+vectors is instant and only the pages a search touches are read. Metadata
+(message id, session, owner, role, text) lives in a SQLite table keyed by row.
+
+Every entry has an owner, the user whose history it belongs to (by default
+its session), and a search given an owner only scores that owner's rows, so
+one index can serve many users without recalling anyone else's messages.
+
+Search is exact (a chunked matrix-vector product) until the index is
+trained, then IVF: vectors are grouped around k-means centroids and a query
+only scores the lists of its `nprobe` nearest centroids, plus anything added
+since training.
+
+The embedding function is pluggable. The default HashingEmbedder needs no
+model or network, so indexing and tests run offline.
+
+Usage:
+    python memory_index.py --mongo mongodb://localhost:27017/ --index-dir memory_index --train
+"""
+import argparse
+import json
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+import numpy as np
+
+from text_terms import words as text_words
+
+DEFAULT_DIM = 256
+SEARCH_CHUNK = 65536
+SNIPPET_LENGTH = 1000
+
+# Train IVF lists automatically once this many vectors are indexed
+AUTO_TRAIN_THRESHOLD = 50_000
+
+
+def normalize(vectors):
+    """Scale rows to unit length so dot products are cosine similarities"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _save_atomic(path, save):
+    """Write a file through save(f) into a temp file and rename it over path"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            save(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class HashingEmbedder:
+    """Offline embedding from hashed word unigrams and bigrams (signed feature hashing)"""
+
+    name = "hashing"
+
+    def __init__(self, dim=DEFAULT_DIM):
+        self.dim = dim
+
+    def __call__(self, texts):
+        rows, cols, signs = [], [], []
+        for row, text in enumerate(texts):
+            words = text_words(text)
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                h = zlib.crc32(feature.encode())
+                rows.append(row)
+                cols.append(h % self.dim)
+                signs.append(1.0 if h & 0x80000000 else -1.0)
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        np.add.at(vectors, (rows, cols), signs)
+        return normalize(vectors)
+
+
+def memory_item(message, owner=None):
+    """Index entry for a stored message document, owned by owner or else by its session"""
+    return {
+        "message_id": str(message.get("_id") or uuid.uuid4().hex),
+        "session_id": message.get("session_id"),
+        "owner": owner or message.get("session_id"),
+        "role": message.get("role"),
+        "text": (message.get("content") or "")[:SNIPPET_LENGTH],
+        "timestamp": message["timestamp"].timestamp() if message.get("timestamp") else time.time(),
+    }
+
+
+class MemoryIndex:
+    """Append-only vector index on disk with memory-mapped flat and IVF search"""
+
+    def __init__(self, path, embed=None, nprobe=16, auto_train=True, batch_size=256, flush_interval=0.5):
+        self.path = path
+        self.embed = embed or HashingEmbedder()
+        self.dim = self.embed.dim
+        self.nprobe = nprobe
+        self.auto_train = auto_train
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        os.makedirs(path, exist_ok=True)
+        self._check_info()
+
+        self._lock = threading.RLock()
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._db = sqlite3.connect(os.path.join(path, "meta.sqlite3"), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "row INTEGER PRIMARY KEY, message_id TEXT UNIQUE NOT NULL, session_id TEXT, owner TEXT, role TEXT, "
+            "text TEXT, timestamp REAL)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(messages)")}
+        if "owner" not in columns:
+            # Indexes from before owners: each message belongs to its own session
+            self._db.execute("ALTER TABLE messages ADD COLUMN owner TEXT")
+            self._db.execute("UPDATE messages SET owner = session_id")
+        self._db.execute("CREATE INDEX IF NOT EXISTS messages_owner ON messages (owner, row)")
+        self._db.commit()
+        self._count = self._recover()
+        self._matrix = None
+        self._ivf = self._load_ivf()
+        # Owner of each row as a small integer code, loaded by the first search that filters by owner
+        self._row_owners = None
+        self._owner_codes = None
+
+        self._queue = queue.Queue()
+        self._thread = None
+
+    # Storage
+
+    def _check_info(self):
+        info_path = os.path.join(self.path, "index.json")
+        info = {"dim": self.dim, "embedder": getattr(self.embed, "name", type(self.embed).__name__)}
+        if os.path.exists(info_path):
+            with open(info_path) as f:
+                stored = json.load(f)
+            if stored != info:
+                raise ValueError(f"Index at {self.path} was built with {stored}, not {info}")
+        else:
+            with open(info_path, "w") as f:
+                json.dump(info, f)
+
+    def _recover(self):
+        """Row count, dropping a partial append left by a crash"""
+        rows_in_meta = self._db.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM messages").fetchone()[0]
+        row_bytes = self.dim * 4
+        rows_on_disk = os.path.getsize(self._vectors_path) // row_bytes if os.path.exists(self._vectors_path) else 0
+        count = min(rows_in_meta, rows_on_disk)
+        if rows_on_disk != count:
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(count * row_bytes)
+        if rows_in_meta != count:
+            self._db.execute("DELETE FROM messages WHERE row >= ?", (count,))
+            self._db.commit()
+        return count
+
+    def __len__(self):
+        return self._count
+
+    def _vectors(self):
+        """Memory-mapped view of all indexed vectors, reopened when the index grows"""
+        with self._lock:
+            if self._matrix is None or len(self._matrix) != self._count:
+                if self._count == 0:
+                    return np.zeros((0, self.dim), dtype=np.float32)
+                self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r",
+                                         shape=(self._count, self.dim))
+            return self._matrix
+
+    def add(self, items):
+        """Embed and append index entries (see memory_item), skipping ids already indexed"""
+        items = [item for item in items if item.get("text")]
+        if not items:
+            return 0
+        with self._lock:
+            ids = [item["message_id"] for item in items]
+            placeholders = ",".join("?" * len(ids))
+            known = {row[0] for row in self._db.execute(
+                f"SELECT message_id FROM messages WHERE message_id IN ({placeholders})", ids
+            )}
+            fresh, seen = [], set(known)
+            for item in items:
+                if item["message_id"] not in seen:
+                    seen.add(item["message_id"])
+                    fresh.append(item)
+            if not fresh:
+                return 0
+
+            vectors = np.ascontiguousarray(self.embed([item["text"] for item in fresh]), dtype=np.float32)
+            with open(self._vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            self._db.executemany(
+                "INSERT INTO messages (row, message_id, session_id, owner, role, text, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (self._count + i, item["message_id"], item.get("session_id"),
+                     item.get("owner") or item.get("session_id"), item.get("role"), item["text"], item.get("timestamp"))
+                    for i, item in enumerate(fresh)
+                ],
+            )
+            self._db.commit()
+            if self._row_owners is not None:
+                codes = [self._owner_codes.setdefault(item.get("owner") or item.get("session_id"),
+                                                      len(self._owner_codes)) for item in fresh]
+                self._row_owners = np.concatenate([self._row_owners, np.array(codes, dtype=np.int32)])
+            self._count += len(fresh)
+            return len(fresh)
+
+    # Background indexing
+
+    def put(self, item):
+        """Queue an entry for indexing on the background thread"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="memory-index", daemon=True)
+                self._thread.start()
+        self._queue.put(item)
+
+    def flush(self, timeout=5):
+        """Wait until queued entries are searchable, returns False on timeout"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self.add(batch)
+                if self.auto_train and self._needs_training():
+                    self.train()
+            except Exception:
+                # Memory is best effort, a lost entry only means a missed recall
+                pass
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    # IVF
+
+    def _needs_training(self):
+        if self._count < AUTO_TRAIN_THRESHOLD:
+            return False
+        # Retrain once the unindexed tail is a fifth of the index
+        trained = self._ivf["trained_count"] if self._ivf else 0
+        return self._count - trained > self._count // 5
+
+    def _load_ivf(self):
+        path = os.path.join(self.path, "ivf.npz")
+        if not os.path.exists(path):
+            return None
+        data = np.load(path)
+        ivf = {key: data[key] for key in ("centroids", "offsets")}
+        ivf["trained_count"] = int(data["trained_count"])
+        ivf["order"] = np.load(os.path.join(self.path, "ivf_order.npy"), mmap_mode="r")
+        # Left over from a training that stopped between the two files
+        if len(ivf["order"]) != ivf["trained_count"]:
+            return None
+        return ivf
+
+    def train(self, nlist=None, iterations=8, seed=0):
+        """Cluster the vectors into nlist lists (spherical k-means on a sample) and assign every row"""
+        vectors = self._vectors()
+        count = len(vectors)
+        if count == 0:
+            return
+        nlist = nlist or max(1, int(np.sqrt(count)))
+        rng = np.random.default_rng(seed)
+        # About 40 points per list is enough to place the centroids
+        sample_size = min(count, 40 * nlist)
+        sample = np.asarray(vectors[np.sort(rng.choice(count, sample_size, replace=False))])
+        centroids = sample[rng.choice(len(sample), min(nlist, len(sample)), replace=False)]
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            empty = np.bincount(assign, minlength=len(centroids)) == 0
+            # Reseed empty lists with random sample rows
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            centroids = normalize(sums)
+
+        assign = np.empty(count, dtype=np.int32)
+        for start in range(0, count, SEARCH_CHUNK):
+            assign[start:start + SEARCH_CHUNK] = np.argmax(vectors[start:start + SEARCH_CHUNK] @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable").astype(np.int32)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=len(centroids)))])
+
+        ivf = {"centroids": centroids, "offsets": offsets, "trained_count": count, "order": order}
+        try:
+            # The old order file may be mapped by a search running right now, so it's replaced, never rewritten
+            _save_atomic(os.path.join(self.path, "ivf_order.npy"), lambda f: np.save(f, order))
+            _save_atomic(os.path.join(self.path, "ivf.npz"),
+                         lambda f: np.savez(f, centroids=centroids, offsets=offsets, trained_count=count))
+        except OSError:
+            # Windows refuses to replace a mapped file, the lists are used from memory until the next training
+            pass
+        else:
+            ivf = self._load_ivf()
+        with self._lock:
+            self._ivf = ivf
+
+    # Search
+
+    def _candidates(self, q, nprobe):
+        """Rows to score: the probed IVF lists plus the untrained tail, or None for a full scan"""
+        ivf = self._ivf
+        if ivf is None:
+            return None
+        probes = np.argsort(ivf["centroids"] @ q)[-nprobe:]
+        rows = [ivf["order"][ivf["offsets"][c]:ivf["offsets"][c + 1]] for c in probes]
+        rows.append(np.arange(ivf["trained_count"], self._count, dtype=np.int32))
+        # Sorted rows read the memory map front to back
+        return np.sort(np.concatenate(rows))
+
+    def _owners(self):
+        """Owner code of every row and the codes by owner, read from SQLite on first use"""
+        with self._lock:
+            if self._row_owners is None:
+                codes, row_owners = {}, np.zeros(self._count, dtype=np.int32)
+                for row, owner in self._db.execute("SELECT row, owner FROM messages"):
+                    row_owners[row] = codes.setdefault(owner, len(codes))
+                self._owner_codes, self._row_owners = codes, row_owners
+            return self._row_owners, self._owner_codes
+
+    def search(self, query, k=5, exclude_texts=(), min_score=None, nprobe=None, exact=False, owner=None):
+        """Top-k entries most similar to the query as dicts with a score, only the owner's when given"""
+        vectors = self._vectors()
+        if len(vectors) == 0 or not query:
+            return []
+        q = self.embed([query])[0]
+        want = k + len(exclude_texts)
+
+        rows = None if exact else self._candidates(q, nprobe or self.nprobe)
+        mask = None
+        if owner is not None:
+            row_owners, codes = self._owners()
+            if owner not in codes:
+                return []
+            if rows is not None:
+                rows = rows[row_owners[rows] == codes[owner]]
+            else:
+                mask = row_owners[:len(vectors)] == codes[owner]
+                # A few rows are gathered, most of the index is cheaper to scan in order and mask
+                if mask.sum() * 4 < len(mask):
+                    rows, mask = np.flatnonzero(mask), None
+        best_rows, best_scores = [], []
+        total = len(vectors) if rows is None else len(rows)
+        for start in range(0, total, SEARCH_CHUNK):
+            if rows is None:
+                chunk = np.arange(start, min(start + SEARCH_CHUNK, total))
+                scores = vectors[start:start + SEARCH_CHUNK] @ q
+                if mask is not None:
+                    scores = np.where(mask[start:start + SEARCH_CHUNK], scores, -np.inf)
+            else:
+                chunk = rows[start:start + SEARCH_CHUNK]
+                scores = vectors[chunk] @ q
+            top = np.argpartition(scores, -min(want, len(scores)))[-want:]
+            best_rows.append(chunk[top])
+            best_scores.append(scores[top])
+        if not best_rows:
+            return []
+        rows, scores = np.concatenate(best_rows), np.concatenate(best_scores)
+        if mask is not None:
+            # Masked out rows can only fill up a chunk's top
+            rows, scores = rows[np.isfinite(scores)], scores[np.isfinite(scores)]
+
+        top = np.argsort(scores)[::-1][:want]
+        if min_score is not None:
+            top = top[scores[top] >= min_score]
+        top_rows = [int(row) for row in rows[top]]
+        with self._lock:
+            entries = {entry[0]: entry[1:] for entry in self._db.execute(
+                "SELECT row, message_id, session_id, role, text, timestamp FROM messages "
+                f"WHERE row IN ({','.join('?' * len(top_rows))})", top_rows
+            )}
+
+        results = []
+        for row, score in zip(top_rows, scores[top]):
+            entry = entries.get(row)
+            if entry is None or entry[3] in exclude_texts:
+                continue
+            results.append({
+                "score": float(score),
+                "message_id": entry[0],
+                "session_id": entry[1],
+                "role": entry[2],
+                "text": entry[3],
+                "timestamp": entry[4],
+            })
+            if len(results) == k:
+                break
+        return results
+
+
+def index_collection(index, collection, batch_size=1000, owner=None):
+    """Index every stored message of a conversations collection, returns how many were added"""
+    added = 0
+    batch = []
+    for doc in collection.find({}, {"session_id": 1, "role": 1, "content": 1, "timestamp": 1}).sort("timestamp", 1):
+        batch.append(memory_item(doc, owner))
+        if len(batch) == batch_size:
+            added += index.add(batch)
+            batch = []
+    return added + index.add(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the memory index from stored conversations")
+    parser.add_argument("--mongo", default=os.environ.get("MONGODB_CONNECTION_STRING"), required=False)
+    parser.add_argument("--index-dir", default=os.environ.get("MEMORY_INDEX_DIR", "memory_index"))
+    parser.add_argument("--train", action="store_true", help="Train IVF lists after indexing")
+    args = parser.parse_args()
+    if not args.mongo:
+        parser.error("--mongo or MONGODB_CONNECTION_STRING is required")
+
+    import pymongo
+
+    from client_registry import credential_id
+
+    index = MemoryIndex(args.index_dir, auto_train=False)
+    started = time.perf_counter()
+    # Owned by the database's connection, like the messages the app indexes while connected to it
+    added = index_collection(index, pymongo.MongoClient(args.mongo).assistant_db.conversations,
+                             owner=credential_id(args.mongo))
+    print(f"Indexed {added} new messages ({len(index)} total) in {time.perf_counter() - started:.1f}s")
+    if args.train:
+        index.train()
+        print(f"Trained IVF lists over {len(index)} vectors")
+
+
+if __name__ == "__main__":
+    main()
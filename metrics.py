@@ -0,0 +1,295 @@
+"""Per-stage latency tracing, exported as Prometheus text and JSON log lines.
+
+A span times one stage of a turn (routing, Gemini, Wikipedia, image
+generation, a MongoDB write, recognition, speech synthesis, ...). Spans
+opened inside another span on the same thread share its trace id, so the
+stages of one turn can be put back together from the logs.
+
+Every finished span updates:
+  * a process-wide histogram per stage (fixed buckets, for Prometheus)
+  * a window of recent durations per stage and per session, from which
+    p50/p95/p99 are computed on demand for the debug panel and the summary
+    lines of the Prometheus output
+  * an error counter per stage, when the span raised or was marked failed
+and, when JSON logging is enabled, is written as one JSON object per line to
+the "genai_chatbot.trace" logger.
+
+Recording is a lock, a few list appends and a bisect, so it stays on in
+production; quantiles are only sorted when someone asks for them.
+"""
+import bisect
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds, from a cache hit to a slow image render
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUANTILES = (0.5, 0.95, 0.99)
+
+logger = logging.getLogger("genai_chatbot.trace")
+
+# Span currently open on this thread (or asyncio task), parent of the next one
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+def _new_id():
+    # Random 64-bit id, uuid4 costs more than the rest of a span
+    return f"{random.getrandbits(64):016x}"
+
+
+def quantile(sorted_values, q):
+    """Nearest-rank quantile of an already sorted list"""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class Span:
+    """One timed stage, attributes can be added while it is open"""
+
+    __slots__ = ("stage", "session_id", "trace_id", "span_id", "parent_id", "attributes", "error", "started")
+
+    def __init__(self, stage, session_id, parent, attributes):
+        self.stage = stage
+        self.session_id = session_id or (parent.session_id if parent else None)
+        self.trace_id = parent.trace_id if parent else _new_id()
+        self.span_id = _new_id()
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.error = None
+        self.started = time.perf_counter()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def fail(self, error):
+        """Mark the stage as failed without raising, e.g. an error turned into a reply"""
+        self.error = str(error)
+
+
+class _NoopSpan:
+    """Stands in for a span while tracing is disabled"""
+
+    def set(self, **attributes):
+        pass
+
+    def fail(self, error):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _StageStats:
+    __slots__ = ("buckets", "count", "total", "errors", "recent")
+
+    def __init__(self, bucket_count, window):
+        self.buckets = [0] * (bucket_count + 1)
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self.recent = collections.deque(maxlen=window)
+
+
+class Tracer:
+    """Collects spans into per-stage and per-session latency statistics"""
+
+    def __init__(self, enabled=True, buckets=DEFAULT_BUCKETS, window=1024, session_window=256, max_sessions=1000):
+        self.enabled = enabled
+        self.bucket_bounds = tuple(buckets)
+        self.window = window
+        self.session_window = session_window
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._stages = {}
+        # session_id -> {stage: deque of durations}, least recently active session first
+        self._sessions = collections.OrderedDict()
+        self._recent_spans = collections.deque(maxlen=200)
+
+    @contextlib.contextmanager
+    def span(self, stage, session_id=None, **attributes):
+        """Time the block as a stage; an exception marks the span failed and propagates"""
+        if not self.enabled:
+            yield _NOOP_SPAN
+            return
+        span = Span(stage, session_id, _current.get(), attributes)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = span.error or f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current.reset(token)
+            self._finish(span, time.perf_counter() - span.started)
+
+    def record(self, stage, seconds, session_id=None, error=None, **attributes):
+        """Record a stage timed elsewhere, e.g. recognition latency measured by the speech service"""
+        if not self.enabled:
+            return
+        span = Span(stage, session_id, _current.get(), attributes)
+        span.error = None if error is None else str(error)
+        self._finish(span, seconds)
+
+    def _finish(self, span, seconds):
+        with self._lock:
+            stats = self._stages.get(span.stage)
+            if stats is None:
+                stats = self._stages[span.stage] = _StageStats(len(self.bucket_bounds), self.window)
+            stats.buckets[bisect.bisect_left(self.bucket_bounds, seconds)] += 1
+            stats.count += 1
+            stats.total += seconds
+            stats.recent.append(seconds)
+            if span.error is not None:
+                stats.errors += 1
+            if span.session_id is not None:
+                stages = self._sessions.get(span.session_id)
+                if stages is None:
+                    stages = self._sessions[span.session_id] = {}
+                    if len(self._sessions) > self.max_sessions:
+                        self._sessions.popitem(last=False)
+                else:
+                    self._sessions.move_to_end(span.session_id)
+                stages.setdefault(span.stage, collections.deque(maxlen=self.session_window)).append(seconds)
+            self._recent_spans.append((span, seconds))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(self._log_record(span, seconds), default=str))
+
+    @staticmethod
+    def _log_record(span, seconds):
+        record = {
+            "ts": round(time.time(), 3),
+            "stage": span.stage,
+            "duration_ms": round(seconds * 1000, 2),
+            "status": "error" if span.error is not None else "ok",
+            "trace_id": span.trace_id,
+            "span_id": span.span_id,
+        }
+        if span.parent_id:
+            record["parent_id"] = span.parent_id
+        if span.session_id:
+            record["session_id"] = span.session_id
+        if span.error is not None:
+            record["error"] = span.error
+        record.update(span.attributes)
+        return record
+
+    # Reading
+
+    def stats(self, session_id=None):
+        """{stage: count, p50_ms, p95_ms, p99_ms (and errors, total_ms process-wide)} for the process or a session"""
+        with self._lock:
+            if session_id is None:
+                windows = {stage: (list(s.recent), s) for stage, s in self._stages.items()}
+            else:
+                windows = {stage: (list(d), None) for stage, d in self._sessions.get(session_id, {}).items()}
+        result = {}
+        for stage, (values, totals) in sorted(windows.items()):
+            values.sort()
+            entry = {"count": totals.count if totals else len(values)}
+            for q in QUANTILES:
+                entry[f"p{int(q * 100)}_ms"] = round(quantile(values, q) * 1000, 1)
+            if totals:
+                entry["errors"] = totals.errors
+                entry["total_ms"] = round(totals.total * 1000, 1)
+            result[stage] = entry
+        return result
+
+    def recent_spans(self, session_id=None, limit=50):
+        """Latest finished spans as log records, newest first"""
+        with self._lock:
+            spans = list(self._recent_spans)
+        records = [
+            self._log_record(span, seconds) for span, seconds in reversed(spans)
+            if session_id is None or span.session_id == session_id
+        ]
+        return records[:limit]
+
+    def prometheus(self, prefix="genai_chatbot"):
+        """Prometheus text exposition: a latency histogram, recent-window quantiles and errors per stage"""
+        with self._lock:
+            stages = {
+                stage: (list(s.buckets), s.count, s.total, s.errors, sorted(s.recent))
+                for stage, s in self._stages.items()
+            }
+        name = f"{prefix}_stage_duration_seconds"
+        lines = [f"# HELP {name} Time spent per stage of a turn.", f"# TYPE {name} histogram"]
+        for stage, (buckets, count, total, _, _) in sorted(stages.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.bucket_bounds + (float("inf"),), buckets):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+
+        recent = f"{prefix}_stage_recent_seconds"
+        lines += [f"# HELP {recent} Quantiles over the most recent spans of each stage.", f"# TYPE {recent} summary"]
+        for stage, (_, _, _, _, values) in sorted(stages.items()):
+            for q in QUANTILES:
+                lines.append(f'{recent}{{stage="{stage}",quantile="{q}"}} {quantile(values, q):.6f}')
+
+        errors = f"{prefix}_stage_errors_total"
+        lines += [f"# HELP {errors} Spans that failed, per stage.", f"# TYPE {errors} counter"]
+        for stage, (_, _, _, error_count, _) in sorted(stages.items()):
+            lines.append(f'{errors}{{stage="{stage}"}} {error_count}')
+        return "\n".join(lines) + "\n"
+
+
+_tracer = Tracer()
+
+
+def get_tracer():
+    """The process-wide tracer shared by the engine, storage and speech components"""
+    return _tracer
+
+
+def enable_json_logs(destination="-"):
+    """Write every span as a JSON line to stderr ("-") or to a file"""
+    handler = logging.StreamHandler() if destination == "-" else logging.FileHandler(destination)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    # Span lines are complete records, don't repeat them through the root logger
+    logger.propagate = False
+    return handler
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    tracer = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.tracer.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port, host="0.0.0.0", tracer=None):
+    """Serve GET /metrics on a background thread, for processes without their own HTTP server"""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"tracer": tracer or get_tracer()})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def configure_from_env():
+    """TRACE_LOG (a path, or "-" for stderr) turns on JSON span logs"""
+    destination = os.environ.get("TRACE_LOG")
+    if destination and not logger.handlers:
+        enable_json_logs(destination)
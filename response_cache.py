@@ -0,0 +1,217 @@
+"""Prompt-keyed cache for backend responses.
+
+A small in-memory LRU sits in front of an optional persistent tier (SQLite on
+local disk or a MongoDB collection). Entries are namespaced by source
+("wikipedia", "image", "gemini", ...) and each source has its own TTL. Keys are
+normalized so trivial differences in case, spacing or trailing punctuation
+share one entry. Values must be JSON serializable.
+"""
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTLS = {
+    "wikipedia": 7 * 24 * 3600,
+    "image": 30 * 24 * 3600,
+    "gemini": 3600,
+}
+DEFAULT_TTL = 3600
+
+logger = logging.getLogger("genai_chatbot.response_cache")
+
+_WHITESPACE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s.?!,;:]+$")
+
+
+def normalize_text(text):
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    text = _WHITESPACE.sub(" ", str(text).strip().lower())
+    return _TRAILING_PUNCTUATION.sub("", text)
+
+
+def cache_key(source, *parts):
+    """Stable key for a source and its (normalized) request parameters"""
+    normalized = [normalize_text(p) if isinstance(p, str) else p for p in parts]
+    digest = hashlib.sha256(json.dumps(normalized, sort_keys=True, default=str).encode()).hexdigest()
+    return f"{source}:{digest}"
+
+
+class SQLiteTier:
+    """Persistent tier in a local SQLite file, bounded by entry count"""
+
+    def __init__(self, path, max_entries=100_000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, stored_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_stored_at ON responses (stored_at)")
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at < time.time():
+            self.delete(key)
+            return None
+        return json.loads(value), expires_at
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at, stored_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, time.time()),
+            )
+            # Evict the oldest entries once over the cap
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._conn.commit()
+
+
+class MongoTier:
+    """Persistent tier in a MongoDB collection, expired entries are removed by a TTL index"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.collection.create_index("expires", expireAfterSeconds=0)
+
+    def get(self, key):
+        doc = self.collection.find_one({"_id": key})
+        if doc is None or doc["expires_at"] < time.time():
+            return None
+        return doc["value"], doc["expires_at"]
+
+    def set(self, key, value, expires_at):
+        import datetime
+
+        self.collection.replace_one(
+            {"_id": key},
+            {
+                "value": value,
+                "expires_at": expires_at,
+                "expires": datetime.datetime.fromtimestamp(expires_at, datetime.timezone.utc),
+            },
+            upsert=True,
+        )
+
+    def delete(self, key):
+        self.collection.delete_one({"_id": key})
+
+
+def persistent_tier(sqlite_path=None, mongo_client=None, collection="response_cache"):
+    """MongoDB tier on the app's client when it has one, else SQLite at sqlite_path, else None.
+
+    A MongoDB server that can't be reached falls back to SQLite rather than
+    keeping the app from starting.
+    """
+    if mongo_client is not None:
+        from pymongo.errors import PyMongoError
+
+        # Shared by every app instance using the database
+        try:
+            return MongoTier(mongo_client.assistant_db[collection])
+        except PyMongoError as e:
+            logger.warning("MongoDB is unavailable, caching responses %s instead: %s",
+                           f"in {sqlite_path}" if sqlite_path else "in memory only", e)
+    if sqlite_path:
+        return SQLiteTier(sqlite_path)
+    return None
+
+
+class ResponseCache:
+    """In-memory LRU with per-source TTLs over an optional persistent tier"""
+
+    def __init__(self, max_entries=1024, ttls=None, backing=None):
+        self.max_entries = max_entries
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.backing = backing
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _count(self, source, outcome):
+        with self._lock:
+            counters = self._stats.setdefault(source, {"hits": 0, "misses": 0})
+            counters[outcome] += 1
+
+    def get(self, source, *parts):
+        """Cached value or None"""
+        key = cache_key(source, *parts)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] >= now:
+                    self._entries.move_to_end(key)
+                    self._stats.setdefault(source, {"hits": 0, "misses": 0})["hits"] += 1
+                    return entry[0]
+                del self._entries[key]
+
+        if self.backing is not None:
+            try:
+                stored = self.backing.get(key)
+            except Exception:
+                stored = None
+            if stored is not None:
+                self._remember(key, *stored)
+                self._count(source, "hits")
+                return stored[0]
+
+        self._count(source, "misses")
+        return None
+
+    def set(self, source, value, *parts, ttl=None):
+        """Cache a value for the source's TTL (or the given one)"""
+        key = cache_key(source, *parts)
+        expires_at = time.time() + (ttl if ttl is not None else self.ttls.get(source, DEFAULT_TTL))
+        self._remember(key, value, expires_at)
+        if self.backing is not None:
+            try:
+                self.backing.set(key, value, expires_at)
+            except Exception:
+                pass
+
+    def get_or_compute(self, source, parts, compute, ttl=None):
+        """Return the cached value or compute, cache and return it (None results aren't cached)"""
+        value = self.get(source, *parts)
+        if value is not None:
+            return value
+        value = compute()
+        if value is not None:
+            self.set(source, value, *parts, ttl=ttl)
+        return value
+
+    def _remember(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Hit/miss counters per source plus the in-memory entry count"""
+        with self._lock:
+            stats = {source: dict(counters) for source, counters in self._stats.items()}
+            entries = len(self._entries)
+        for counters in stats.values():
+            total = counters["hits"] + counters["misses"]
+            counters["hit_rate"] = round(counters["hits"] / total, 3) if total else None
+        return {"sources": stats, "entries": entries}
@@ -0,0 +1,252 @@
+"""Full-text search over stored messages, across sessions.
+
+With MongoDB, conversation_store.search_messages uses the collection's text
+index. SearchIndex is the same search without a server: an in-memory inverted
+index for mongomock, offline tests and benchmarks, kept up to date from the
+collection with sync().
+
+Every term maps to a sorted array of document numbers, and per-document
+columns hold the timestamp, role and session, so a query is a few binary
+searches plus vectorized filters and never looks at message text. Messages
+arrive roughly in time order, so while they do, document numbers are also
+time order: a date range is a slice and "newest first" is reading backwards.
+Text for snippets is fetched from the collection for the page being shown.
+
+Both paths match messages containing every word of the query (lowercased,
+stopwords dropped). MongoDB also stems words, the local index does not.
+"""
+import datetime
+import re
+import threading
+
+import numpy as np
+from bson import ObjectId
+
+from text_terms import STOPWORDS, WORD
+
+ROLES = ("user", "assistant")
+# What the index reads of a stored message
+_FIELDS = {"session_id": 1, "role": 1, "content": 1, "timestamp": 1}
+SNIPPET_WIDTH = 160
+
+
+def tokenize(text):
+    """Distinct search terms of a text, in order of first appearance"""
+    terms = []
+    for token in WORD.findall(text.lower()):
+        token = token.strip("'")
+        if len(token) > 1 and token not in STOPWORDS and token not in terms:
+            terms.append(token)
+    return terms
+
+
+def highlight(text, terms, width=SNIPPET_WIDTH):
+    """Part of the text around the first match, with every matched term in **bold**"""
+    if not terms:
+        return text[:width]
+    pattern = re.compile(r"\b(" + "|".join(re.escape(term) for term in terms) + r")\w*", re.IGNORECASE)
+    first = pattern.search(text)
+    start = 0 if first is None else max(0, first.start() - width // 3)
+    end = min(len(text), start + width)
+    # Don't cut words in half at either end
+    if start > 0:
+        space = text.find(" ", start, first.start() if first else end)
+        start = space + 1 if space != -1 else start
+    if end < len(text):
+        space = text.rfind(" ", start, end)
+        end = space if space > start else end
+    snippet = pattern.sub(lambda m: f"**{m.group(0)}**", text[start:end])
+    return ("…" if start > 0 else "") + snippet + ("…" if end < len(text) else "")
+
+
+def _epoch(value):
+    return value.timestamp() if isinstance(value, datetime.datetime) else float(value)
+
+
+class _Column:
+    """Growable numpy array, appended to in batches"""
+
+    __slots__ = ("data", "size")
+
+    def __init__(self, dtype, capacity=4):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.data.dtype)
+        end = self.size + len(values)
+        if end > len(self.data):
+            grown = np.empty(max(end, 2 * len(self.data)), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:end] = values
+        self.size = end
+
+    def view(self):
+        # Appends only write past size or into a new array, so a view stays valid without the lock
+        return self.data[:self.size]
+
+
+class SearchIndex:
+    """In-memory inverted index of message terms with time, role and session filters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._ids = _Column("V12", 1024)
+        self._timestamps = _Column(np.float64, 1024)
+        self._roles = _Column(np.uint8, 1024)
+        self._sessions = _Column(np.uint32, 1024)
+        self._session_numbers = {}
+        self._session_ids = []
+        # Document numbers are in timestamp order as long as messages arrive in order
+        self.ordered = True
+        # Highest _id indexed, sync() continues from there
+        self.last_id = None
+
+    def __len__(self):
+        return self._timestamps.size
+
+    def add(self, documents):
+        """Index message documents (_id, session_id, role, content, timestamp), returns how many"""
+        batch_postings = {}
+        ids, timestamps, roles, sessions = [], [], [], []
+        with self._lock:
+            first = self._timestamps.size
+            last_timestamp = self._timestamps.data[first - 1] if first else float("-inf")
+            for document in documents:
+                number = first + len(ids)
+                for term in tokenize(document.get("content") or ""):
+                    batch_postings.setdefault(term, []).append(number)
+                session_number = self._session_numbers.get(document["session_id"])
+                if session_number is None:
+                    session_number = self._session_numbers[document["session_id"]] = len(self._session_ids)
+                    self._session_ids.append(document["session_id"])
+                timestamp = _epoch(document["timestamp"])
+                if timestamp < last_timestamp:
+                    self.ordered = False
+                last_timestamp = timestamp
+                ids.append(document["_id"].binary)
+                timestamps.append(timestamp)
+                roles.append(ROLES.index(document["role"]) if document["role"] in ROLES else len(ROLES))
+                sessions.append(session_number)
+                if self.last_id is None or document["_id"] > self.last_id:
+                    self.last_id = document["_id"]
+            if not ids:
+                return 0
+            for term, numbers in batch_postings.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = _Column(np.uint32, max(4, len(numbers)))
+                postings.extend(numbers)
+            self._ids.extend(ids)
+            self._timestamps.extend(timestamps)
+            self._roles.extend(roles)
+            self._sessions.extend(sessions)
+        return len(ids)
+
+    def sync(self, collection, batch_size=5000):
+        """Index messages stored since the last sync, returns how many were added.
+
+        New messages are read from the highest _id indexed. Messages stored with
+        older _ids (ids made by other clients, imported exports) are caught up
+        with once the collection holds more messages than the index.
+        """
+        query = {} if self.last_id is None else {"_id": {"$gt": self.last_id}}
+        added = self._add_all(collection.find(query, _FIELDS).sort("_id", 1), batch_size)
+        if collection.estimated_document_count() > len(self):
+            with self._lock:
+                # numpy drops trailing zero bytes of the ids, so they are compared without them
+                known = set(self._ids.view().tolist())
+            missing = [document["_id"] for document in collection.find({}, {"_id": 1})
+                       if document["_id"].binary.rstrip(b"\0") not in known]
+            for start in range(0, len(missing), batch_size):
+                chunk = missing[start:start + batch_size]
+                added += self._add_all(collection.find({"_id": {"$in": chunk}}, _FIELDS).sort("_id", 1), batch_size)
+        return added
+
+    def _add_all(self, documents, batch_size):
+        added, batch = 0, []
+        for document in documents:
+            batch.append(document)
+            if len(batch) == batch_size:
+                added += self.add(batch)
+                batch = []
+        return added + self.add(batch)
+
+    def search(self, query, session_id=None, role=None, since=None, until=None, offset=0, limit=20):
+        """Messages containing every term of the query, newest first.
+
+        since is inclusive and until exclusive. Returns (hits, total) where
+        hits are dicts with _id, session_id, role and timestamp.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return [], 0
+        with self._lock:
+            lists = [self._postings.get(term) for term in terms]
+            if any(postings is None for postings in lists):
+                return [], 0
+            lists = sorted((postings.view() for postings in lists), key=len)
+            timestamps = self._timestamps.view()
+            roles = self._roles.view()
+            sessions = self._sessions.view()
+            ids = self._ids.view()
+            ordered = self.ordered
+            session_number = self._session_numbers.get(session_id) if session_id is not None else None
+        if session_id is not None and session_number is None:
+            return [], 0
+
+        candidates = lists[0]
+        if ordered and (since is not None or until is not None):
+            # The date range is a range of document numbers
+            low = 0 if since is None else np.searchsorted(timestamps, _epoch(since), "left")
+            high = len(timestamps) if until is None else np.searchsorted(timestamps, _epoch(until), "left")
+            candidates = candidates[np.searchsorted(candidates, low):np.searchsorted(candidates, high)]
+        for postings in lists[1:]:
+            if not len(candidates):
+                break
+            positions = np.minimum(np.searchsorted(postings, candidates), len(postings) - 1)
+            candidates = candidates[postings[positions] == candidates]
+
+        mask = None
+        if role is not None:
+            mask = roles[candidates] == (ROLES.index(role) if role in ROLES else len(ROLES))
+        if session_number is not None:
+            match = sessions[candidates] == session_number
+            mask = match if mask is None else mask & match
+        if not ordered and (since is not None or until is not None):
+            stamps = timestamps[candidates]
+            match = np.ones(len(candidates), dtype=bool)
+            if since is not None:
+                match &= stamps >= _epoch(since)
+            if until is not None:
+                match &= stamps < _epoch(until)
+            mask = match if mask is None else mask & match
+        if mask is not None:
+            candidates = candidates[mask]
+
+        total = len(candidates)
+        if offset >= total:
+            return [], total
+        if ordered:
+            page = candidates[max(0, total - offset - limit):total - offset][::-1]
+        else:
+            stamps = -timestamps[candidates]
+            top = offset + limit
+            if top < total:
+                chosen = np.argpartition(stamps, top - 1)[:top]
+            else:
+                chosen = np.arange(total)
+            page = candidates[chosen[np.argsort(stamps[chosen], kind="stable")]][offset:top]
+
+        hits = [
+            {
+                "_id": ObjectId(ids[number].tobytes()),
+                "session_id": self._session_ids[sessions[number]],
+                "role": ROLES[roles[number]] if roles[number] < len(ROLES) else None,
+                "timestamp": datetime.datetime.fromtimestamp(timestamps[number]),
+            }
+            for number in page
+        ]
+        return hits, total
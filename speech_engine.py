@@ -0,0 +1,205 @@
+"""Process-wide text-to-speech service.
+
+pyttsx3 engines are expensive to start (driver load plus voice enumeration)
+and are not safe to drive from several threads, so a single engine lives on a
+dedicated thread for the whole process. Streamlit reruns re-execute the app
+script but keep imported modules, so the service outlives every rerun.
+
+Besides speaking directly, the engine can render an utterance to a WAV clip
+(save_to_file), which speech_output plays in small interruptible blocks.
+"""
+import io
+import os
+import queue
+import tempfile
+import threading
+import time
+import wave
+
+import pyttsx3
+
+
+class Voice:
+    """Voice id and display name as reported by the driver"""
+
+    def __init__(self, voice_id, name):
+        self.id = voice_id
+        self.name = name
+
+
+class AudioClip:
+    """Raw PCM with its format"""
+
+    def __init__(self, pcm, sample_rate, channels=1, sample_width=2):
+        self.pcm = pcm
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+
+    @property
+    def seconds(self):
+        return len(self.pcm) / (self.sample_rate * self.channels * self.sample_width)
+
+    @classmethod
+    def from_wav(cls, path):
+        with wave.open(path, "rb") as wav:
+            return cls(wav.readframes(wav.getnframes()), wav.getframerate(), wav.getnchannels(), wav.getsampwidth())
+
+    def to_wav(self):
+        """The clip as WAV file bytes"""
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(self.channels)
+            wav.setsampwidth(self.sample_width)
+            wav.setframerate(self.sample_rate)
+            wav.writeframes(self.pcm)
+        return buffer.getvalue()
+
+    @classmethod
+    def concatenate(cls, clips):
+        """One clip from several in the same format"""
+        first = clips[0]
+        if any((c.sample_rate, c.channels, c.sample_width) != (first.sample_rate, first.channels, first.sample_width)
+               for c in clips):
+            raise ValueError("Clips have different formats")
+        return cls(b"".join(c.pcm for c in clips), first.sample_rate, first.channels, first.sample_width)
+
+
+class SpeechRequest:
+    """One utterance with the voice settings to apply before speaking it"""
+
+    def __init__(self, text, voice=None, rate=None, volume=None, output_path=None):
+        self.text = text
+        # Render to this file instead of the speakers
+        self.output_path = output_path
+        self.voice = voice
+        self.rate = rate
+        self.volume = volume
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+        self.error = None
+        self.done = threading.Event()
+
+    @property
+    def start_latency(self):
+        """Seconds from submission until the driver started the utterance"""
+        if self.started_at is None:
+            return None
+        return self.started_at - self.submitted_at
+
+
+class SpeechEngineService:
+    """Owns one long-lived pyttsx3 engine and speaks requests in order"""
+
+    def __init__(self, init_timeout=10):
+        self.error = None
+        self._voices = []
+        self._requests = queue.Queue()
+        self._current = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="speech-engine", daemon=True)
+        self._thread.start()
+        self._ready.wait(timeout=init_timeout)
+
+    @property
+    def available(self):
+        return self._ready.is_set() and self.error is None and self._thread.is_alive()
+
+    @property
+    def voices(self):
+        """Voices enumerated once when the engine started"""
+        return list(self._voices)
+
+    def say(self, text, voice=None, rate=None, volume=None, wait=True):
+        """Queue an utterance, blocking until it has been spoken unless wait is False"""
+        request = SpeechRequest(text, voice=voice, rate=rate, volume=volume)
+        if not self.available:
+            request.error = self.error or RuntimeError("Speech engine is not running")
+            request.done.set()
+            return request
+
+        self._requests.put(request)
+        if wait:
+            request.done.wait()
+        return request
+
+    def synthesize(self, text, voice=None, rate=None, volume=None):
+        """Render an utterance to an AudioClip without playing it"""
+        fd, path = tempfile.mkstemp(suffix=".wav", prefix="tts-")
+        os.close(fd)
+        try:
+            request = SpeechRequest(text, voice=voice, rate=rate, volume=volume, output_path=path)
+            if not self.available:
+                raise self.error or RuntimeError("Speech engine is not running")
+            self._requests.put(request)
+            request.done.wait()
+            if request.error:
+                raise request.error
+            # Drivers that can't write WAV (nsss writes AIFF) fail here, callers fall back to say()
+            return AudioClip.from_wav(path)
+        finally:
+            os.remove(path)
+
+    def shutdown(self, timeout=5):
+        """Stop the engine thread after the queued requests are spoken"""
+        self._requests.put(None)
+        self._thread.join(timeout=timeout)
+
+    def _on_started(self, name):
+        if self._current is not None:
+            self._current.started_at = time.perf_counter()
+
+    def _run(self):
+        try:
+            engine = pyttsx3.init()
+            self._voices = [Voice(v.id, v.name) for v in engine.getProperty('voices')]
+            engine.connect('started-utterance', self._on_started)
+        except Exception as e:
+            self.error = e
+            self._ready.set()
+            return
+        self._ready.set()
+
+        # Only push properties to the driver when they actually change
+        applied = {}
+        while True:
+            request = self._requests.get()
+            if request is None:
+                break
+
+            self._current = request
+            try:
+                for prop in ('voice', 'rate', 'volume'):
+                    value = getattr(request, prop)
+                    if value is not None and applied.get(prop) != value:
+                        engine.setProperty(prop, value)
+                        applied[prop] = value
+                if request.output_path:
+                    engine.save_to_file(request.text, request.output_path)
+                else:
+                    engine.say(request.text)
+                engine.runAndWait()
+            except Exception as e:
+                request.error = e
+            finally:
+                self._current = None
+                request.done.set()
+
+        try:
+            engine.stop()
+        except Exception:
+            pass
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_speech_service():
+    """Return the process-wide speech service, starting it on first use"""
+    global _service
+    with _service_lock:
+        # A failed start is kept so reruns don't retry the driver load every time
+        if _service is None or (_service.error is None and not _service._thread.is_alive()):
+            _service = SpeechEngineService()
+        return _service
@@ -0,0 +1,447 @@
+"""Process-wide speech input with voice-activity detection.
+
+Opening the microphone and calibrating for ambient noise cost about a second,
+so the microphone stays open on a capture thread between button presses and
+the noise floor is measured once and then tracked from the silence between
+utterances. While nobody is listening the frames only feed the noise floor and
+a short pre-roll buffer, so the start of a word spoken right after the press
+isn't cut off.
+
+An utterance starts after a few consecutive frames above the floor and ends
+after a short run of silence. Recognition runs while the user is still
+talking: recognizers get the audio through a stream, and the batch
+recognizers shipped with speech_recognition (Google, Sphinx) are driven in
+segments cut at pauses, so when the utterance ends only its last segment is
+still to be recognized.
+
+Sources and recognizers are pluggable, WavSource replays a WAV file frame by
+frame for tests and benchmarks.
+"""
+import collections
+import os
+import queue
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import speech_recognition as sr
+
+SAMPLE_RATE = 16000
+FRAME_MS = 30
+SAMPLE_WIDTH = 2  # 16-bit PCM
+
+
+def frame_energy(frame):
+    """RMS level of a 16-bit mono PCM frame"""
+    samples = np.frombuffer(frame, dtype=np.int16).astype(np.float32)
+    return float(np.sqrt(np.mean(samples * samples))) if len(samples) else 0.0
+
+
+# Audio sources
+
+class MicrophoneSource:
+    """Microphone read in fixed-size frames through PyAudio"""
+
+    def __init__(self, device_index=None, sample_rate=SAMPLE_RATE, frame_ms=FRAME_MS):
+        self.sample_rate = sample_rate
+        self.frame_samples = sample_rate * frame_ms // 1000
+        self._mic = sr.Microphone(device_index=device_index, sample_rate=sample_rate, chunk_size=self.frame_samples)
+        self._mic.__enter__()
+
+    def read(self):
+        return self._mic.stream.read(self.frame_samples)
+
+    def close(self):
+        self._mic.__exit__(None, None, None)
+
+
+class WavSource:
+    """16-bit mono WAV file read in frames, optionally paced like a live microphone"""
+
+    def __init__(self, path, frame_ms=FRAME_MS, realtime=False):
+        self._wav = wave.open(path, "rb")
+        if self._wav.getsampwidth() != SAMPLE_WIDTH or self._wav.getnchannels() != 1:
+            raise ValueError(f"{path} must be 16-bit mono PCM")
+        self.sample_rate = self._wav.getframerate()
+        self.frame_samples = self.sample_rate * frame_ms // 1000
+        self.realtime = realtime
+        self._next_at = None
+
+    def read(self):
+        """Next frame, b"" at the end of the file"""
+        if self.realtime:
+            now = time.perf_counter()
+            self._next_at = max(self._next_at or now, now - 0.1)
+            time.sleep(max(0.0, self._next_at - now))
+            self._next_at += self.frame_samples / self.sample_rate
+        return self._wav.readframes(self.frame_samples)
+
+    def close(self):
+        self._wav.close()
+
+
+def write_wav(path, pcm, sample_rate=SAMPLE_RATE):
+    """Write 16-bit mono PCM to a WAV file"""
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(SAMPLE_WIDTH)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+
+
+# Recognizers
+
+class SegmentStream:
+    """Recognizes an utterance in segments cut at pauses, each on a worker thread"""
+
+    def __init__(self, recognizer, sample_rate, min_segment):
+        self._recognizer = recognizer
+        self._sample_rate = sample_rate
+        self._min_bytes = int(min_segment * sample_rate) * SAMPLE_WIDTH
+        self._buffer = bytearray()
+        self._futures = []
+        # Recognition of a short tail started at a pause, used if the speaker doesn't go on
+        self._speculative = None
+
+    def feed(self, frame):
+        self._buffer += frame
+
+    def pause(self):
+        """The speaker paused, start recognizing what was said so far"""
+        if len(self._buffer) >= self._min_bytes:
+            self._futures.append(self._submit(self._buffer))
+            self._buffer = bytearray()
+        elif self._buffer:
+            self._speculative = self._submit(self._buffer)
+
+    def resume(self):
+        """The speaker went on after a pause"""
+        if self._speculative is not None:
+            self._speculative.cancel()
+            self._speculative = None
+
+    def _submit(self, pcm):
+        audio = sr.AudioData(bytes(pcm), self._sample_rate, SAMPLE_WIDTH)
+        return self._recognizer.executor.submit(self._recognizer.recognize_segment, audio)
+
+    def partial(self):
+        """Text of the leading segments that are already recognized"""
+        parts = []
+        for future in self._futures:
+            if not future.done() or future.exception() is not None:
+                break
+            parts.append(future.result())
+        return " ".join(p for p in parts if p)
+
+    def finish(self):
+        """Text of the whole utterance, raises sr.UnknownValueError if nothing was understood"""
+        if self._speculative is not None:
+            # Only silence came after the pause
+            self._futures.append(self._speculative)
+        elif self._buffer:
+            self._futures.append(self._submit(self._buffer))
+        parts = [future.result() for future in self._futures]
+        text = " ".join(p for p in parts if p)
+        if not text:
+            raise sr.UnknownValueError()
+        return text
+
+    def cancel(self):
+        self.resume()
+        for future in self._futures:
+            future.cancel()
+
+
+class SegmentedRecognizer:
+    """Drives a batch recognizer (AudioData -> text) segment by segment"""
+
+    def __init__(self, recognize, min_segment=1.0, workers=2):
+        self.recognize = recognize
+        self.min_segment = min_segment
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="speech-recognizer")
+
+    def recognize_segment(self, audio):
+        try:
+            return self.recognize(audio)
+        except sr.UnknownValueError:
+            # Coughs and half words between phrases aren't fatal to the utterance
+            return ""
+
+    def stream(self, sample_rate):
+        return SegmentStream(self, sample_rate, self.min_segment)
+
+
+def google_recognizer(language="en-in"):
+    """Free Google Web Speech API, one HTTP request per segment"""
+    recognizer = sr.Recognizer()
+    return SegmentedRecognizer(lambda audio: recognizer.recognize_google(audio, language=language))
+
+
+def sphinx_recognizer(language="en-US"):
+    """Offline CMU Sphinx, needs the pocketsphinx package"""
+    recognizer = sr.Recognizer()
+    return SegmentedRecognizer(lambda audio: recognizer.recognize_sphinx(audio, language=language))
+
+
+RECOGNIZERS = {"google": google_recognizer, "sphinx": sphinx_recognizer}
+
+
+# Listening
+
+class MicrophoneBusy(Exception):
+    """Another caller is already listening to the process-wide source"""
+
+
+class Utterance:
+    """Recognized text with timing, all times from time.perf_counter()"""
+
+    def __init__(self, text, started_at, speech_start, speech_end, recognized_at):
+        self.text = text
+        self.started_at = started_at
+        self.speech_start = speech_start
+        self.speech_end = speech_end
+        self.recognized_at = recognized_at
+
+    @property
+    def latency(self):
+        """Seconds from the end of speech until the text was ready"""
+        return self.recognized_at - self.speech_end
+
+    @property
+    def speech_seconds(self):
+        return self.speech_end - self.speech_start
+
+
+class SpeechInputService:
+    """Keeps one audio source open on a capture thread and turns speech into text"""
+
+    def __init__(self, open_source=MicrophoneSource, recognizer=None, threshold_ratio=3.0, min_threshold=300.0,
+                 start_ms=90, pause_ms=250, end_ms=500, preroll_ms=300, calibration_ms=300, idle_timeout=60):
+        self.open_source = open_source
+        self.recognizer = recognizer or google_recognizer()
+        self.threshold_ratio = threshold_ratio
+        self.min_threshold = min_threshold
+        self.start_ms = start_ms
+        self.pause_ms = pause_ms
+        self.end_ms = end_ms
+        self.preroll_ms = preroll_ms
+        self.calibration_ms = calibration_ms
+        self.idle_timeout = idle_timeout
+        # Ambient RMS level, kept across utterances and source restarts
+        self.noise_floor = None
+        self.error = None
+        self.sample_rate = None
+        self.frame_ms = None
+        self._listener = None
+        self._last_used = time.monotonic()
+        self._preroll = collections.deque()
+        self._lock = threading.Lock()
+        # One listener at a time, the source has one stream of frames
+        self._listen_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+        # Whether the capture thread still hands out frames, it's cleared under the lock as it stops
+        self._capturing = False
+
+    @property
+    def threshold(self):
+        return max(self.min_threshold, (self.noise_floor or 0.0) * self.threshold_ratio)
+
+    def _track_floor(self, energy, weight):
+        self.noise_floor = energy if self.noise_floor is None else (1 - weight) * self.noise_floor + weight * energy
+
+    def _start(self):
+        with self._lock:
+            if self._capturing:
+                return
+            stopping = self._thread
+        # A capture thread that reached its idle timeout closes its source before another opens one
+        if stopping is not None:
+            stopping.join(timeout=5)
+        with self._lock:
+            if self._capturing:
+                return
+            self.error = None
+            self._ready.clear()
+            self._capturing = True
+            self._thread = threading.Thread(target=self._capture, name="speech-capture", daemon=True)
+            self._thread.start()
+        self._ready.wait(timeout=10)
+
+    def _capture(self):
+        try:
+            source = self.open_source()
+        except Exception as e:
+            self.error = e
+            with self._lock:
+                self._capturing = False
+            self._ready.set()
+            return
+        self.sample_rate = source.sample_rate
+        self.frame_ms = 1000 * source.frame_samples / source.sample_rate
+        calibrating = self.noise_floor is None and int(self.calibration_ms / self.frame_ms)
+        self._preroll = collections.deque(maxlen=max(1, int(self.preroll_ms / self.frame_ms)))
+        if not calibrating:
+            self._ready.set()
+        try:
+            while True:
+                frame = source.read()
+                if not frame:
+                    break
+                energy = frame_energy(frame)
+                if calibrating:
+                    # Plain average over the first frames, then track it
+                    calibrating -= 1
+                    self._track_floor(energy, 1.0 / (int(self.calibration_ms / self.frame_ms) - calibrating))
+                    if not calibrating:
+                        self._ready.set()
+                    continue
+                with self._lock:
+                    if self._listener is not None:
+                        self._listener.put((frame, energy, time.perf_counter()))
+                        continue
+                    self._preroll.append((frame, energy, time.perf_counter()))
+                    # Decided under the lock, so a listener either registers before or sees it stopped
+                    if time.monotonic() - self._last_used > self.idle_timeout:
+                        self._capturing = False
+                        break
+                if energy < self.threshold:
+                    self._track_floor(energy, 0.05)
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._lock:
+                self._capturing = False
+                if self._listener is not None:
+                    self._listener.put(None)
+            source.close()
+            self._ready.set()
+
+    def listen(self, timeout=5, phrase_time_limit=15, on_partial=None):
+        """Wait for one utterance and return it as an Utterance
+
+        Raises sr.WaitTimeoutError if nobody starts talking within timeout seconds,
+        MicrophoneBusy if another caller is listening, and the recognizer's errors
+        (sr.UnknownValueError, sr.RequestError) otherwise.
+        """
+        if not self._listen_lock.acquire(blocking=False):
+            raise MicrophoneBusy("The microphone is in use by another session, try again in a moment")
+        try:
+            return self._listen(timeout, phrase_time_limit, on_partial)
+        finally:
+            self._listen_lock.release()
+
+    def _listen(self, timeout, phrase_time_limit, on_partial):
+        started_at = time.perf_counter()
+        self._last_used = time.monotonic()
+        frames = queue.Queue()
+        # The capture thread may stop on its idle timeout right after _start() found it running
+        for _ in range(2):
+            self._start()
+            if self.error is not None:
+                raise self.error
+            with self._lock:
+                if self._capturing:
+                    # Frames from just before the call may hold the first syllable
+                    for item in list(self._preroll):
+                        frames.put(item)
+                    self._preroll.clear()
+                    self._listener = frames
+                    break
+        else:
+            raise sr.WaitTimeoutError("no audio from the source")
+        try:
+            return self._detect(frames, started_at, timeout, phrase_time_limit, on_partial)
+        finally:
+            with self._lock:
+                self._listener = None
+            self._last_used = time.monotonic()
+
+    def _detect(self, frames, started_at, timeout, phrase_time_limit, on_partial):
+        start_frames = max(1, int(self.start_ms / self.frame_ms))
+        pause_frames = max(1, int(self.pause_ms / self.frame_ms))
+        end_frames = max(1, int(self.end_ms / self.frame_ms))
+        onset = []
+        stream = None
+        silent = 0
+        speech_start = speech_end = None
+        partial = ""
+        try:
+            while True:
+                item = frames.get(timeout=max(0.1, timeout))
+                if item is None:
+                    if self.error is not None:
+                        raise self.error
+                    break
+                frame, energy, at = item
+                voiced = energy >= self.threshold
+
+                if stream is None:
+                    if not voiced:
+                        self._track_floor(energy, 0.05)
+                        onset = []
+                        if at - started_at > timeout:
+                            raise sr.WaitTimeoutError("listening timed out while waiting for phrase to start")
+                        continue
+                    onset.append(frame)
+                    if len(onset) < start_frames:
+                        continue
+                    stream = self.recognizer.stream(self.sample_rate)
+                    speech_start = at - len(onset) * self.frame_ms / 1000
+                    for f in onset:
+                        stream.feed(f)
+                    speech_end = at
+                    continue
+
+                stream.feed(frame)
+                if voiced:
+                    if silent >= pause_frames:
+                        stream.resume()
+                    silent = 0
+                    speech_end = at
+                else:
+                    silent += 1
+                    if silent == pause_frames:
+                        stream.pause()
+                    if silent >= end_frames:
+                        break
+                if at - speech_start > phrase_time_limit:
+                    break
+                if on_partial is not None:
+                    text = stream.partial()
+                    if text != partial:
+                        partial = text
+                        on_partial(text)
+        except queue.Empty:
+            raise sr.WaitTimeoutError("no audio from the source") from None
+        except BaseException:
+            if stream is not None:
+                stream.cancel()
+            raise
+
+        if stream is None:
+            raise sr.WaitTimeoutError("listening timed out while waiting for phrase to start")
+        text = stream.finish()
+        return Utterance(text, started_at, speech_start, speech_end, time.perf_counter())
+
+    def close(self, timeout=5):
+        """Release the audio source"""
+        self._last_used = float("-inf")
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_speech_input():
+    """Return the process-wide speech input service, created on first use"""
+    global _service
+    with _service_lock:
+        if _service is None:
+            factory = RECOGNIZERS[os.environ.get("SPEECH_RECOGNIZER", "google")]
+            _service = SpeechInputService(recognizer=factory())
+        return _service
@@ -0,0 +1,337 @@
+"""Sentence-pipelined speech output.
+
+Replies are cut into sentences, and long sentences into clauses, so the first
+audio starts after one short chunk has been synthesized. A synthesis thread
+renders the next chunks to audio clips while the current one plays, and a
+playback thread writes each clip to the audio sink in small blocks. Stop and
+pause are checked between blocks, so they take effect within a block (20 ms)
+plus whatever the device has buffered, instead of at the end of a sentence.
+
+Rendered chunks go through an optional AudioCache, so repeated sentences
+(greetings, canned command replies, replays) skip synthesis. Drivers that
+can't render to a WAV file fall back to speaking each chunk directly, which
+can only be stopped between chunks.
+"""
+import collections
+import queue
+import re
+import threading
+import time
+
+import numpy as np
+
+from metrics import get_tracer
+from speech_engine import AudioClip
+
+BLOCK_MS = 20
+
+# Abbreviations whose period doesn't end a sentence
+_ABBREVIATIONS = re.compile(r"\b(?:Mr|Mrs|Ms|Dr|Prof|Sr|Jr|St|vs|etc|approx|No|Fig|e\.g|i\.e)\.$", re.IGNORECASE)
+_SENTENCE_END = re.compile(r"[.!?]+[\"')\]]*(?=\s)|\n+")
+_CLAUSE_END = re.compile(r"[,;:–—](?=\s)")
+
+
+def _clauses(sentence, max_chars):
+    """Split a long sentence at clause punctuation into pieces of at most about max_chars"""
+    if len(sentence) <= max_chars:
+        return [sentence]
+    pieces, start = [], 0
+    cuts = [m.end() for m in _CLAUSE_END.finditer(sentence)] + [len(sentence)]
+    last_cut = 0
+    for cut in cuts:
+        if cut - start > max_chars and last_cut > start:
+            pieces.append(sentence[start:last_cut].strip())
+            start = last_cut
+        last_cut = cut
+    pieces.append(sentence[start:].strip())
+    # Clauses without punctuation are cut at the last space before the limit
+    chunks = []
+    for piece in pieces:
+        while len(piece) > max_chars and " " in piece[:max_chars]:
+            cut = piece.rindex(" ", 0, max_chars)
+            chunks.append(piece[:cut])
+            piece = piece[cut + 1:]
+        chunks.append(piece)
+    return chunks
+
+
+def split_sentences(text, max_chars=160):
+    """Split text into speakable chunks: sentences, and clauses of sentences longer than max_chars"""
+    sentences, start = [], 0
+    for match in _SENTENCE_END.finditer(text):
+        candidate = text[start:match.end()]
+        if match.group().startswith(".") and _ABBREVIATIONS.search(candidate.rstrip()):
+            continue
+        # "3.5" never matches (no whitespace after the period), "v2. Next" does
+        sentences.append(candidate)
+        start = match.end()
+    sentences.append(text[start:])
+    chunks = []
+    for sentence in sentences:
+        sentence = " ".join(sentence.split())
+        if sentence:
+            chunks.extend(_clauses(sentence, max_chars))
+    return chunks
+
+
+# Audio sinks
+
+class PyAudioSink:
+    """Plays PCM on the default output device"""
+
+    def __init__(self):
+        self._pa = None
+
+    def open(self, sample_rate, channels, sample_width):
+        """Output stream with a blocking write(pcm) and close()"""
+        import pyaudio
+
+        if self._pa is None:
+            self._pa = pyaudio.PyAudio()
+        # A small device buffer keeps stop latency close to one block
+        return self._pa.open(
+            format=self._pa.get_format_from_width(sample_width), channels=channels, rate=sample_rate,
+            output=True, frames_per_buffer=sample_rate * BLOCK_MS // 1000,
+        )
+
+
+class FakeStream:
+    def __init__(self, sink, bytes_per_second):
+        self._sink = sink
+        self._bytes_per_second = bytes_per_second
+
+    def write(self, pcm):
+        self._sink.written.append(pcm)
+        if self._sink.realtime:
+            time.sleep(len(pcm) / self._bytes_per_second)
+
+    def close(self):
+        pass
+
+
+class FakeAudioSink:
+    """Records what would have been played, at real-time pace unless realtime is False"""
+
+    def __init__(self, realtime=True):
+        self.realtime = realtime
+        self.written = []
+
+    def open(self, sample_rate, channels, sample_width):
+        return FakeStream(self, sample_rate * channels * sample_width)
+
+
+# Pipeline
+
+class SpeechChunk:
+    """One sentence or clause on its way through the pipeline, times from time.perf_counter()"""
+
+    def __init__(self, text, settings, generation, queued_at):
+        self.text = text
+        self.settings = settings
+        self.generation = generation
+        self.queued_at = queued_at
+        self.clip = None
+        self.synth_started = None
+        self.synth_done = None
+        self.play_started = None
+        self.play_done = None
+        self.interrupted = False
+
+    def metrics(self, previous_done=None):
+        ms = lambda a, b: round((b - a) * 1000, 1) if a is not None and b is not None else None
+        return {
+            "chars": len(self.text),
+            "synth_ms": ms(self.synth_started, self.synth_done),
+            # From the text arriving to its first audio
+            "latency_ms": ms(self.queued_at, self.play_started),
+            # Silence between the previous chunk and this one, zero when prefetch kept up
+            "gap_ms": ms(previous_done, self.play_started) if previous_done else None,
+            "audio_ms": round(self.clip.seconds * 1000, 1) if self.clip is not None else None,
+            "interrupted": self.interrupted,
+        }
+
+
+class SpeechPipeline:
+    """Speaks queued text chunk by chunk, synthesizing ahead of playback"""
+
+    def __init__(self, service, sink, cache=None, prefetch=2, max_chars=160, block_ms=BLOCK_MS, history=200):
+        self.service = service
+        self.sink = sink
+        self.cache = cache
+        self.max_chars = max_chars
+        self.block_ms = block_ms
+        self.metrics = collections.deque(maxlen=history)
+        self.last_stop_ms = None
+        # Bumped by stop(), chunks from an older generation are dropped
+        self._generation = 0
+        self._texts = queue.Queue()
+        self._ready = queue.Queue(maxsize=prefetch)
+        self._unpaused = threading.Event()
+        self._unpaused.set()
+        self._stop_requested_at = None
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+        self._direct = False
+        self._last_done = None
+        self._threads = []
+
+    @property
+    def speaking(self):
+        return self._busy > 0
+
+    @property
+    def paused(self):
+        return not self._unpaused.is_set()
+
+    def _start(self):
+        if not self._threads:
+            for target, name in ((self._synthesize, "speech-synthesis"), (self._play, "speech-playback")):
+                thread = threading.Thread(target=target, name=name, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _track(self, delta):
+        with self._busy_lock:
+            self._busy += delta
+
+    def speak(self, text, **settings):
+        """Queue text to be spoken with the given voice settings"""
+        self._start()
+        chunks = split_sentences(text, self.max_chars)
+        now = time.perf_counter()
+        generation = self._generation
+        self._track(len(chunks))
+        for chunk in chunks:
+            self._texts.put(SpeechChunk(chunk, settings, generation, now))
+
+    def pause(self):
+        self._unpaused.clear()
+
+    def resume(self):
+        self._unpaused.set()
+
+    def stop(self):
+        """Drop everything queued and cut off the chunk that is playing"""
+        self._stop_requested_at = time.perf_counter()
+        self._generation += 1
+        self._unpaused.set()
+        for pending in (self._texts, self._ready):
+            while True:
+                try:
+                    chunk = pending.get_nowait()
+                except queue.Empty:
+                    break
+                if chunk is not None:
+                    self._track(-1)
+
+    def _synthesize(self):
+        while True:
+            chunk = self._texts.get()
+            if chunk is None:
+                self._ready.put(None)
+                return
+            if chunk.generation != self._generation:
+                self._track(-1)
+                continue
+            chunk.synth_started = time.perf_counter()
+            if not self._direct:
+                try:
+                    chunk.clip = self._clip(chunk.text, chunk.settings)
+                except Exception as e:
+                    # Play the rest through the driver directly
+                    self._direct = True
+                    get_tracer().record("speech_synthesis", time.perf_counter() - chunk.synth_started, error=e)
+                else:
+                    get_tracer().record("speech_synthesis", time.perf_counter() - chunk.synth_started,
+                                        characters=len(chunk.text))
+            chunk.synth_done = time.perf_counter()
+            # Blocks while enough chunks are rendered ahead, unless stop() drains the queue
+            while chunk.generation == self._generation:
+                try:
+                    self._ready.put(chunk, timeout=0.05)
+                    break
+                except queue.Full:
+                    pass
+            else:
+                self._track(-1)
+
+    def _clip(self, text, settings):
+        if self.cache is None:
+            return self.service.synthesize(text, **settings)
+        return self.cache.get_or_synthesize(self.service.synthesize, text, **settings)
+
+    def render(self, text, **settings):
+        """Audio for the whole text, assembled from the same (cached) chunks the pipeline speaks"""
+        chunks = split_sentences(text, self.max_chars)
+        if not chunks:
+            return None
+        return AudioClip.concatenate([self._clip(chunk, settings) for chunk in chunks])
+
+    def _play(self):
+        stream, stream_format = None, None
+        while True:
+            chunk = self._ready.get()
+            if chunk is None:
+                break
+            try:
+                if chunk.generation != self._generation:
+                    continue
+                self._unpaused.wait()
+                if chunk.generation != self._generation:
+                    continue
+                chunk.play_started = time.perf_counter()
+                if chunk.clip is None:
+                    self.service.say(chunk.text, **chunk.settings)
+                else:
+                    clip = chunk.clip
+                    fmt = (clip.sample_rate, clip.channels, clip.sample_width)
+                    if stream_format != fmt:
+                        if stream is not None:
+                            stream.close()
+                        stream, stream_format = self.sink.open(*fmt), fmt
+                    self._write(stream, chunk)
+                chunk.play_done = time.perf_counter()
+                self.metrics.append(chunk.metrics(self._last_done))
+                self._last_done = None if chunk.interrupted else chunk.play_done
+            except Exception as e:
+                self.metrics.append({"chars": len(chunk.text), "error": str(e)})
+            finally:
+                self._track(-1)
+        if stream is not None:
+            stream.close()
+
+    def _write(self, stream, chunk):
+        clip = chunk.clip
+        block = clip.sample_rate * self.block_ms // 1000 * clip.channels * clip.sample_width
+        for start in range(0, len(clip.pcm), block):
+            while not self._unpaused.wait(timeout=0.01):
+                if chunk.generation != self._generation:
+                    break
+            if chunk.generation != self._generation:
+                chunk.interrupted = True
+                self.last_stop_ms = round((time.perf_counter() - self._stop_requested_at) * 1000, 1)
+                return
+            stream.write(clip.pcm[start:start + block])
+
+    def stats(self):
+        """Latency summary over the recorded chunks"""
+        rows = [m for m in self.metrics if "error" not in m]
+        if not rows:
+            return {}
+        latency = [m["latency_ms"] for m in rows]
+        gaps = [m["gap_ms"] for m in rows if m["gap_ms"] is not None]
+        synth = [m["synth_ms"] for m in rows if m["synth_ms"] is not None]
+        return {
+            "chunks": len(rows),
+            "latency_p50_ms": float(np.percentile(latency, 50)),
+            "gap_p95_ms": float(np.percentile(gaps, 95)) if gaps else None,
+            "synth_p50_ms": float(np.percentile(synth, 50)) if synth else None,
+            "last_stop_ms": self.last_stop_ms,
+        }
+
+    def close(self, timeout=2):
+        self.stop()
+        if self._threads:
+            self._texts.put(None)
+            for thread in self._threads:
+                thread.join(timeout=timeout)
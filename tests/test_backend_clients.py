@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pytest
+
+from backend_clients import AsyncBackends, BackendCancelled, BackendPolicy, BackendTimeout
+from chat_engine import ChatEngine
+from response_cache import ResponseCache
+from stub_backends import StubBackends
+
+
+@pytest.fixture
+def stub():
+    stub = StubBackends()
+    stub.start()
+    yield stub
+    stub.stop()
+
+
+def engine_for(stub, **policy):
+    settings = dict(timeout=2, concurrency=8, retries=2, backoff=0.01, max_backoff=0.05)
+    settings.update(policy)
+    backends = AsyncBackends(policies={"wikipedia": BackendPolicy(**settings)}, rate_limits=False)
+    engine = ChatEngine(response_cache=ResponseCache(max_entries=64), backends=backends,
+                        wikipedia_url=stub.wikipedia_url, stability_url=stub.stability_url)
+    return engine, engine.create_session()
+
+
+def test_connections_are_reused_across_calls(stub):
+    engine, session = engine_for(stub)
+    try:
+        for i in range(20):
+            assert "stub article" in engine.wikipedia_summary(session, f"topic {i}")
+    finally:
+        engine.backends.close()
+    assert stub.requests == 20
+    assert len(stub.peers) == 1
+
+
+def test_transient_failures_are_retried_then_reported(stub):
+    stub.failure_rate = 1.0
+    engine, session = engine_for(stub)
+    try:
+        with pytest.raises(Exception) as raised:
+            engine.wikipedia_summary(session, "pandas")
+        stats = engine.backends.stats()["wikipedia"]
+    finally:
+        engine.backends.close()
+    assert getattr(raised.value, "status", None) == 503
+    assert stub.requests == 3
+    assert stats["retries"] == 2 and stats["errors"] == 1
+
+
+def test_a_stalled_backend_times_out_and_the_request_is_dropped(stub):
+    stub.stall = True
+    engine, session = engine_for(stub, timeout=0.2, retries=0)
+    started = time.perf_counter()
+    try:
+        with pytest.raises(BackendTimeout):
+            engine.wikipedia_summary(session, "pandas")
+    finally:
+        engine.backends.close()
+    assert time.perf_counter() - started < 1.0
+    deadline = time.monotonic() + 2
+    while not stub.disconnects:
+        assert time.monotonic() < deadline, "the stalled request was never closed"
+        time.sleep(0.01)
+
+
+def test_cancelling_stops_the_wait_right_away(stub):
+    stub.stall = True
+    engine, session = engine_for(stub, timeout=30)
+    threading.Timer(0.2, session.cancel_event.set).start()
+    started = time.perf_counter()
+    try:
+        with pytest.raises(BackendCancelled):
+            engine.wikipedia_summary(session, "pandas")
+    finally:
+        engine.backends.close()
+    assert time.perf_counter() - started < 0.6
@@ -0,0 +1,100 @@
+import time
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+from conversation_store import ConversationWriter
+
+mongomock = pytest.importorskip("mongomock")
+
+
+def message(i, session_id="s1"):
+    return {"session_id": session_id, "role": "user" if i % 2 == 0 else "assistant", "content": f"message {i}",
+            "timestamp": time.time()}
+
+
+class FlakyCollection:
+    """Fails the first insert_many calls with a transient error"""
+
+    def __init__(self, collection, failures):
+        self.collection = collection
+        self.failures = failures
+        self.calls = 0
+
+    def insert_many(self, documents, ordered=True):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise AutoReconnect("connection reset")
+        return self.collection.insert_many(documents, ordered=ordered)
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().db.conversations
+
+
+def test_messages_are_written_in_batches(collection):
+    writer = ConversationWriter(collection, batch_size=50, flush_interval=0.5)
+    try:
+        ids = [writer.put(message(i)) for i in range(120)]
+        assert writer.flush()
+    finally:
+        writer.close()
+    stats = writer.stats()
+    assert collection.count_documents({}) == 120
+    assert sorted(doc["_id"] for doc in collection.find()) == sorted(ids)
+    assert stats["written"] == 120 and stats["failed"] == 0
+    # Queued faster than the interval, so batches fill up instead of going one by one
+    assert 3 <= stats["batches"] <= 5
+
+
+def test_a_lone_message_is_written_after_the_flush_interval(collection):
+    writer = ConversationWriter(collection, flush_interval=0.1)
+    try:
+        message_id = writer.put(message(0))
+        assert collection.find_one({"_id": message_id}) is None
+        deadline = time.monotonic() + 2
+        while collection.find_one({"_id": message_id}) is None:
+            assert time.monotonic() < deadline, "message was never written"
+            time.sleep(0.01)
+    finally:
+        writer.close()
+    assert writer.stats()["batches"] == 1
+
+
+def test_transient_errors_are_retried(collection):
+    flaky = FlakyCollection(collection, failures=2)
+    writer = ConversationWriter(flaky, flush_interval=0.05, retry_backoff=0.01)
+    try:
+        for i in range(10):
+            writer.put(message(i))
+        assert writer.flush()
+    finally:
+        writer.close()
+    stats = writer.stats()
+    assert collection.count_documents({}) == 10
+    assert stats["retries"] == 2 and stats["failed"] == 0
+
+
+def test_already_stored_messages_are_not_failures(collection):
+    stored = message(0)
+    collection.insert_one(dict(stored, _id="duplicate"))
+    writer = ConversationWriter(collection, flush_interval=0.05)
+    try:
+        writer.put(dict(stored, _id="duplicate"))
+        writer.put(message(1))
+        assert writer.flush()
+    finally:
+        writer.close()
+    assert collection.count_documents({}) == 2
+    assert writer.stats()["failed"] == 0
+
+
+def test_close_drains_the_queue_and_refuses_new_messages(collection):
+    writer = ConversationWriter(collection, batch_size=10, flush_interval=0.2)
+    for i in range(25):
+        writer.put(message(i))
+    assert writer.close()
+    assert collection.count_documents({}) == 25
+    with pytest.raises(RuntimeError):
+        writer.put(message(25))
@@ -0,0 +1,105 @@
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+from job_queue import JobQueue
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def blocking_job(release):
+    def run(job):
+        release.wait(5)
+        return "finished"
+
+    return run
+
+
+def insert_job(path, job_id, owner, owner_pid):
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "INSERT INTO jobs (job_id, session_id, kind, status, created_at, owner, owner_pid) "
+        "VALUES (?, 's', 'image', 'running', ?, ?, ?)",
+        (job_id, time.time(), owner, owner_pid),
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_starting_a_queue_leaves_another_queues_live_jobs_alone(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    release = threading.Event()
+    first = JobQueue(path)
+    try:
+        job_id = first.submit("s", "image", blocking_job(release))
+        wait_for(lambda: first.get(job_id)["status"] == "running")
+        second = JobQueue(path)
+        assert second.get(job_id)["status"] == "running"
+        release.set()
+        wait_for(lambda: first.get(job_id)["status"] == "done")
+        second.close()
+    finally:
+        release.set()
+        first.close(wait=True)
+
+
+def test_jobs_of_a_dead_process_are_interrupted_and_a_live_ones_are_kept(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    JobQueue(path).close()
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    live = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        insert_job(path, "orphan", "dead-queue", dead.pid)
+        insert_job(path, "elsewhere", "live-queue", live.pid)
+        jobs = JobQueue(path)
+        assert jobs.get("orphan")["status"] == "interrupted"
+        assert jobs.get("elsewhere")["status"] == "running"
+        jobs.close()
+    finally:
+        live.kill()
+        live.wait()
+
+
+def test_jobs_of_a_closed_queue_are_interrupted_on_restart(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    release = threading.Event()
+    jobs = JobQueue(path, workers=1)
+    try:
+        running = jobs.submit("s", "image", blocking_job(release))
+        queued = jobs.submit("t", "image", blocking_job(release))
+        wait_for(lambda: jobs.get(running)["status"] == "running")
+        jobs.close()
+        restarted = JobQueue(path)
+        assert restarted.get(queued)["status"] == "interrupted"
+        restarted.close()
+    finally:
+        release.set()
+
+
+def test_tables_from_before_owners_are_migrated(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE jobs ("
+        "job_id TEXT PRIMARY KEY, session_id TEXT NOT NULL, kind TEXT NOT NULL, description TEXT, "
+        "status TEXT NOT NULL, progress_done INTEGER, progress_total INTEGER, result TEXT, error TEXT, "
+        "created_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+    )
+    conn.execute("INSERT INTO jobs (job_id, session_id, kind, status, created_at) VALUES ('old', 's', 'image', 'queued', 0)")
+    conn.commit()
+    conn.close()
+    jobs = JobQueue(path)
+    try:
+        assert jobs.get("old")["status"] == "interrupted"
+        job_id = jobs.submit("s", "image", lambda job: "ok")
+        wait_for(lambda: jobs.get(job_id)["status"] == "done")
+    finally:
+        jobs.close()
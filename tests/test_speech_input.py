@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+import speech_recognition as sr
+
+from speech_input import (SAMPLE_RATE, MicrophoneBusy, SegmentedRecognizer, SpeechInputService, WavSource, frame_energy,
+                          write_wav)
+
+
+def noise(rng, seconds):
+    return rng.normal(0, 80, int(seconds * SAMPLE_RATE))
+
+
+def tone(seconds, frequency=440):
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    return 4000 * np.sin(2 * np.pi * frequency * t)
+
+
+def fixture(tmp_path, name, *parts):
+    path = os.path.join(tmp_path, name)
+    samples = np.clip(np.concatenate(parts), -32768, 32767).astype(np.int16)
+    write_wav(path, samples.tobytes())
+    return path
+
+
+class RecordingRecognizer(SegmentedRecognizer):
+    """Answers "word" for every segment with a tone in it and keeps the segment lengths in seconds"""
+
+    def __init__(self, min_segment):
+        self.segments = []
+        super().__init__(self._recognize, min_segment=min_segment)
+
+    def _recognize(self, audio):
+        samples = np.frombuffer(audio.get_raw_data(), dtype=np.int16)
+        self.segments.append(len(samples) / audio.sample_rate)
+        if np.abs(samples).max() < 1000:
+            raise sr.UnknownValueError()
+        return "word"
+
+
+def service_for(path, recognizer):
+    return SpeechInputService(open_source=lambda: WavSource(path, realtime=True), recognizer=recognizer)
+
+
+def test_wav_source_reads_what_write_wav_wrote_in_frames(tmp_path):
+    rng = np.random.default_rng(0)
+    path = fixture(tmp_path, "tone.wav", noise(rng, 0.1), tone(0.1))
+    source = WavSource(path)
+    frames = []
+    while True:
+        frame = source.read()
+        if not frame:
+            break
+        frames.append(frame)
+    source.close()
+    assert len(frames[0]) == source.frame_samples * 2
+    assert len(b"".join(frames)) == int(0.2 * SAMPLE_RATE) * 2
+    assert frame_energy(frames[0]) < 300 < frame_energy(frames[-2])
+
+
+def test_utterance_is_cut_at_the_pause_and_ends_after_silence(tmp_path):
+    rng = np.random.default_rng(1)
+    path = fixture(tmp_path, "two_words.wav", noise(rng, 0.6), tone(0.6) + noise(rng, 0.6), noise(rng, 0.35),
+                   tone(0.6) + noise(rng, 0.6), noise(rng, 1.2))
+    recognizer = RecordingRecognizer(min_segment=0.3)
+    service = service_for(path, recognizer)
+    try:
+        utterance = service.listen(timeout=3)
+    finally:
+        service.close()
+    # The first word is recognized at the pause, the rest once speech ended
+    assert utterance.text == "word word"
+    assert 2 <= len(recognizer.segments) <= 3
+    assert sum(recognizer.segments) >= 1.5
+    assert utterance.speech_seconds == pytest.approx(1.55, abs=0.15)
+    assert service.noise_floor < service.threshold < 4000
+
+
+def test_silence_times_out(tmp_path):
+    rng = np.random.default_rng(2)
+    path = fixture(tmp_path, "silence.wav", noise(rng, 2.0))
+    recognizer = RecordingRecognizer(min_segment=0.3)
+    service = service_for(path, recognizer)
+    try:
+        with pytest.raises(sr.WaitTimeoutError):
+            service.listen(timeout=0.8)
+    finally:
+        service.close()
+    assert recognizer.segments == []
+
+
+def test_a_second_listener_is_refused_while_one_listens(tmp_path):
+    rng = np.random.default_rng(3)
+    path = fixture(tmp_path, "silence.wav", noise(rng, 2.0))
+    service = service_for(path, RecordingRecognizer(min_segment=0.3))
+    errors = []
+
+    def first():
+        try:
+            service.listen(timeout=0.8)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=first)
+    thread.start()
+    try:
+        time.sleep(0.5)
+        with pytest.raises(MicrophoneBusy):
+            service.listen(timeout=0.5)
+        thread.join()
+    finally:
+        service.close()
+    # The first listener kept getting frames until its own timeout
+    assert len(errors) == 1 and isinstance(errors[0], sr.WaitTimeoutError)
+    assert "waiting for phrase" in str(errors[0])
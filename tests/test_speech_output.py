@@ -0,0 +1,83 @@
+import time
+
+import numpy as np
+
+from speech_engine import AudioClip
+from speech_output import FakeAudioSink, SpeechPipeline, split_sentences
+
+SAMPLE_RATE = 16000
+REPLY = "Pandas is a library for data analysis. It reads CSV files. Grouping is built in. Want an example?"
+
+
+class FakeSpeechService:
+    """Instant synthesis of silence, 50 ms of audio per character"""
+
+    def synthesize(self, text, **settings):
+        return AudioClip(np.zeros(int(SAMPLE_RATE * 0.05 * len(text)), dtype=np.int16).tobytes(), SAMPLE_RATE)
+
+    def say(self, text, **settings):
+        raise AssertionError("clips are rendered, nothing is spoken directly")
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_split_sentences_keeps_abbreviations_and_cuts_long_sentences():
+    assert split_sentences("Dr. Smith is here. He waits!  Ok") == ["Dr. Smith is here.", "He waits!", "Ok"]
+    chunks = split_sentences("one, two, three, four, five, six", max_chars=12)
+    assert all(len(chunk) <= 12 for chunk in chunks)
+    assert " ".join(chunks) == "one, two, three, four, five, six"
+
+
+def test_stop_cuts_off_playback_within_a_block():
+    sink = FakeAudioSink()
+    pipeline = SpeechPipeline(FakeSpeechService(), sink)
+    try:
+        pipeline.speak(REPLY)
+        wait_for(lambda: len(sink.written) > 5)
+        pipeline.stop()
+        wait_for(lambda: not pipeline.speaking)
+        assert pipeline.last_stop_ms is not None and pipeline.last_stop_ms < 50
+        written = len(sink.written)
+        time.sleep(0.1)
+        assert len(sink.written) == written
+        # Far less than the whole reply was played
+        played = sum(len(pcm) for pcm in sink.written) / (SAMPLE_RATE * 2)
+        assert played < 0.05 * len(REPLY) / 2
+    finally:
+        pipeline.close()
+
+
+def test_pause_holds_playback_until_resumed():
+    sink = FakeAudioSink()
+    pipeline = SpeechPipeline(FakeSpeechService(), sink)
+    try:
+        pipeline.speak("Short sentence to pause.")
+        wait_for(lambda: len(sink.written) > 2)
+        pipeline.pause()
+        time.sleep(0.05)
+        written = len(sink.written)
+        time.sleep(0.1)
+        assert len(sink.written) == written and pipeline.speaking
+        pipeline.resume()
+        wait_for(lambda: not pipeline.speaking)
+        assert len(sink.written) > written
+    finally:
+        pipeline.close()
+
+
+def test_everything_queued_is_played_in_order():
+    sink = FakeAudioSink(realtime=False)
+    pipeline = SpeechPipeline(FakeSpeechService(), sink)
+    try:
+        pipeline.speak(REPLY)
+        wait_for(lambda: not pipeline.speaking)
+        chunks = split_sentences(REPLY)
+        assert [m["chars"] for m in pipeline.metrics] == [len(chunk) for chunk in chunks]
+        assert sum(len(pcm) for pcm in sink.written) == sum(int(SAMPLE_RATE * 0.05 * len(c)) * 2 for c in chunks)
+    finally:
+        pipeline.close()
@@ -0,0 +1,15 @@
+"""Words of message text, as the search index and the memory index see them."""
+import re
+
+WORD = re.compile(r"[\w']+")
+# Too common to tell messages apart
+STOPWORDS = frozenset(
+    "a an and are as at be but by can could do does for from had has have how i if in into is it its "
+    "me my of on or our so that the their them then there these they this to was we were what when "
+    "where which who why will with would you your".split()
+)
+
+
+def words(text):
+    """Lowercased words of a text without stopwords, in order"""
+    return [word for word in WORD.findall(text.lower()) if word not in STOPWORDS]